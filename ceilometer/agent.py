@@ -19,8 +19,9 @@
 # under the License.
 
 import collections
-import itertools
+import time
 
+import eventlet
 from oslo.config import cfg
 import six
 from six.moves.urllib import parse as urlparse
@@ -36,6 +37,26 @@ from ceilometer import utils
 
 LOG = log.getLogger(__name__)
 
+OPTS = [
+    cfg.FloatOpt('polling_budget',
+                 default=1.0,
+                 help='Fraction of the polling interval a polling cycle may '
+                      'last. The pollsters not started when it is spent are '
+                      'skipped for the cycle, the pollsters which went over '
+                      'their share of it before running last. 0 disables '
+                      'the budget.'),
+    cfg.IntOpt('pollster_workers',
+               default=1,
+               help='Number of pollsters of a polling task run '
+                    'concurrently.'),
+    cfg.IntOpt('polling_stats_interval',
+               default=600,
+               help='Number of seconds between two logs of the pollster '
+                    'timing statistics, 0 disables them.'),
+]
+
+cfg.CONF.register_opts(OPTS)
+
 cfg.CONF.import_opt('heartbeat', 'ceilometer.coordination',
                     group='coordination')
 
@@ -68,14 +89,59 @@ class Resources(object):
         return '%s-%s' % (source.name, pollster.name)
 
 
+class PollsterStats(object):
+    """Timing statistics of a pollster within a polling task."""
+
+    __slots__ = ('runs', 'samples', 'errors', 'skips', 'last_duration',
+                 'average_duration', 'max_duration', 'over_budget',
+                 'skipped')
+
+    # Weight of the last duration in the moving average.
+    WEIGHT = 0.3
+
+    def __init__(self):
+        self.runs = 0
+        self.samples = 0
+        self.errors = 0
+        self.skips = 0
+        self.last_duration = 0.0
+        self.average_duration = 0.0
+        self.max_duration = 0.0
+        self.over_budget = False
+        self.skipped = False
+
+    def record(self, duration, samples, error=False, budget=None):
+        if self.runs:
+            self.average_duration += self.WEIGHT * (duration -
+                                                    self.average_duration)
+        else:
+            self.average_duration = duration
+        self.runs += 1
+        self.samples += samples
+        self.errors += int(error)
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        self.over_budget = budget is not None and duration > budget
+        self.skipped = False
+
+    def skip(self):
+        self.skips += 1
+        self.skipped = True
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__
+                    if name != 'skipped')
+
+
 class PollingTask(object):
     """Polling task for polling samples and inject into pipeline.
 
     A polling task can be invoked periodically or only once.
     """
 
-    def __init__(self, agent_manager):
+    def __init__(self, agent_manager, interval=None):
         self.manager = agent_manager
+        self.interval = interval
 
         # elements of the Cartesian product of sources X pollsters
         # with a common interval
@@ -89,6 +155,11 @@ class PollingTask(object):
         resource_factory = lambda: Resources(agent_manager)
         self.resources = collections.defaultdict(resource_factory)
 
+        # timing statistics of each combination of pollster and source
+        self.stats = collections.defaultdict(PollsterStats)
+        self.last_duration = None
+        self._stats_logged = time.time()
+
     def add(self, pollster, pipeline):
         if pipeline.source.name not in self.publishers:
             publish_context = publish_pipeline.PublishContext(
@@ -99,19 +170,49 @@ class PollingTask(object):
         key = Resources.key(pipeline.source, pollster)
         self.resources[key].setup(pipeline)
 
+    def _prioritized_matches(self):
+        """Return the pollster matches, the slow ones last.
+
+        Pollsters skipped by the previous cycle run first, so that a spent
+        budget does not starve them.
+        """
+        def priority(match):
+            stats = self.stats[Resources.key(*match)]
+            return (not stats.skipped, stats.over_budget,
+                    stats.average_duration)
+        return sorted(self.pollster_matches, key=priority)
+
     def poll_and_publish(self):
         """Polling sample and publish into pipeline."""
+        start = time.time()
+        budget = None
+        if self.interval and cfg.CONF.polling_budget > 0:
+            budget = self.interval * cfg.CONF.polling_budget
+        share = (budget / len(self.pollster_matches)
+                 if budget and self.pollster_matches else None)
+        skipped = []
         agent_resources = self.manager.discover()
-        cache = {}
-        discovery_cache = {}
-        for source, pollster in self.pollster_matches:
+        # Concurrent pollsters share the discoveries and inspections.
+        cache = utils.SingleFlightCache()
+        discovery_cache = utils.SingleFlightCache()
+
+        def poll(match):
+            source, pollster = match
+            key = Resources.key(source, pollster)
+            stats = self.stats[key]
+            if budget is not None and time.time() - start >= budget:
+                stats.skip()
+                skipped.append(key)
+                return
             LOG.info(_("Polling pollster %(poll)s in the context of %(src)s"),
                      dict(poll=pollster.name, src=source))
+            polled = time.time()
+            samples = []
+            error = False
             pollster_resources = None
             if pollster.obj.default_discovery:
                 pollster_resources = self.manager.discover(
                     [pollster.obj.default_discovery], discovery_cache)
-            key = Resources.key(source, pollster)
             source_resources = list(self.resources[key].get(discovery_cache))
             with self.publishers[source.name] as publisher:
                 try:
@@ -124,10 +225,63 @@ class PollingTask(object):
                     ))
                     publisher(samples)
                 except Exception as err:
+                    error = True
                     LOG.warning(_(
                         'Continue after error from %(name)s: %(error)s')
                         % ({'name': pollster.name, 'error': err}),
                         exc_info=True)
+            stats.record(time.time() - polled, len(samples), error, share)
+
+        matches = self._prioritized_matches()
+        workers = cfg.CONF.pollster_workers
+        if workers > 1 and len(matches) > 1:
+            pool = eventlet.GreenPool(workers)
+            threads = [(match, pool.spawn(poll, match)) for match in matches]
+            pool.waitall()
+            for (source, pollster), thread in threads:
+                try:
+                    thread.wait()
+                except Exception:
+                    LOG.exception(_('Failed to poll pollster %(poll)s in '
+                                    'the context of %(src)s'),
+                                  dict(poll=pollster.name, src=source))
+        else:
+            for match in matches:
+                poll(match)
+
+        self.last_duration = time.time() - start
+        if skipped:
+            LOG.warning(_('Polling cycle of interval %(interval)ss spent its '
+                          'budget of %(budget).1fs, skipped %(skipped)s'),
+                        {'interval': self.interval, 'budget': budget,
+                         'skipped': ', '.join(sorted(skipped))})
+        elif self.interval and self.last_duration > self.interval:
+            LOG.warning(_('Polling cycle of interval %(interval)ss took '
+                          '%(duration).1fs, slowest pollsters: %(slowest)s'),
+                        {'interval': self.interval,
+                         'duration': self.last_duration,
+                         'slowest': self._slowest()})
+        self._log_stats()
+
+    def _slowest(self, count=3):
+        slowest = sorted(six.iteritems(self.stats),
+                         key=lambda item: item[1].last_duration,
+                         reverse=True)[:count]
+        return ', '.join('%s (%.1fs)' % (key, stats.last_duration)
+                         for key, stats in slowest)
+
+    def _log_stats(self):
+        interval = cfg.CONF.polling_stats_interval
+        now = time.time()
+        if interval <= 0 or now - self._stats_logged < interval:
+            return
+        self._stats_logged = now
+        for key, stats in sorted(six.iteritems(self.stats)):
+            LOG.info(_('Pollster %(key)s: %(runs)d runs, %(skips)d skipped, '
+                       'average %(average_duration).3fs, max '
+                       '%(max_duration).3fs, %(samples)d samples, '
+                       '%(errors)d errors'),
+                     dict(stats.as_dict(), key=key))
 
 
 class AgentManager(os_service.Service):
@@ -142,6 +296,17 @@ class AgentManager(os_service.Service):
         self.partition_coordinator = coordination.PartitionCoordinator()
         self.group_prefix = ('%s-%s' % (namespace, group_prefix)
                              if group_prefix else namespace)
+        # The resources kept across the polling cycles by the discoverers
+        # with a cache_ttl, as (discoverer, expiry, resources) by url.
+        self._discovered = {}
+        self._discovery_generation = 0
+        # The resources lost the transformer state of which is handed over,
+        # as (changed at, matchers, new owners, serial number), and the
+        # resources gained the state of which is to be taken over, as
+        # (changed at, matchers), by group.
+        self._hand_overs = {}
+        self._take_overs = {}
+        self.partition_coordinator.watch_rebalance(self._on_rebalance)
 
     @staticmethod
     def _extensions(category, agent_ns=None):
@@ -165,19 +330,19 @@ class AgentManager(os_service.Service):
         for group in groups:
             self.partition_coordinator.join_group(group)
 
-    def create_polling_task(self):
+    def create_polling_task(self, interval=None):
         """Create an initially empty polling task."""
-        return PollingTask(self)
+        return PollingTask(self, interval)
 
     def setup_polling_tasks(self):
         polling_tasks = {}
-        for pipeline, pollster in itertools.product(
-                self.pipeline_manager.pipelines,
-                self.pollster_manager.extensions):
-            if pipeline.support_meter(pollster.name):
+        for pollster in self.pollster_manager.extensions:
+            for pipeline in self.pipeline_manager.pipelines_for(
+                    pollster.name):
                 polling_task = polling_tasks.get(pipeline.get_interval())
                 if not polling_task:
-                    polling_task = self.create_polling_task()
+                    polling_task = self.create_polling_task(
+                        pipeline.get_interval())
                     polling_tasks[pipeline.get_interval()] = polling_task
                 polling_task.add(pollster, pipeline)
 
@@ -197,7 +362,8 @@ class AgentManager(os_service.Service):
         # allow time for coordination if necessary
         delay_start = self.partition_coordinator.is_active()
 
-        for interval, task in six.iteritems(self.setup_polling_tasks()):
+        self.polling_tasks = self.setup_polling_tasks()
+        for interval, task in six.iteritems(self.polling_tasks):
             self.tg.add_timer(interval,
                               self.interval_task,
                               initial_delay=interval if delay_start else None,
@@ -209,6 +375,19 @@ class AgentManager(os_service.Service):
     def interval_task(task):
         task.poll_and_publish()
 
+    def polling_stats(self):
+        """Return the pollster timing statistics of each polling task.
+
+        :return: a dict keyed by polling interval of dicts with the last
+                 cycle duration and the statistics of each pollster
+        """
+        return dict((interval, {
+            'last_duration': task.last_duration,
+            'pollsters': dict((key, stats.as_dict())
+                              for key, stats in six.iteritems(task.stats)),
+        }) for interval, task in six.iteritems(
+            getattr(self, 'polling_tasks', {})))
+
     @staticmethod
     def _parse_discoverer(url):
         s = urlparse.urlparse(url)
@@ -220,25 +399,181 @@ class AgentManager(os_service.Service):
                 return d.obj
         return None
 
+    def _discover(self, url, discovery_cache=None):
+        name, param = self._parse_discoverer(url)
+        discoverer = self._discoverer(name)
+        if discoverer:
+            try:
+                discovered = self._discover_cached(url, discoverer, param)
+                group_id = self.construct_group_id(discoverer.group_id)
+                partitioned = self.partition_coordinator.extract_my_subset(
+                    group_id, discovered)
+                if group_id in self._hand_overs:
+                    self._confirm_hand_over(group_id)
+                if group_id in self._take_overs:
+                    self._take_over_state(group_id)
+                if discovery_cache is not None:
+                    discovery_cache[url] = partitioned
+                return partitioned
+            except Exception as err:
+                LOG.exception(_('Unable to discover resources: %s') % err)
+        else:
+            LOG.warning(_('Unknown discovery extension: %s') % name)
+        return []
+
+    def _discover_cached(self, url, discoverer, param):
+        now = time.time()
+        cached = self._discovered.get(url)
+        if cached is not None and cached[1] > now:
+            return cached[2]
+        generation = self._discovery_generation
+        discovered = discoverer.discover(self, param)
+        ttl = discoverer.cache_ttl
+        # Resources discovered while being invalidated may be outdated.
+        if ttl > 0 and generation == self._discovery_generation:
+            self._discovered[url] = (discoverer, now + ttl, discovered)
+        return discovered
+
+    def invalidate_discovery(self, discoverer=None):
+        """Discover the resources again on the next polling cycle.
+
+        May be called from another thread, as when a discoverer is told of
+        a change of its resources.
+
+        :param discoverer: the discoverer whose resources changed, all the
+                           resources if None
+        """
+        self._discovery_generation += 1
+        for url, cached in list(self._discovered.items()):
+            if discoverer is None or cached[0] is discoverer:
+                self._discovered.pop(url, None)
+
+    def _transformers(self):
+        """Yield the transformers of the pipelines with a stable id."""
+        sinks = set()
+        pipeline_manager = getattr(self, 'pipeline_manager', None)
+        for pipeline in (pipeline_manager.pipelines
+                         if pipeline_manager else []):
+            sink = getattr(pipeline, 'sink', None)
+            if sink is None or sink.name in sinks:
+                continue
+            sinks.add(sink.name)
+            for i, transformer in enumerate(sink.transformers):
+                yield '%s:%d' % (sink.name, i), transformer
+
+    @staticmethod
+    def _resource_matcher(resources):
+        """Return whether a resource id belongs to one of the resources.
+
+        The samples of a resource, such as those of the disks of an
+        instance, have ids made of the id of the resource and of other
+        parts, separated by dashes.
+        """
+        ids = frozenset(six.text_type(getattr(r, 'id', r)) for r in resources)
+
+        def match(resource_id):
+            if not resource_id:
+                return False
+            if resource_id in ids:
+                return True
+            dashes = [i for i, c in enumerate(resource_id) if c == '-']
+            if not dashes:
+                return False
+            starts = [0] + [i + 1 for i in dashes]
+            ends = dashes + [len(resource_id)]
+            return any(resource_id[start:end] in ids
+                       for start in starts for end in ends if end > start)
+
+        return match
+
+    @staticmethod
+    def _any_matcher(matchers):
+        def match(resource_id):
+            return any(m(resource_id) for m in matchers)
+        return match
+
+    def _on_rebalance(self, rebalance):
+        """Hand the transformer state of the moved resources over.
+
+        The state is kept until the agents the resources moved to
+        acknowledge they took it over.
+        """
+        now = time.time()
+        group_id = rebalance.group_id
+        if rebalance.lost:
+            changed_at, matchers, owners, serial = self._hand_overs.get(
+                group_id, (None, [], set(), None))
+            if changed_at is None or (now - changed_at >
+                                      coordination.REBALANCE_WINDOW):
+                matchers, owners = [], set()
+            matchers.append(self._resource_matcher(rebalance.lost))
+            owners |= self.partition_coordinator.get_owners(group_id,
+                                                            rebalance.lost)
+            match = self._any_matcher(matchers)
+            state = {}
+            for transformer_id, transformer in self._transformers():
+                transformer_state = transformer.export_state(match)
+                if transformer_state:
+                    state[transformer_id] = transformer_state
+            serial = (self.partition_coordinator.publish_state(group_id,
+                                                               state)
+                      if state else None)
+            self._hand_overs[group_id] = (now, matchers, owners, serial)
+        if rebalance.gained:
+            changed_at, matchers = self._take_overs.get(group_id,
+                                                        (None, []))
+            matchers.append(self._resource_matcher(rebalance.gained))
+            self._take_overs[group_id] = (now, matchers)
+
+    def _confirm_hand_over(self, group_id):
+        """Drop the transformer state handed over once taken over.
+
+        The state not taken over within the rebalance window, as when it
+        could not be published, is kept.
+        """
+        changed_at, matchers, owners, serial = self._hand_overs[group_id]
+        if time.time() - changed_at > coordination.REBALANCE_WINDOW:
+            del self._hand_overs[group_id]
+            return
+        if serial is None or not self.partition_coordinator.state_acknowledged(
+                group_id, serial, owners):
+            return
+        match = self._any_matcher(matchers)
+        for transformer_id, transformer in self._transformers():
+            transformer.drop_state(match)
+        del self._hand_overs[group_id]
+        self.partition_coordinator.publish_state(group_id, None)
+
+    def _take_over_state(self, group_id):
+        """Import the state of the resources gained by a group.
+
+        The agents losing the resources may publish their state after the
+        rebalance is noticed here, so it is fetched again on every polling
+        cycle for a while, the state kept being the most recent one.
+        """
+        changed_at, matchers = self._take_overs[group_id]
+        if time.time() - changed_at > coordination.REBALANCE_WINDOW:
+            del self._take_overs[group_id]
+            return
+        match = self._any_matcher(matchers)
+        for member, serial, state in self.partition_coordinator.fetch_state(
+                group_id):
+            for transformer_id, transformer in self._transformers():
+                if state.get(transformer_id):
+                    transformer.import_state(state[transformer_id], match)
+            self.partition_coordinator.acknowledge_state(group_id, member,
+                                                         serial)
+
     def discover(self, discovery=None, discovery_cache=None):
         resources = []
         for url in (discovery or self.default_discovery):
-            if discovery_cache is not None and url in discovery_cache:
+            if discovery_cache is None:
+                resources.extend(self._discover(url))
+            elif url in discovery_cache:
                 resources.extend(discovery_cache[url])
-                continue
-            name, param = self._parse_discoverer(url)
-            discoverer = self._discoverer(name)
-            if discoverer:
-                try:
-                    discovered = discoverer.discover(self, param)
-                    partitioned = self.partition_coordinator.extract_my_subset(
-                        self.construct_group_id(discoverer.group_id),
-                        discovered)
-                    resources.extend(partitioned)
-                    if discovery_cache is not None:
-                        discovery_cache[url] = partitioned
-                except Exception as err:
-                    LOG.exception(_('Unable to discover resources: %s') % err)
             else:
-                LOG.warning(_('Unknown discovery extension: %s') % name)
+                # Concurrent pollsters wait for the same discovery.
+                resources.extend(utils.single_flight(
+                    discovery_cache, url,
+                    lambda: self._discover(url, discovery_cache)))
         return resources
@@ -15,34 +15,228 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import functools
+import hashlib
+import time
+
+import eventlet
 from oslo.config import cfg
 
 from ceilometer import nova_client
+from ceilometer.openstack.common.gettextutils import _
+from ceilometer.openstack.common import log
 from ceilometer import plugin
 
+LOG = log.getLogger(__name__)
+
 OPTS = [
     cfg.BoolOpt('workload_partitioning',
                 default=False,
                 help='Enable work-load partitioning, allowing multiple '
-                     'compute agents to be run simultaneously.')
+                     'compute agents to be run simultaneously.'),
+    cfg.IntOpt('instance_discovery_ttl',
+               default=0,
+               help='Number of seconds the instances listed by Nova are '
+                    'polled for before being listed again. The instances '
+                    'are also listed again whenever the hypervisor reports '
+                    'an instance change, as libvirt does when '
+                    'libvirt_events is enabled. 0 lists them on every '
+                    'polling cycle.'),
+    cfg.StrOpt('instance_discovery_method',
+               default='naive',
+               help='How the instances of the host are discovered: "naive" '
+                    'lists them through the Nova API, "libvirt_metadata" '
+                    'lists the running libvirt domains and reads the '
+                    'metadata Nova sets on them, the Nova API only being '
+                    'used to complete it in the background.'),
+    cfg.IntOpt('instance_reconciliation_interval',
+               default=600,
+               help='Number of seconds between two listings of the '
+                    'instances through the Nova API, completing the '
+                    'instances discovered with libvirt_metadata.'),
 ]
 cfg.CONF.register_opts(OPTS, group='compute')
 
 
+NOVA_METADATA_NAMESPACE = 'http://openstack.org/xmlns/libvirt/nova/1.0'
+
+# Minimum number of seconds between two listings of the instances through
+# the Nova API triggered by instances it was not listed with.
+MIN_RECONCILIATION_INTERVAL = 60
+
+# Attributes taken from the Nova API listing for the instances discovered
+# with libvirt_metadata, lacking in the metadata of the domains.
+RECONCILED_ATTRIBUTES = [
+    'metadata',
+    'status',
+    'OS-EXT-STS:vm_state',
+    'reservation_id',
+    'OS-EXT-AZ:availability_zone',
+    'kernel_id',
+    'ramdisk_id',
+]
+
+
+class NovaLikeServer(object):
+    """An instance built from the metadata of a domain.
+
+    It has the attributes of a server listed by the Nova API that the
+    pollsters rely on.
+    """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __repr__(self):
+        return '<NovaLikeServer: %s>' % getattr(self, 'name', 'unknown-name')
+
+
 class InstanceDiscovery(plugin.DiscoveryBase):
     def __init__(self):
         super(InstanceDiscovery, self).__init__()
         self.nova_cli = nova_client.Client()
+        self._watching = None
+        # The servers listed by the last reconciliation, by id.
+        self._servers = {}
+        self._reconciled_at = None
+        self._reconciling = False
+
+    def _watch(self, manager):
+        inspector = getattr(manager, 'inspector', None)
+        self._watching = bool(inspector and inspector.watch_instances(
+            functools.partial(manager.invalidate_discovery, self)))
+        if not self._watching:
+            LOG.info(_('The hypervisor does not report the instance '
+                       'changes, new instances are polled after up to %d '
+                       'seconds.') % self.cache_ttl)
 
     def discover(self, manager, param=None):
         """Discover resources to monitor."""
-        instances = self.nova_cli.instance_get_all_by_host(cfg.CONF.host)
+        if self._watching is None and self.cache_ttl > 0:
+            self._watch(manager)
+        if cfg.CONF.compute.instance_discovery_method == 'libvirt_metadata':
+            instances = self._discover_libvirt_metadata(manager)
+        else:
+            instances = self.nova_cli.instance_get_all_by_host(cfg.CONF.host)
         return [i for i in instances
                 if getattr(i, 'OS-EXT-STS:vm_state', None) != 'error']
 
+    def _discover_libvirt_metadata(self, manager):
+        instances = []
+        unknown = False
+        for domain, metadata in manager.inspector.inspect_instances_metadata(
+                NOVA_METADATA_NAMESPACE):
+            if metadata is None:
+                # Not a Nova instance.
+                continue
+            try:
+                instance = self._instance_from_metadata(domain, metadata)
+            except (AttributeError, KeyError, ValueError) as err:
+                LOG.warning(_('Unable to parse the Nova metadata of domain '
+                              '%(domain)s: %(error)s')
+                            % {'domain': domain.name, 'error': err})
+                continue
+            server = self._servers.get(instance.id)
+            if server is None:
+                unknown = True
+            else:
+                self._reconcile_instance(instance, server)
+            instances.append(instance)
+        self._schedule_reconciliation(unknown)
+        return instances
+
+    @staticmethod
+    def _instance_from_metadata(domain, metadata):
+        """Build an instance from the nova:instance metadata of a domain."""
+        def find(path):
+            element = metadata.find(path, namespaces={'nova':
+                                                      NOVA_METADATA_NAMESPACE})
+            if element is None:
+                raise ValueError('no %s element' % path)
+            return element
+
+        def number(path):
+            text = find(path).text
+            if text is None:
+                raise ValueError('no value for %s element' % path)
+            return int(text)
+
+        flavor = find('nova:flavor')
+        project = find('nova:owner/nova:project')
+        user = find('nova:owner/nova:user')
+        root = metadata.find('nova:root',
+                             namespaces={'nova': NOVA_METADATA_NAMESPACE})
+        image = None
+        if root is not None and root.get('type') == 'image':
+            image = {'id': root.get('uuid')}
+        host = cfg.CONF.host
+        project_id = project.get('uuid')
+        if project_id is None:
+            raise ValueError('no uuid for nova:owner/nova:project')
+        return NovaLikeServer(**{
+            'id': domain.UUID,
+            'name': find('nova:name').text,
+            'flavor': {
+                'id': None,
+                'name': flavor.get('name'),
+                'vcpus': number('nova:flavor/nova:vcpus'),
+                'ram': number('nova:flavor/nova:memory'),
+                'disk': number('nova:flavor/nova:disk'),
+                'ephemeral': number('nova:flavor/nova:ephemeral'),
+            },
+            'image': image,
+            'tenant_id': project_id,
+            'user_id': user.get('uuid'),
+            'hostId': hashlib.sha224(project_id + host).hexdigest(),
+            'status': 'ACTIVE',
+            'metadata': {},
+            'OS-EXT-SRV-ATTR:instance_name': domain.name,
+            'OS-EXT-SRV-ATTR:host': host,
+            'OS-EXT-STS:vm_state': 'active',
+        })
+
+    @staticmethod
+    def _reconcile_instance(instance, server):
+        """Complete an instance with what the Nova API listed for it."""
+        for attr in RECONCILED_ATTRIBUTES:
+            if hasattr(server, attr):
+                setattr(instance, attr, getattr(server, attr))
+        if server.flavor.get('name') == instance.flavor['name']:
+            instance.flavor['id'] = server.flavor['id']
+        if instance.image and server.image:
+            if server.image.get('id') == instance.image['id']:
+                instance.image = dict(server.image)
+
+    def _schedule_reconciliation(self, unknown):
+        if self._reconciling:
+            return
+        elapsed = (time.time() - self._reconciled_at
+                   if self._reconciled_at is not None else None)
+        if (elapsed is None or
+                elapsed >= cfg.CONF.compute.instance_reconciliation_interval or
+                (unknown and elapsed >= MIN_RECONCILIATION_INTERVAL)):
+            self._reconciling = True
+            eventlet.spawn_n(self._reconcile)
+
+    def _reconcile(self):
+        """List the instances of the host through the Nova API."""
+        try:
+            servers = self.nova_cli.instance_get_all_by_host(cfg.CONF.host)
+            self._servers = dict((server.id, server) for server in servers)
+        except Exception as err:
+            LOG.warning(_('Unable to reconcile the instances with the Nova '
+                          'API: %s') % err)
+        finally:
+            self._reconciled_at = time.time()
+            self._reconciling = False
+
     @property
     def group_id(self):
         if cfg.CONF.compute.workload_partitioning:
             return cfg.CONF.host
         else:
             return None
+
+    @property
+    def cache_ttl(self):
+        return cfg.CONF.compute.instance_discovery_ttl
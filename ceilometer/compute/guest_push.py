@@ -0,0 +1,179 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Publish the guest agent reports as soon as they are received."""
+
+import time
+
+import eventlet
+from eventlet import event
+from oslo.config import cfg
+
+from ceilometer.compute.pollsters import util
+from ceilometer.openstack.common.gettextutils import _
+from ceilometer.openstack.common import log
+from ceilometer import pipeline as publish_pipeline
+
+OPTS = [
+    cfg.BoolOpt('push_mode',
+                default=False,
+                help='Publish the memory and disk usage samples of an '
+                     'instance as soon as its guest agent reports them, on '
+                     'top of the regular polling.'),
+    cfg.FloatOpt('push_min_interval',
+                 default=10.0,
+                 help='Minimum number of seconds between two pushes of the '
+                      'samples of an instance. The reports received '
+                      'meanwhile are coalesced into the next push.'),
+]
+
+cfg.CONF.register_opts(OPTS, group='oga')
+
+LOG = log.getLogger(__name__)
+
+# Pollsters whose samples are built from the guest agent reports only.
+GUEST_METERS = ('memory.total', 'memory.unused', 'memory.swap',
+                'memory.buffer', 'memory.cached', 'disk.usage')
+
+# Number of seconds the discovered instances are used for, so that a change
+# of their flavor, image or name is published. The discovery goes through
+# the discovery cache of the agent when it has one.
+_DISCOVERY_INTERVAL = 60
+
+
+class GuestReportEmitter(object):
+    """Turn the guest agent reports into samples when they arrive.
+
+    The emitter is woken up by the store of the reports, as soon as a
+    guest reports. The reports of an instance received within
+    push_min_interval are coalesced, only the latest one is published,
+    once the interval is over. Samples are built by the regular guest
+    pollsters from the report, and go through the same pipelines as the
+    polled ones. The instances are discovered again every
+    _DISCOVERY_INTERVAL seconds.
+    """
+
+    def __init__(self, manager, min_interval=None):
+        self.manager = manager
+        self.min_interval = (cfg.CONF.oga.push_min_interval
+                             if min_interval is None else min_interval)
+        self._version = 0
+        self._pending = {}
+        self._last_push = {}
+        self._instances = {}
+        self._discovered = None
+        self._publishers = []
+        self._wakeup = event.Event()
+
+    def setup(self, pipelines):
+        """Prepare publishing to the pipelines of the guest meters.
+
+        :return: whether any pipeline supports a guest meter
+        """
+        self._publishers = []
+        for pollster in self.manager.pollster_manager:
+            if pollster.name not in GUEST_METERS:
+                continue
+            matching = [p for p in pipelines if p.support_meter(pollster.name)]
+            if matching:
+                self._publishers.append((pollster,
+                                         publish_pipeline.PublishContext(
+                                             self.manager.context,
+                                             matching)))
+        return bool(self._publishers)
+
+    def notify(self):
+        """Wake the emitter up, a guest having reported."""
+        if not self._wakeup.ready():
+            self._wakeup.send()
+
+    def _next_due(self):
+        """Seconds until a pending report is due, None if there is none."""
+        if not self._pending:
+            return None
+        return max(0, min(self._last_push.get(name, 0)
+                          for name in self._pending) +
+                   self.min_interval - time.time())
+
+    def run(self):
+        """Push the reports as they arrive, until killed."""
+        self.manager.oga_inspector.store.watch(self.notify)
+        while True:
+            with eventlet.Timeout(self._next_due(), False):
+                self._wakeup.wait()
+            # The reports received from now on wake the emitter up again.
+            self._wakeup = event.Event()
+            try:
+                self.push()
+            except Exception as err:
+                LOG.exception(_('Unable to push guest reports: %s') % err)
+
+    def _refresh_instances(self, now):
+        if (self._discovered is not None and
+                now - self._discovered < _DISCOVERY_INTERVAL):
+            return
+        self._discovered = now
+        self._instances = dict((util.instance_name(i), i)
+                               for i in self.manager.discover())
+
+    def _collect(self):
+        inspector = self.manager.oga_inspector
+        if inspector.store.version == self._version:
+            return
+        self._version, changes = inspector.inspect_guest_changes(
+            self._version)
+        # A newer report of an instance replaces the one not pushed yet.
+        self._pending.update(changes)
+
+    def push(self):
+        """Publish the samples of the instances which reported."""
+        try:
+            self._collect()
+        except Exception as err:
+            # The reports already collected are still due.
+            LOG.exception(_('Unable to collect guest reports: %s') % err)
+        if not self._pending:
+            return
+
+        now = time.time()
+        self._refresh_instances(now)
+
+        due = {}
+        for name, guest_info in list(self._pending.items()):
+            if name not in self._instances:
+                # Not ours to publish, or not known by nova yet.
+                del self._pending[name]
+            elif now - self._last_push.get(name, 0) >= self.min_interval:
+                due[name] = self._pending.pop(name)
+                self._last_push[name] = now
+        if not due:
+            return
+
+        resources = [self._instances[name] for name in due]
+        cache = {util.CACHE_KEY_GUEST: due}
+        for pollster, publish_context in self._publishers:
+            with publish_context as publisher:
+                try:
+                    samples = list(pollster.obj.get_samples(
+                        manager=self.manager,
+                        cache=cache,
+                        resources=resources))
+                    publisher(samples)
+                except Exception as err:
+                    LOG.warning(_(
+                        'Continue after error from %(name)s: %(error)s')
+                        % ({'name': pollster.name, 'error': err}),
+                        exc_info=True)
+
+        for name in list(self._last_push):
+            if name not in self._instances:
+                del self._last_push[name]
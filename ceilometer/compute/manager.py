@@ -15,9 +15,13 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from oslo.config import cfg
+
 from ceilometer import agent
+from ceilometer.compute import guest_push
 from ceilometer.compute.virt import inspector as virt_inspector
 from ceilometer.compute.virt import oga_inspector
+from ceilometer.openstack.common.gettextutils import _
 from ceilometer.openstack.common import log
 
 LOG = log.getLogger(__name__)
@@ -31,10 +35,20 @@ class AgentManager(agent.AgentManager):
         self._oga_inspector = oga_inspector.get_oga_inspector()
         self.tg.add_timer(60, self._oga_inspector.clear_outdated_agent)
 
+    def start(self):
+        super(AgentManager, self).start()
+        if cfg.CONF.oga.push_mode:
+            emitter = guest_push.GuestReportEmitter(self)
+            if emitter.setup(self.pipeline_manager.pipelines):
+                self.tg.add_thread(emitter.run)
+            else:
+                LOG.warning(_("Guest agent push mode is enabled but no "
+                              "pipeline publishes guest meters."))
+
     @property
     def inspector(self):
         return self._inspector
 
     @property
     def oga_inspector(self):
-        return self._oga_inspector
\ No newline at end of file
+        return self._oga_inspector
@@ -29,12 +29,26 @@ LOG = log.getLogger(__name__)
 
 class CPUPollster(plugin.ComputePollster):
 
+    CACHE_KEY_CPU = 'cpu'
+
     def get_samples(self, manager, cache, resources):
+        util.prefetch(manager.inspector, cache, self.CACHE_KEY_CPU,
+                      resources,
+                      lambda instance: manager.inspector.inspect_cpus(
+                          util.instance_name(instance)))
         for instance in resources:
             LOG.debug(_('checking instance %s'), instance.id)
             instance_name = util.instance_name(instance)
             try:
-                cpu_info = manager.inspector.inspect_cpus(instance_name)
+                stats = util.get_instance_stats(manager.inspector, cache,
+                                                instance, resources)
+                c_cache = cache.get(self.CACHE_KEY_CPU, {})
+                if stats is not None and stats.cpu is not None:
+                    cpu_info = stats.cpu
+                elif instance_name in c_cache:
+                    cpu_info = util.cached_result(c_cache[instance_name])
+                else:
+                    cpu_info = manager.inspector.inspect_cpus(instance_name)
                 LOG.debug(_("CPUTIME USAGE: %(instance)s %(time)d"),
                           {'instance': instance.__dict__,
                            'time': cpu_info.time})
@@ -81,6 +95,9 @@ class CPUUtilPollster(plugin.ComputePollster):
             except virt_inspector.InstanceNotFoundException as err:
                 # Instance was deleted while getting samples. Ignore it.
                 LOG.debug(_('Exception while getting samples %s'), err)
+            except virt_inspector.NoDataException as err:
+                # First reading of the counters, the rate comes next time.
+                LOG.debug(_('Exception while getting samples %s'), err)
             except ceilometer.NotImplementedError:
                 # Selected inspector does not implement this pollster.
                 LOG.debug(_('Obtaining CPU Util is not implemented for %s'),
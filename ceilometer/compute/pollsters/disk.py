@@ -61,51 +61,67 @@ class _Base(plugin.ComputePollster):
 
     CACHE_KEY_DISK = 'diskio'
 
-    def _populate_cache(self, inspector, cache, instance, instance_name):
-        i_cache = cache.setdefault(self.CACHE_KEY_DISK, {})
-        if instance_name not in i_cache:
-            r_bytes = 0
-            r_requests = 0
-            w_bytes = 0
-            w_requests = 0
-            per_device_read_bytes = {}
-            per_device_read_requests = {}
-            per_device_write_bytes = {}
-            per_device_write_requests = {}
-            for disk, info in inspector.inspect_disks(instance_name):
-                LOG.debug(self.DISKIO_USAGE_MESSAGE,
-                          instance, disk.device, info.read_requests,
-                          info.read_bytes, info.write_requests,
-                          info.write_bytes, info.errors)
-                r_bytes += info.read_bytes
-                r_requests += info.read_requests
-                w_bytes += info.write_bytes
-                w_requests += info.write_requests
-                # per disk data
-                per_device_read_bytes[disk.device] = info.read_bytes
-                per_device_read_requests[disk.device] = info.read_requests
-                per_device_write_bytes[disk.device] = info.write_bytes
-                per_device_write_requests[disk.device] = info.write_requests
-            per_device_requests = {
-                'read_bytes': per_device_read_bytes,
-                'read_requests': per_device_read_requests,
-                'write_bytes': per_device_write_bytes,
-                'write_requests': per_device_write_requests,
-            }
-            i_cache[instance_name] = DiskIOData(
-                r_bytes=r_bytes,
-                r_requests=r_requests,
-                w_bytes=w_bytes,
-                w_requests=w_requests,
-                per_disk_requests=per_device_requests,
-            )
-        return i_cache[instance_name]
+    def _populate_cache(self, inspector, cache, instance, instance_name,
+                        resources=()):
+        return util.cached_result(util.get_cached(
+            cache, self.CACHE_KEY_DISK, instance_name,
+            lambda: self._inspect_disks(inspector, cache, instance,
+                                        instance_name, resources)))
+
+    def _inspect_disks(self, inspector, cache, instance, instance_name,
+                       resources):
+        stats = util.get_instance_stats(inspector, cache, instance,
+                                        resources)
+        if stats is not None:
+            disks = stats.disks
+        else:
+            disks = inspector.inspect_disks(instance_name)
+        r_bytes = 0
+        r_requests = 0
+        w_bytes = 0
+        w_requests = 0
+        per_device_read_bytes = {}
+        per_device_read_requests = {}
+        per_device_write_bytes = {}
+        per_device_write_requests = {}
+        for disk, info in disks:
+            LOG.debug(self.DISKIO_USAGE_MESSAGE,
+                      instance, disk.device, info.read_requests,
+                      info.read_bytes, info.write_requests,
+                      info.write_bytes, info.errors)
+            r_bytes += info.read_bytes
+            r_requests += info.read_requests
+            w_bytes += info.write_bytes
+            w_requests += info.write_requests
+            # per disk data
+            per_device_read_bytes[disk.device] = info.read_bytes
+            per_device_read_requests[disk.device] = info.read_requests
+            per_device_write_bytes[disk.device] = info.write_bytes
+            per_device_write_requests[disk.device] = info.write_requests
+        per_device_requests = {
+            'read_bytes': per_device_read_bytes,
+            'read_requests': per_device_read_requests,
+            'write_bytes': per_device_write_bytes,
+            'write_requests': per_device_write_requests,
+        }
+        return DiskIOData(
+            r_bytes=r_bytes,
+            r_requests=r_requests,
+            w_bytes=w_bytes,
+            w_requests=w_requests,
+            per_disk_requests=per_device_requests,
+        )
 
     @abc.abstractmethod
     def _get_samples(instance, c_data):
         """Return one or more Sample."""
 
     def get_samples(self, manager, cache, resources):
+        util.prefetch(manager.inspector, cache, self.CACHE_KEY_DISK,
+                      resources,
+                      lambda instance: self._inspect_disks(
+                          manager.inspector, cache, instance,
+                          util.instance_name(instance), resources))
         for instance in resources:
             instance_name = util.instance_name(instance)
             try:
@@ -114,6 +130,7 @@ class _Base(plugin.ComputePollster):
                     cache,
                     instance,
                     instance_name,
+                    resources,
                 )
                 for s in self._get_samples(instance, c_data):
                     yield s
@@ -325,6 +342,9 @@ class _DiskRatesPollsterBase(plugin.ComputePollster):
             except virt_inspector.InstanceNotFoundException as err:
                 # Instance was deleted while getting samples. Ignore it.
                 LOG.debug(_('Exception while getting samples %s'), err)
+            except virt_inspector.NoDataException as err:
+                # First reading of the counters, the rate comes next time.
+                LOG.debug(_('Exception while getting samples %s'), err)
             except ceilometer.NotImplementedError:
                 # Selected inspector does not implement this pollster.
                 LOG.debug(_('%(inspector)s does not provide data for '
@@ -470,23 +490,23 @@ class DiskUsagePollster(plugin.ComputePollster):
     def get_samples(self, manager, cache, resources):
         for instance in resources:
             LOG.debug(_('Checking disk usage for instance %s'), instance.id)
+            instance_name = util.instance_name(instance)
             try:
-                instance_name = util.instance_name(instance)
-                disk_usage_list = manager.oga_inspector.inspect_disk_usage(
-                        instance_name)
-
-                if disk_usage_list is None:
+                guest_info = util.get_guest_info(manager.oga_inspector,
+                                                 cache, instance)
+                if guest_info is None or guest_info.disk_usage is None:
                     continue
 
-                for disk_usage in disk_usage_list:
-                    yield (util.make_sample_from_instance(
+                for disk_usage in guest_info.disk_usage:
+                    yield util.make_sample_from_instance(
                         instance,
                         name='disk.usage',
                         type=sample.TYPE_GAUGE,
                         unit='%',
                         volume=disk_usage.usage,
-                        resource_id="%s-%s" % (instance.id, disk_usage.mount_point),
-                    ))
+                        resource_id="%s-%s" % (instance.id,
+                                               disk_usage.mount_point),
+                    )
 
             except virt_inspector.InstanceNotFoundException as err:
                 # Instance was deleted while getting samples. Ignore it.
@@ -495,7 +515,8 @@ class DiskUsagePollster(plugin.ComputePollster):
                 # Selected inspector does not implement this pollster.
                 LOG.debug(_('%(inspector)s does not provide data for '
                             ' %(pollster)s'),
-                          {'inspector': manager.inspector.__class__.__name__,
+                          {'inspector':
+                           manager.oga_inspector.__class__.__name__,
                            'pollster': self.__class__.__name__})
             except Exception as err:
                 LOG.exception(_('Ignoring instance %(name)s: %(error)s'),
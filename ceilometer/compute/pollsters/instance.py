@@ -58,9 +58,9 @@ class InstanceSystemInfoPollster(plugin.ComputePollster):
     @staticmethod
     def get_samples(manager, cache, resources):
         for instance in resources:
-
-            instance_name = util.instance_name(instance)
-            sys_info = manager.oga_inspector.inspect_sys(instance_name)
+            guest_info = util.get_guest_info(manager.oga_inspector,
+                                             cache, instance)
+            sys_info = dict(guest_info.sys_info) if guest_info else None
 
             yield util.make_sample_from_instance(
                 instance,
@@ -70,4 +70,4 @@ class InstanceSystemInfoPollster(plugin.ComputePollster):
                 volume=1,
                 additional_metadata=sys_info,
                 resource_id="%s-%s" % (instance.id, 'sys-info'),
-            )
\ No newline at end of file
+            )
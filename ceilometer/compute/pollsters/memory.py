@@ -12,6 +12,10 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+import abc
+
+import six
+
 import ceilometer
 from ceilometer.compute import plugin
 from ceilometer.compute.pollsters import util
@@ -55,197 +59,87 @@ class MemoryUsagePollster(plugin.ComputePollster):
                                                    'e': err})
 
 
-class MemoryTotalPollster(plugin.ComputePollster):
-
-    def get_samples(self, manager, cache, resources):
-        for instance in resources:
-            LOG.debug(_('Checking memory total and system info for instance %s'), instance.id)
-            try:
-                instance_name = util.instance_name(instance)
-                memory_total_kb = int(manager.oga_inspector.inspect_mem_total(
-                    instance_name))
-                LOG.debug(_("MEMORY TOTAL: %(instance)s %(total)f"),
-                          ({'instance': instance.__dict__,
-                            'total': memory_total_kb}))
-
-                if memory_total_kb == -1:
-                    # Note(luogangyi): we do not report empty info
-                    continue
-                memory_total = memory_total_kb/1024
-
-                yield util.make_sample_from_instance(
-                    instance,
-                    name='memory.total',
-                    type=sample.TYPE_GAUGE,
-                    unit='MB',
-                    volume=memory_total,
-                )
-            except virt_inspector.InstanceNotFoundException as err:
-                # Instance was deleted while getting samples. Ignore it.
-                LOG.debug(_('Exception while getting samples %s'), err)
-            except ceilometer.NotImplementedError:
-                # Selected inspector does not implement this pollster.
-                LOG.debug(_('Obtaining Memory Total is not implemented for %s'
-                            ), manager.inspector.__class__.__name__)
-            except Exception as err:
-                LOG.exception(_('Could not get Memory Total for '
-                                '%(id)s: %(e)s'), {'id': instance.id,
-                                                   'e': err})
-
+@six.add_metaclass(abc.ABCMeta)
+class _GuestMemoryBase(plugin.ComputePollster):
 
-class MemoryUnusedPollster(plugin.ComputePollster):
+    @abc.abstractmethod
+    def _get_samples(instance, guest_info):
+        """Return one or more Sample."""
 
     def get_samples(self, manager, cache, resources):
         for instance in resources:
-            LOG.debug(_('Checking memory unused for instance %s'), instance.id)
+            LOG.debug(_('Checking guest memory for instance %s'), instance.id)
             try:
-                instance_name = util.instance_name(instance)
-                memory_unused_kb = int(manager.oga_inspector.inspect_mem_unused(
-                    instance_name))
-                LOG.debug(_("MEMORY UNUSED: %(instance)s %(unused)f"),
-                          ({'instance': instance.__dict__,
-                            'unused': memory_unused_kb}))
-
-                if memory_unused_kb == -1:
-                    # Note(luogangyi): we do not report empty info
+                guest_info = util.get_guest_info(manager.oga_inspector,
+                                                 cache, instance)
+                if guest_info is None:
                     continue
-                memory_unused = memory_unused_kb/1024
-
-                yield util.make_sample_from_instance(
-                    instance,
-                    name='memory.unused',
-                    type=sample.TYPE_GAUGE,
-                    unit='MB',
-                    volume=memory_unused,
-                )
+                for s in self._get_samples(instance, guest_info):
+                    yield s
             except virt_inspector.InstanceNotFoundException as err:
                 # Instance was deleted while getting samples. Ignore it.
                 LOG.debug(_('Exception while getting samples %s'), err)
             except ceilometer.NotImplementedError:
                 # Selected inspector does not implement this pollster.
-                LOG.debug(_('Obtaining Memory Unused is not implemented for %s'
-                            ), manager.inspector.__class__.__name__)
+                LOG.debug(_('%(inspector)s does not provide data for '
+                            ' %(pollster)s'),
+                          {'inspector':
+                           manager.oga_inspector.__class__.__name__,
+                           'pollster': self.__class__.__name__})
             except Exception as err:
-                LOG.exception(_('Could not get Memory Unused for '
+                LOG.exception(_('Could not get guest memory for '
                                 '%(id)s: %(e)s'), {'id': instance.id,
                                                    'e': err})
 
 
-class MemorySwapPollster(plugin.ComputePollster):
+def _make_memory_samples(instance, name, memory_kb):
+    if memory_kb is None:
+        # Note(luogangyi): we do not report empty info
+        return []
+    return [util.make_sample_from_instance(
+        instance,
+        name=name,
+        type=sample.TYPE_GAUGE,
+        unit='MB',
+        volume=memory_kb / 1024,
+    )]
 
-    def get_samples(self, manager, cache, resources):
-        for instance in resources:
-            LOG.debug(_('Checking memory swap for instance %s'), instance.id)
-            try:
-                instance_name = util.instance_name(instance)
-                memory_swap_kb = int(manager.oga_inspector.inspect_mem_swap(
-                    instance_name))
-                LOG.debug(_("MEMORY SWAP: %(instance)s %(swap)f"),
-                          ({'instance': instance.__dict__,
-                            'swap': memory_swap_kb}))
 
-                if memory_swap_kb == -1:
-                    # Note(luogangyi): we do not report empty info
-                    continue
-                memory_swap = memory_swap_kb/1024
+class MemoryTotalPollster(_GuestMemoryBase):
 
-                yield util.make_sample_from_instance(
-                    instance,
-                    name='memory.swap',
-                    type=sample.TYPE_GAUGE,
-                    unit='MB',
-                    volume=memory_swap,
-                )
-            except virt_inspector.InstanceNotFoundException as err:
-                # Instance was deleted while getting samples. Ignore it.
-                LOG.debug(_('Exception while getting samples %s'), err)
-            except ceilometer.NotImplementedError:
-                # Selected inspector does not implement this pollster.
-                LOG.debug(_('Obtaining Memory Swap is not implemented for %s'
-                            ), manager.inspector.__class__.__name__)
-            except Exception as err:
-                LOG.exception(_('Could not get Memory Swap for '
-                                '%(id)s: %(e)s'), {'id': instance.id,
-                                                   'e': err})
+    @staticmethod
+    def _get_samples(instance, guest_info):
+        return _make_memory_samples(instance, 'memory.total',
+                                    guest_info.mem_total)
 
 
-class MemoryBufferPollster(plugin.ComputePollster):
+class MemoryUnusedPollster(_GuestMemoryBase):
 
-    def get_samples(self, manager, cache, resources):
-        for instance in resources:
-            LOG.debug(_('Checking memory buffer for instance %s'), instance.id)
-            try:
-                instance_name = util.instance_name(instance)
-                memory_buffer_kb = int(manager.oga_inspector.inspect_mem_buffer(
-                    instance_name))
-                LOG.debug(_("MEMORY Buffer: %(instance)s %(buffer)f"),
-                          ({'instance': instance.__dict__,
-                            'buffer': memory_buffer_kb}))
+    @staticmethod
+    def _get_samples(instance, guest_info):
+        return _make_memory_samples(instance, 'memory.unused',
+                                    guest_info.mem_unused)
 
-                if memory_buffer_kb == -1:
-                    # Note(luogangyi): we do not report empty info
-                    continue
 
-                memory_buffer = memory_buffer_kb/1024
+class MemorySwapPollster(_GuestMemoryBase):
 
-                yield util.make_sample_from_instance(
-                    instance,
-                    name='memory.buffer',
-                    type=sample.TYPE_GAUGE,
-                    unit='MB',
-                    volume=memory_buffer,
-                )
-            except virt_inspector.InstanceNotFoundException as err:
-                # Instance was deleted while getting samples. Ignore it.
-                LOG.debug(_('Exception while getting samples %s'), err)
-            except ceilometer.NotImplementedError:
-                # Selected inspector does not implement this pollster.
-                LOG.debug(_('Obtaining Memory Buffer is not implemented for %s'
-                            ), manager.inspector.__class__.__name__)
-            except Exception as err:
-                LOG.exception(_('Could not get Memory Buffer for '
-                                '%(id)s: %(e)s'), {'id': instance.id,
-                                                   'e': err})
+    @staticmethod
+    def _get_samples(instance, guest_info):
+        return _make_memory_samples(instance, 'memory.swap',
+                                    guest_info.mem_swap)
 
 
-class MemoryCachedPollster(plugin.ComputePollster):
-
-    def get_samples(self, manager, cache, resources):
-        for instance in resources:
-            LOG.debug(_('Checking memory cached for instance %s'), instance.id)
-            try:
-                instance_name = util.instance_name(instance)
-                memory_cached_kb = int(manager.oga_inspector.inspect_mem_cached(
-                    instance_name))
-                LOG.debug(_("MEMORY CACHED: %(instance)s %(cached)f"),
-                          ({'instance': instance.__dict__,
-                            'cached': memory_cached_kb}))
-
-                if memory_cached_kb == -1:
-                    # Note(luogangyi): we do not report empty info
-                    continue
-                memory_cached = memory_cached_kb/1024
-
-                yield util.make_sample_from_instance(
-                    instance,
-                    name='memory.cached',
-                    type=sample.TYPE_GAUGE,
-                    unit='MB',
-                    volume=memory_cached,
-                )
-            except virt_inspector.InstanceNotFoundException as err:
-                # Instance was deleted while getting samples. Ignore it.
-                LOG.debug(_('Exception while getting samples %s'), err)
-            except ceilometer.NotImplementedError:
-                # Selected inspector does not implement this pollster.
-                LOG.debug(_('Obtaining Memory Cached is not implemented for %s'
-                            ), manager.inspector.__class__.__name__)
-            except Exception as err:
-                LOG.exception(_('Could not get Memory Cached for '
-                                '%(id)s: %(e)s'), {'id': instance.id,
-                                                   'e': err})
-
+class MemoryBufferPollster(_GuestMemoryBase):
 
+    @staticmethod
+    def _get_samples(instance, guest_info):
+        return _make_memory_samples(instance, 'memory.buffer',
+                                    guest_info.mem_buffer)
 
 
+class MemoryCachedPollster(_GuestMemoryBase):
 
+    @staticmethod
+    def _get_samples(instance, guest_info):
+        return _make_memory_samples(instance, 'memory.cached',
+                                    guest_info.mem_cached)
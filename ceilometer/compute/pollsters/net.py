@@ -69,7 +69,11 @@ class _Base(plugin.ComputePollster):
 
     CACHE_KEY_VNIC = 'vnics'
 
-    def _get_vnic_info(self, inspector, instance):
+    def _get_vnic_info(self, inspector, instance, cache, resources):
+        stats = util.get_instance_stats(inspector, cache, instance,
+                                        resources)
+        if stats is not None:
+            return stats.vnics
         instance_name = util.instance_name(instance)
         return inspector.inspect_vnics(instance_name)
 
@@ -81,17 +85,22 @@ class _Base(plugin.ComputePollster):
     def _get_tx_info(info):
         return info.tx_bytes
 
-    def _get_vnics_for_instance(self, cache, inspector, instance):
+    def _get_vnics_for_instance(self, cache, inspector, instance,
+                                resources=()):
         instance_name = util.instance_name(instance)
-        i_cache = cache.setdefault(self.CACHE_KEY_VNIC, {})
-        if instance_name not in i_cache:
-            i_cache[instance_name] = list(
-                self._get_vnic_info(inspector, instance)
-            )
-        return i_cache[instance_name]
+        return util.cached_result(util.get_cached(
+            cache, self.CACHE_KEY_VNIC, instance_name,
+            lambda: list(self._get_vnic_info(inspector, instance, cache,
+                                             resources))))
+
+    def _prefetch(self, inspector, cache, resources):
+        util.prefetch(inspector, cache, self.CACHE_KEY_VNIC, resources,
+                      lambda instance: list(self._get_vnic_info(
+                          inspector, instance, cache, resources)))
 
     def get_samples(self, manager, cache, resources):
         self._inspection_duration = self._record_poll_time()
+        self._prefetch(manager.inspector, cache, resources)
         for instance in resources:
             instance_name = util.instance_name(instance)
             LOG.debug(_('checking net info for instance %s'), instance.id)
@@ -100,6 +109,7 @@ class _Base(plugin.ComputePollster):
                     cache,
                     manager.inspector,
                     instance,
+                    resources,
                 )
                 for vnic, info in vnics:
                     LOG.debug(self.NET_USAGE_MESSAGE, instance_name,
@@ -109,6 +119,9 @@ class _Base(plugin.ComputePollster):
             except virt_inspector.InstanceNotFoundException as err:
                 # Instance was deleted while getting samples. Ignore it.
                 LOG.debug(_('Exception while getting samples %s'), err)
+            except virt_inspector.NoDataException as err:
+                # First reading of the counters, the rate comes next time.
+                LOG.debug(_('Exception while getting samples %s'), err)
             except ceilometer.NotImplementedError:
                 # Selected inspector does not implement this pollster.
                 LOG.debug(_('%(inspector)s does not provide data for '
@@ -128,10 +141,15 @@ class _RateBase(_Base):
 
     CACHE_KEY_VNIC = 'vnic-rates'
 
-    def _get_vnic_info(self, inspector, instance):
+    def _get_vnic_info(self, inspector, instance, cache, resources):
         return inspector.inspect_vnic_rates(instance,
                                             self._inspection_duration)
 
+    def _prefetch(self, inspector, cache, resources):
+        # The bulk statistics do not tell whether the inspector can tell
+        # the rates, and the libvirt one reads them all at once anyway.
+        pass
+
     @staticmethod
     def _get_rx_info(info):
         return info.rx_bytes_rate
@@ -16,10 +16,35 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import weakref
+
+import eventlet
+from oslo.config import cfg
 from oslo.utils import timeutils
 
+import ceilometer
 from ceilometer.compute import util as compute_util
+from ceilometer.compute.virt import inspector as virt_inspector
+from ceilometer.openstack.common.gettextutils import _
+from ceilometer.openstack.common import log
 from ceilometer import sample
+from ceilometer import utils
+
+OPTS = [
+    cfg.IntOpt('inspection_workers',
+               default=1,
+               help='Number of instances inspected concurrently by the '
+                    'compute pollsters. With more than one, the libvirt '
+                    'calls run in native threads.'),
+    cfg.FloatOpt('inspection_timeout',
+                 default=30.0,
+                 help='Number of seconds after which the concurrent '
+                      'inspection of an instance is abandoned.'),
+]
+
+cfg.CONF.register_opts(OPTS, group='compute')
+
+LOG = log.getLogger(__name__)
 
 
 INSTANCE_PROPERTIES = [
@@ -75,11 +100,53 @@ def _get_metadata_from_object(instance):
     return compute_util.add_reserved_user_metadata(instance.metadata, metadata)
 
 
+# Metadata of the instances, dropped with the instance objects. The
+# discovered instances are kept for up to instance_discovery_ttl seconds,
+# so the metadata is only built again when the attributes it depends on
+# change, as told by _metadata_key().
+_METADATA = weakref.WeakKeyDictionary()
+
+
+def _metadata_key(instance):
+    flavor = instance.flavor or {}
+    image = instance.image or {}
+    return (instance.status, flavor.get('id'), flavor.get('name'),
+            image.get('id'))
+
+
+def get_metadata(instance):
+    """Return the metadata dictionary of an instance, built once.
+
+    The dictionary is shared by all the samples of the instance and must
+    not be modified.
+    """
+    key = _metadata_key(instance)
+    try:
+        cached_key, metadata = _METADATA[instance]
+        if cached_key == key:
+            return metadata
+    except KeyError:
+        pass
+    except TypeError:
+        # Not weakly referenceable.
+        return _get_metadata_from_object(instance)
+    metadata = _get_metadata_from_object(instance)
+    _METADATA[instance] = (key, metadata)
+    return metadata
+
+
+def _with_metadata(metadata, additional_metadata):
+    if not additional_metadata:
+        return metadata
+    metadata = metadata.copy()
+    metadata.update(additional_metadata)
+    return metadata
+
+
 def make_sample_from_instance(instance, name, type, unit, volume,
                               resource_id=None, additional_metadata=None):
-    additional_metadata = additional_metadata or {}
-    resource_metadata = _get_metadata_from_object(instance)
-    resource_metadata.update(additional_metadata)
+    resource_metadata = _with_metadata(get_metadata(instance),
+                                       additional_metadata)
     return sample.Sample(
         name=name,
         type=type,
@@ -93,6 +160,139 @@ def make_sample_from_instance(instance, name, type, unit, volume,
     )
 
 
-def instance_name(instance):
-    """Shortcut to get instance name."""
-    return getattr(instance, 'OS-EXT-SRV-ATTR:instance_name', None)
+instance_name = virt_inspector.instance_name
+
+
+CACHE_KEY_GUEST = 'guest-info'
+
+
+def get_guest_info(oga_inspector, cache, instance):
+    """Return the guest agent snapshot of an instance.
+
+    The snapshot is kept in the per-cycle cache, so every guest agent
+    backed pollster reads the agent report of an instance only once.
+    """
+    name = instance_name(instance)
+    g_cache = cache.setdefault(CACHE_KEY_GUEST, {})
+    if name not in g_cache:
+        g_cache[name] = oga_inspector.inspect_guest(name)
+    return g_cache[name]
+
+
+CACHE_KEY_STATS = 'instance-stats'
+
+
+def get_instance_stats(inspector, cache, instance, resources):
+    """Return the bulk hypervisor statistics of an instance.
+
+    The statistics of every polled instance are collected by a single
+    inspect_all() call the first time any of them is asked for, and kept
+    in the per-cycle cache for all the pollsters.
+
+    :return: the InstanceStats of the instance, or None if it has to be
+             inspected on its own
+    """
+    name = instance_name(instance)
+    s_cache = cache.setdefault(CACHE_KEY_STATS, {})
+
+    def fetch():
+        names = set(instance_name(r) for r in resources)
+        names.add(name)
+        names.difference_update(s_cache)
+        try:
+            stats = inspector.inspect_all(list(names))
+        except ceilometer.NotImplementedError:
+            stats = {}
+        except Exception as err:
+            LOG.warning(_('Unable to inspect instances in bulk, inspecting '
+                          'them one by one: %s') % err)
+            stats = {}
+        for n in names:
+            s_cache[n] = stats.get(n)
+
+    # A concurrent pollster may be fetching statistics which do not
+    # include this instance.
+    while name not in s_cache:
+        utils.single_flight(cache, CACHE_KEY_STATS, fetch)
+    return s_cache[name]
+
+
+def get_cached(cache, key, name, compute):
+    """Return cache[key][name], computing it if missing.
+
+    Concurrent pollsters asking for the same missing entry wait for the
+    first one to compute it.
+    """
+    i_cache = cache.setdefault(key, {})
+    while name not in i_cache:
+        utils.single_flight(cache, (key, name),
+                            lambda: i_cache.__setitem__(name, compute()))
+    return i_cache[name]
+
+
+class _Failure(object):
+    """An exception raised while prefetching, to be raised when read."""
+
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
+
+def cached_result(value):
+    """Return a result stored by prefetch(), or raise its exception."""
+    if isinstance(value, _Failure):
+        raise value.error
+    return value
+
+
+def prefetch(inspector, cache, key, resources, inspect):
+    """Inspect the instances concurrently, ahead of the pollster loop.
+
+    When inspection_workers is more than one, inspect(instance) is called
+    for each instance missing from cache[key] and whose bulk statistics
+    are not available, by a bounded pool of green threads. Each result, or
+    the exception raised, is stored in cache[key] under the instance name
+    for cached_result(). An instance taking more than inspection_timeout
+    seconds gets an InspectorException.
+    """
+    workers = cfg.CONF.compute.inspection_workers
+    if workers <= 1:
+        return
+    i_cache = cache.setdefault(key, {})
+    instances = [instance for instance in resources
+                 if instance_name(instance) not in i_cache and
+                 get_instance_stats(inspector, cache, instance,
+                                    resources) is None]
+    # Even a single instance left out of the bulk statistics is inspected
+    # by the pool, for the timeout.
+    if not instances:
+        return
+    timeout = cfg.CONF.compute.inspection_timeout
+
+    def run(instance):
+        name = instance_name(instance)
+        timer = eventlet.Timeout(timeout)
+        try:
+            i_cache[name] = inspect(instance)
+        except eventlet.Timeout as t:
+            if t is not timer:
+                raise
+            LOG.warning(_('Inspection of %(name)s took more than %(timeout)s '
+                          'seconds, skipping it'),
+                        {'name': name, 'timeout': timeout})
+            i_cache[name] = _Failure(virt_inspector.InspectorException(
+                _('Inspection of %s timed out') % name))
+        except Exception as err:
+            i_cache[name] = _Failure(err)
+        finally:
+            timer.cancel()
+
+    def run_all():
+        pool = eventlet.GreenPool(workers)
+        for instance in instances:
+            pool.spawn_n(run, instance)
+        pool.waitall()
+
+    # Pollsters sharing the cache key prefetch the same instances.
+    utils.single_flight(cache, ('prefetch', key), run_all)
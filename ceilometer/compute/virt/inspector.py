@@ -132,6 +132,17 @@ DiskRateStats = collections.namedtuple('DiskRateStats',
                                         'write_requests_rate'])
 
 
+# Named tuple representing the statistics of an instance collected at once.
+#
+# cpu: CPUStats, or None if not available
+# vnics: list of (Interface, InterfaceStats) pairs
+# disks: list of (Disk, DiskStats) pairs
+# balloon: current memory balloon size in kB, or None if not available
+#
+InstanceStats = collections.namedtuple('InstanceStats',
+                                       ['cpu', 'vnics', 'disks', 'balloon'])
+
+
 # Exception types
 #
 class InspectorException(Exception):
@@ -143,6 +154,10 @@ class InstanceNotFoundException(InspectorException):
     pass
 
 
+class NoDataException(InspectorException):
+    pass
+
+
 # Main virt inspector abstraction layering over the hypervisor API.
 #
 class Inspector(object):
@@ -151,6 +166,15 @@ class Inspector(object):
         """List the instances on the current host."""
         raise ceilometer.NotImplementedError
 
+    def inspect_instances_metadata(self, namespace):
+        """List the running instances on the current host with metadata.
+
+        :param namespace: the XML namespace of the metadata
+        :return: (Instance, metadata) pairs, the metadata being the XML
+                 element of the namespace set on the instance, or None
+        """
+        raise ceilometer.NotImplementedError
+
     def inspect_cpus(self, instance_name):
         """Inspect the CPU statistics for an instance.
 
@@ -208,6 +232,16 @@ class Inspector(object):
         """
         raise ceilometer.NotImplementedError
 
+    def inspect_all(self, instance_names):
+        """Inspect the statistics of several instances at once.
+
+        :param instance_names: the names of the target instances
+        :return: a dict of InstanceStats keyed by instance name, the
+                 instances which were not found or whose statistics are
+                 not available in bulk are left out
+        """
+        raise ceilometer.NotImplementedError
+
     def inspect_disk_rates(self, instance, duration=None):
         """Inspect the disk statistics as rates for an instance.
 
@@ -219,6 +253,22 @@ class Inspector(object):
         """
         raise ceilometer.NotImplementedError
 
+    def watch_instances(self, callback):
+        """Call back whenever an instance of the host changes state.
+
+        The callback, taking no argument, may be called from another
+        thread when an instance is defined, started, stopped or undefined.
+
+        :param callback: the function to call
+        :return: whether the changes are reported
+        """
+        return False
+
+
+def instance_name(instance):
+    """Shortcut to get instance name."""
+    return getattr(instance, 'OS-EXT-SRV-ATTR:instance_name', None)
+
 
 def get_hypervisor_inspector():
     try:
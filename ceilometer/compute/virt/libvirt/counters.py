@@ -0,0 +1,100 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Rates of change of cumulative hypervisor counters."""
+
+import array
+
+
+class CounterRing(object):
+    """The last readings of a fixed set of cumulative counters.
+
+    The readings are kept in a single flat array of doubles, each one as
+    its timestamp followed by the counter values, the newest reading
+    overwriting the oldest one once the ring is full. The rates are
+    computed between the oldest and the newest readings.
+
+    :param width: number of counters of a reading
+    :param depth: number of readings kept
+    """
+
+    __slots__ = ('width', 'depth', '_data', '_next', '_count')
+
+    def __init__(self, width, depth=2):
+        if depth < 2:
+            raise ValueError('A rate needs at least two readings')
+        self.width = width
+        self.depth = depth
+        self._data = array.array('d', [0.0]) * (depth * (width + 1))
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _offset(self, age):
+        """Return the offset of a reading, the newest one being of age 0."""
+        return ((self._next - 1 - age) % self.depth) * (self.width + 1)
+
+    @property
+    def timestamp(self):
+        """Timestamp of the newest reading, or None if there is none."""
+        if not self._count:
+            return None
+        return self._data[self._offset(0)]
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
+
+    def add(self, timestamp, values, min_interval=0):
+        """Add a reading of the counters.
+
+        A reading taken less than min_interval seconds after the newest
+        one replaces it, so close readings do not make for noisy rates.
+        Counters going backwards, as when a domain is restarted, drop the
+        previous readings.
+        """
+        if len(values) != self.width:
+            raise ValueError('Expected %d counters, got %d'
+                             % (self.width, len(values)))
+        data = self._data
+        if self._count:
+            newest = self._offset(0)
+            if any(value < data[newest + 1 + i]
+                   for i, value in enumerate(values)):
+                self.clear()
+            elif timestamp - data[newest] < min_interval:
+                data[newest:newest + self.width + 1] = array.array(
+                    'd', [timestamp] + list(values))
+                return
+        offset = self._next * (self.width + 1)
+        data[offset:offset + self.width + 1] = array.array(
+            'd', [timestamp] + list(values))
+        self._next = (self._next + 1) % self.depth
+        self._count = min(self._count + 1, self.depth)
+
+    def rates(self):
+        """Return the per second rate of each counter.
+
+        :return: a list of rates, or None until two readings were added
+        """
+        if self._count < 2:
+            return None
+        data = self._data
+        newest = self._offset(0)
+        oldest = self._offset(self._count - 1)
+        elapsed = data[newest] - data[oldest]
+        if elapsed <= 0:
+            return None
+        return [(data[newest + i] - data[oldest + i]) / elapsed
+                for i in range(1, self.width + 1)]
@@ -16,11 +16,23 @@
 # under the License.
 """Implementation of Inspector abstraction for libvirt."""
 
+import collections
+import errno
+import fcntl
+import os
+import time
+
+import eventlet
+from eventlet import hubs
+from eventlet import patcher
+from eventlet import tpool
 from lxml import etree
 from oslo.config import cfg
 import six
 
+import ceilometer
 from ceilometer.compute.virt import inspector as virt_inspector
+from ceilometer.compute.virt.libvirt import counters
 from ceilometer.openstack.common.gettextutils import _
 from ceilometer.openstack.common import log as logging
 
@@ -37,11 +49,80 @@ libvirt_opts = [
                default='',
                help='Override the default libvirt URI '
                     '(which is dependent on libvirt_type).'),
+    cfg.BoolOpt('libvirt_events',
+                default=False,
+                help='Subscribe to the libvirt domain lifecycle and device '
+                     'events to refresh the cached device list of an '
+                     'instance as soon as it changes.'),
+    cfg.BoolOpt('libvirt_local_rates',
+                default=False,
+                help='Compute cpu_util and the vNIC and disk rates from the '
+                     'previous counter readings kept by the libvirt '
+                     'inspector. The rate_of_change transformers producing '
+                     'those meters should then be removed from the '
+                     'pipelines.'),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(libvirt_opts)
 
+# Flags of virConnectGetAllDomainStats, defined here since the bindings of
+# libvirt releases older than 1.2.8 lack them.
+VIR_DOMAIN_STATS_STATE = 1
+VIR_DOMAIN_STATS_CPU_TOTAL = 2
+VIR_DOMAIN_STATS_BALLOON = 4
+VIR_DOMAIN_STATS_VCPU = 8
+VIR_DOMAIN_STATS_INTERFACE = 16
+VIR_DOMAIN_STATS_BLOCK = 32
+VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE = 1
+
+_ALL_DOMAIN_STATS = (VIR_DOMAIN_STATS_STATE | VIR_DOMAIN_STATS_CPU_TOTAL |
+                     VIR_DOMAIN_STATS_BALLOON | VIR_DOMAIN_STATS_VCPU |
+                     VIR_DOMAIN_STATS_INTERFACE | VIR_DOMAIN_STATS_BLOCK)
+
+# Domain event IDs, defined here since older bindings lack the device ones.
+VIR_DOMAIN_EVENT_ID_LIFECYCLE = 0
+VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED = 15
+VIR_DOMAIN_EVENT_ID_DEVICE_ADDED = 19
+
+VIR_DOMAIN_METADATA_ELEMENT = 2
+
+# Number of seconds after which a cached device topology is parsed again
+# when no domain event tells about its changes.
+TOPOLOGY_MAX_AGE = 600
+
+# Minimum number of seconds between two readings of the counters used for
+# rates, a closer reading replaces the previous one.
+MIN_READING_INTERVAL = 1.0
+
+# Number of seconds after which the counter readings of a domain which is
+# no longer polled are dropped.
+READINGS_MAX_AGE = 1200
+
+native_threading = patcher.original('threading')
+
+# The vNICs and disks of a domain, as parsed from its XML description.
+#
+# domain_id: ID of the domain when parsed, changing when it is restarted
+# interfaces: tuple of Interface
+# disks: tuple of Disk
+# timestamp: when the XML description was parsed
+#
+_DomainTopology = collections.namedtuple('_DomainTopology',
+                                         ['domain_id', 'interfaces',
+                                          'disks', 'timestamp'])
+
+
+class _DomainReadings(object):
+    """The latest statistics of a domain and its counter rings."""
+
+    __slots__ = ('stats', 'timestamp', 'rings')
+
+    def __init__(self):
+        self.stats = None
+        self.timestamp = None
+        self.rings = {}
+
 
 def retry_on_disconnect(function):
     def decorator(self, *args, **kwargs):
@@ -63,9 +144,19 @@ class LibvirtInspector(virt_inspector.Inspector):
 
     per_type_uris = dict(uml='uml:///system', xen='xen:///', lxc='lxc:///')
 
+    _event_loop = None
+
     def __init__(self):
         self.uri = self._get_uri()
         self.connection = None
+        self._topology = {}
+        self._events = False
+        self._readings = {}
+        self._watchers = []
+        # The events handed over by the event loop thread, as (handler,
+        # domain name), and the pipe waking their dispatching up.
+        self._pending_events = collections.deque()
+        self._event_pipe = None
 
     def _get_uri(self):
         return CONF.libvirt_uri or self.per_type_uris.get(CONF.libvirt_type,
@@ -76,11 +167,169 @@ class LibvirtInspector(virt_inspector.Inspector):
             global libvirt
             if libvirt is None:
                 libvirt = __import__('libvirt')
+            if CONF.libvirt_events:
+                self._start_event_loop()
             LOG.debug('Connecting to libvirt: %s', self.uri)
             self.connection = libvirt.openReadOnly(self.uri)
+            if CONF.compute.inspection_workers > 1:
+                # Instances are inspected concurrently, the blocking calls
+                # of the connection and its domains then run in native
+                # threads.
+                self.connection = tpool.Proxy(self.connection,
+                                              autowrap=(libvirt.virDomain,))
+            self._events = (CONF.libvirt_events and
+                            self._register_events(self.connection))
+            # Events may have been missed while disconnected.
+            self._topology.clear()
 
         return self.connection
 
+    @classmethod
+    def _start_event_loop(cls):
+        """Run the libvirt event loop in a native thread.
+
+        The default implementation has to be registered before opening
+        the connections whose events are wanted, and blocks in poll(), so
+        it cannot run in a green thread.
+        """
+        if cls._event_loop is not None:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+
+        def run():
+            while True:
+                libvirt.virEventRunDefaultImpl()
+
+        cls._event_loop = native_threading.Thread(target=run,
+                                                  name='libvirt-events')
+        cls._event_loop.daemon = True
+        cls._event_loop.start()
+
+    def _register_events(self, conn):
+        """Drop the cached topology of the domains whose devices change.
+
+        :return: whether the events are delivered
+        """
+        self._start_event_dispatch()
+        try:
+            for event_id in (VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                             VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED,
+                             VIR_DOMAIN_EVENT_ID_DEVICE_ADDED):
+                handler = (self._on_lifecycle_event
+                           if event_id == VIR_DOMAIN_EVENT_ID_LIFECYCLE
+                           else self._on_domain_event)
+                conn.domainEventRegisterAny(None, event_id,
+                                            self._queue_event, handler)
+        except libvirt.libvirtError as e:
+            # The device added event needs libvirt 1.2.15, the fingerprint
+            # check still catches those changes.
+            LOG.debug('Unable to register libvirt event %(event)s: %(error)s',
+                      {'event': event_id, 'error': e})
+            return event_id != VIR_DOMAIN_EVENT_ID_LIFECYCLE
+        return True
+
+    def _start_event_dispatch(self):
+        """Handle the events in a green thread.
+
+        The event loop thread is a native one, it must not switch to the
+        hub, as logging or notifying the watchers may. It only queues the
+        events and wakes the dispatching green thread up through a pipe.
+        """
+        if self._event_pipe is not None:
+            return
+        self._event_pipe = os.pipe()
+        for fd in self._event_pipe:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        eventlet.spawn_n(self._dispatch_events)
+
+    def _queue_event(self, conn, domain, *args):
+        # Called from the event loop thread, deque.append is atomic.
+        handler = args[-1]
+        self._pending_events.append((handler, domain.name()))
+        try:
+            os.write(self._event_pipe[1], b'x')
+        except OSError as e:
+            # A full pipe already guarantees a wakeup
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _dispatch_events(self):
+        read_fd = self._event_pipe[0]
+        while True:
+            hubs.trampoline(read_fd, read=True)
+            try:
+                while os.read(read_fd, 4096):
+                    pass
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+            while self._pending_events:
+                handler, name = self._pending_events.popleft()
+                try:
+                    handler(name)
+                except Exception:
+                    LOG.exception(_('Failed to handle an event of domain '
+                                    '%s'), name)
+
+    def _on_domain_event(self, name):
+        self._topology.pop(name, None)
+
+    def _on_lifecycle_event(self, name):
+        self._on_domain_event(name)
+        for callback in self._watchers:
+            try:
+                callback()
+            except Exception:
+                LOG.exception(_('Failed to notify an instance change'))
+
+    def watch_instances(self, callback):
+        # The events are registered along with the connection.
+        self._get_connection()
+        self._watchers.append(callback)
+        return self._events
+
+    def _get_topology(self, domain, vnic_names=None):
+        """Return the devices of a domain, parsing its XML only if needed.
+
+        The devices are cached until the domain is restarted, the vNICs
+        differ from the given vnic_names, an event is received for the
+        domain or, without events, the cached entry is older than
+        TOPOLOGY_MAX_AGE.
+        """
+        name = domain.name()
+        domain_id = domain.ID()
+        now = time.time()
+        topology = self._topology.get(name)
+        if (topology is not None and topology.domain_id == domain_id and
+                (vnic_names is None or vnic_names == frozenset(
+                    interface.name for interface in topology.interfaces)) and
+                (self._events or
+                 now - topology.timestamp < TOPOLOGY_MAX_AGE)):
+            return topology
+        if topology is None:
+            self._prune_topology(now)
+        tree = etree.fromstring(domain.XMLDesc(0))
+        topology = _DomainTopology(domain_id=domain_id,
+                                   interfaces=tuple(
+                                       self._parse_interfaces(tree)),
+                                   disks=tuple(self._parse_disks(tree)),
+                                   timestamp=now)
+        self._topology[name] = topology
+        return topology
+
+    def _prune_topology(self, now):
+        # Domains deleted without an event being received leave entries.
+        for name, topology in list(self._topology.items()):
+            if now - topology.timestamp >= 2 * TOPOLOGY_MAX_AGE:
+                self._topology.pop(name, None)
+
+    def _invalidate_topology(self, domain):
+        try:
+            self._topology.pop(domain.name(), None)
+        except libvirt.libvirtError:
+            pass
+
     @retry_on_disconnect
     def _lookup_by_name(self, instance_name):
         try:
@@ -117,20 +366,39 @@ class LibvirtInspector(virt_inspector.Inspector):
                         # Instance was deleted while listing... ignore it
                         pass
 
+    @retry_on_disconnect
+    def inspect_instances_metadata(self, namespace):
+        conn = self._get_connection()
+        for domain_id in conn.listDomainsID():
+            if domain_id == 0:
+                continue
+            try:
+                domain = conn.lookupByID(domain_id)
+                instance = virt_inspector.Instance(name=domain.name(),
+                                                   UUID=domain.UUIDString())
+            except libvirt.libvirtError:
+                continue
+            try:
+                metadata = etree.fromstring(domain.metadata(
+                    VIR_DOMAIN_METADATA_ELEMENT, namespace))
+            except libvirt.libvirtError:
+                # Not a domain with such metadata, or deleted meanwhile.
+                metadata = None
+            except etree.XMLSyntaxError as e:
+                LOG.warn(_('Ignoring the malformed metadata of domain '
+                           '%(name)s: %(error)s'),
+                         {'name': instance.name, 'error': e})
+                metadata = None
+            yield instance, metadata
+
     def inspect_cpus(self, instance_name):
         domain = self._lookup_by_name(instance_name)
         dom_info = domain.info()
         return virt_inspector.CPUStats(number=dom_info[3], time=dom_info[4])
 
-    def inspect_vnics(self, instance_name):
-        domain = self._lookup_by_name(instance_name)
-        state = domain.info()[0]
-        if state == libvirt.VIR_DOMAIN_SHUTOFF:
-            LOG.warn(_('Failed to inspect vnics of %(instance_name)s, '
-                       'domain is in state of SHUTOFF'),
-                     {'instance_name': instance_name})
-            return
-        tree = etree.fromstring(domain.XMLDesc(0))
+    @staticmethod
+    def _parse_interfaces(tree):
+        """Yield the Interface of each vNIC of a domain XML description."""
         for iface in tree.findall('devices/interface'):
             target = iface.find('target')
             if target is not None:
@@ -148,14 +416,49 @@ class LibvirtInspector(virt_inspector.Inspector):
 
             params = dict((p.get('name').lower(), p.get('value'))
                           for p in iface.findall('filterref/parameter'))
-            interface = virt_inspector.Interface(name=name, mac=mac_address,
-                                                 fref=fref, parameters=params)
-            dom_stats = domain.interfaceStats(name)
-            stats = virt_inspector.InterfaceStats(rx_bytes=dom_stats[0],
-                                                  rx_packets=dom_stats[1],
-                                                  tx_bytes=dom_stats[4],
-                                                  tx_packets=dom_stats[5])
-            yield (interface, stats)
+            yield virt_inspector.Interface(name=name, mac=mac_address,
+                                           fref=fref, parameters=params)
+
+    @staticmethod
+    def _parse_disks(tree):
+        """Return the Disk of each device of a domain XML description."""
+        return [virt_inspector.Disk(device=target.get('dev'))
+                for target in tree.findall('devices/disk/target')
+                if target.get('dev')]
+
+    @staticmethod
+    def _interface_stats(domain, interface):
+        dom_stats = domain.interfaceStats(interface.name)
+        return virt_inspector.InterfaceStats(rx_bytes=dom_stats[0],
+                                             rx_packets=dom_stats[1],
+                                             tx_bytes=dom_stats[4],
+                                             tx_packets=dom_stats[5])
+
+    @staticmethod
+    def _disk_stats(domain, disk):
+        block_stats = domain.blockStats(disk.device)
+        return virt_inspector.DiskStats(read_requests=block_stats[0],
+                                        read_bytes=block_stats[1],
+                                        write_requests=block_stats[2],
+                                        write_bytes=block_stats[3],
+                                        errors=block_stats[4])
+
+    def inspect_vnics(self, instance_name):
+        domain = self._lookup_by_name(instance_name)
+        state = domain.info()[0]
+        if state == libvirt.VIR_DOMAIN_SHUTOFF:
+            LOG.warn(_('Failed to inspect vnics of %(instance_name)s, '
+                       'domain is in state of SHUTOFF'),
+                     {'instance_name': instance_name})
+            return
+        topology = self._get_topology(domain)
+        try:
+            for interface in topology.interfaces:
+                yield (interface, self._interface_stats(domain, interface))
+        except libvirt.libvirtError:
+            # The device may have been unplugged meanwhile.
+            self._invalidate_topology(domain)
+            raise
 
     def inspect_disks(self, instance_name):
         domain = self._lookup_by_name(instance_name)
@@ -165,16 +468,241 @@ class LibvirtInspector(virt_inspector.Inspector):
                        'domain is in state of SHUTOFF'),
                      {'instance_name': instance_name})
             return
-        tree = etree.fromstring(domain.XMLDesc(0))
-        for device in filter(
-                bool,
-                [target.get("dev")
-                 for target in tree.findall('devices/disk/target')]):
-            disk = virt_inspector.Disk(device=device)
-            block_stats = domain.blockStats(device)
-            stats = virt_inspector.DiskStats(read_requests=block_stats[0],
-                                             read_bytes=block_stats[1],
-                                             write_requests=block_stats[2],
-                                             write_bytes=block_stats[3],
-                                             errors=block_stats[4])
-            yield (disk, stats)
+        topology = self._get_topology(domain)
+        try:
+            for disk in topology.disks:
+                yield (disk, self._disk_stats(domain, disk))
+        except libvirt.libvirtError:
+            # The device may have been unplugged meanwhile.
+            self._invalidate_topology(domain)
+            raise
+
+    @retry_on_disconnect
+    def _get_all_domain_stats(self):
+        """Return the bulk statistics of the active domains.
+
+        :return: a list of (domain, stats dict) or None if the libvirt
+                 bindings or daemon do not support bulk statistics
+        """
+        conn = self._get_connection()
+        if not hasattr(conn, 'getAllDomainStats'):
+            return None
+        try:
+            records = conn.getAllDomainStats(
+                _ALL_DOMAIN_STATS, VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() == libvirt.VIR_ERR_NO_SUPPORT:
+                return None
+            raise
+        if isinstance(conn, tpool.Proxy):
+            # The proxy only wraps the domains it returns directly, those
+            # of the records would block the hub when described.
+            records = [(tpool.Proxy(domain), stats)
+                       for domain, stats in records]
+        return records
+
+    def _make_instance_stats(self, domain, stats):
+        cpu = None
+        if 'cpu.time' in stats:
+            cpu = virt_inspector.CPUStats(number=stats.get('vcpu.current'),
+                                          time=stats['cpu.time'])
+        vnics = []
+        disks = []
+        if stats.get('state.state') != libvirt.VIR_DOMAIN_SHUTOFF:
+            vnic_stats = {}
+            for i in range(stats.get('net.count', 0)):
+                prefix = 'net.%d.' % i
+                vnic_stats[stats.get(prefix + 'name')] = (
+                    virt_inspector.InterfaceStats(
+                        rx_bytes=stats.get(prefix + 'rx.bytes', 0),
+                        rx_packets=stats.get(prefix + 'rx.pkts', 0),
+                        tx_bytes=stats.get(prefix + 'tx.bytes', 0),
+                        tx_packets=stats.get(prefix + 'tx.pkts', 0)))
+            if vnic_stats:
+                # MAC addresses and filters are only in the XML description,
+                # which only needs parsing again when the devices change.
+                topology = self._get_topology(domain, frozenset(vnic_stats))
+                vnics = [(interface, vnic_stats[interface.name])
+                         for interface in topology.interfaces
+                         if interface.name in vnic_stats]
+            for i in range(stats.get('block.count', 0)):
+                prefix = 'block.%d.' % i
+                disks.append((
+                    virt_inspector.Disk(device=stats.get(prefix + 'name')),
+                    virt_inspector.DiskStats(
+                        read_bytes=stats.get(prefix + 'rd.bytes', 0),
+                        read_requests=stats.get(prefix + 'rd.reqs', 0),
+                        write_bytes=stats.get(prefix + 'wr.bytes', 0),
+                        write_requests=stats.get(prefix + 'wr.reqs', 0),
+                        errors=stats.get(prefix + 'errors', -1))))
+        return virt_inspector.InstanceStats(
+            cpu=cpu, vnics=vnics, disks=disks,
+            balloon=stats.get('balloon.current'))
+
+    def _inspect_instance_stats(self, instance_name):
+        domain = self._lookup_by_name(instance_name)
+        dom_info = domain.info()
+        vnics = []
+        disks = []
+        if dom_info[0] != libvirt.VIR_DOMAIN_SHUTOFF:
+            topology = self._get_topology(domain)
+            try:
+                vnics = [(interface,
+                          self._interface_stats(domain, interface))
+                         for interface in topology.interfaces]
+                disks = [(disk, self._disk_stats(domain, disk))
+                         for disk in topology.disks]
+            except libvirt.libvirtError:
+                self._invalidate_topology(domain)
+                raise
+        return virt_inspector.InstanceStats(
+            cpu=virt_inspector.CPUStats(number=dom_info[3],
+                                        time=dom_info[4]),
+            vnics=vnics, disks=disks, balloon=dom_info[2])
+
+    def inspect_all(self, instance_names):
+        return self._inspect_all(set(instance_names))
+
+    def _inspect_all(self, names, all_active=False):
+        """Collect the statistics of the given or of all active domains.
+
+        The counters are also recorded for the rates, when enabled.
+        """
+        records = self._get_all_domain_stats()
+        now = time.time()
+        result = {}
+        active = None
+        if records is not None:
+            active = set()
+            for domain, stats in records:
+                try:
+                    name = domain.name()
+                    active.add(name)
+                    if all_active or name in names:
+                        result[name] = self._make_instance_stats(domain,
+                                                                 stats)
+                except libvirt.libvirtError as e:
+                    # Domain was undefined meanwhile... ignore it
+                    LOG.debug('Ignoring domain statistics: %s', e)
+            # Stopped or deleted domains get a new ID when started again.
+            for name in set(self._topology).difference(active):
+                self._topology.pop(name, None)
+        # Inactive domains are not reported in bulk, and older libvirt
+        # releases have no bulk statistics at all. The pollsters inspect
+        # the instances left out on their own, concurrently and with a
+        # timeout, only the readings of a single instance are completed
+        # here.
+        if all_active:
+            for name in names.difference(result):
+                try:
+                    result[name] = self._inspect_instance_stats(name)
+                except virt_inspector.InstanceNotFoundException as e:
+                    LOG.debug('Ignoring instance %(name)s: %(error)s',
+                              {'name': name, 'error': e})
+        if CONF.libvirt_local_rates:
+            for name, inst_stats in six.iteritems(result):
+                self._record_readings(name, inst_stats, now)
+            self._prune_readings(now, active)
+        return result
+
+    @staticmethod
+    def _add_reading(readings, key, now, values):
+        ring = readings.rings.get(key)
+        if ring is None:
+            ring = counters.CounterRing(len(values))
+        ring.add(now, values, MIN_READING_INTERVAL)
+        return ring
+
+    def _record_readings(self, name, inst_stats, now):
+        readings = self._readings.get(name)
+        if readings is None:
+            readings = self._readings[name] = _DomainReadings()
+        rings = {}
+        if inst_stats.cpu is not None:
+            rings['cpu'] = self._add_reading(readings, 'cpu', now,
+                                             (inst_stats.cpu.time,))
+        for vnic, info in inst_stats.vnics:
+            key = ('vnic', vnic.name)
+            rings[key] = self._add_reading(readings, key, now,
+                                           (info.rx_bytes, info.tx_bytes))
+        for disk, info in inst_stats.disks:
+            key = ('disk', disk.device)
+            rings[key] = self._add_reading(readings, key, now,
+                                           (info.read_bytes,
+                                            info.read_requests,
+                                            info.write_bytes,
+                                            info.write_requests))
+        # The rings of unplugged devices are dropped.
+        readings.rings = rings
+        readings.stats = inst_stats
+        readings.timestamp = now
+
+    def _prune_readings(self, now, active=None):
+        for name, readings in list(self._readings.items()):
+            if ((active is not None and name not in active and
+                 readings.timestamp != now) or
+                    now - readings.timestamp > READINGS_MAX_AGE):
+                del self._readings[name]
+
+    def _get_readings(self, instance, duration):
+        """Return the readings of an instance, as of this polling cycle.
+
+        A reading older than half the polling interval belongs to the
+        previous cycle, the counters of all the active domains are then
+        read again at once so the other instances find theirs fresh.
+        """
+        if not CONF.libvirt_local_rates:
+            raise ceilometer.NotImplementedError
+        name = virt_inspector.instance_name(instance)
+        readings = self._readings.get(name)
+        max_age = max((duration or 0) / 2.0, MIN_READING_INTERVAL)
+        if readings is None or time.time() - readings.timestamp >= max_age:
+            if name not in self._inspect_all(set([name]), all_active=True):
+                self._readings.pop(name, None)
+                raise virt_inspector.InstanceNotFoundException(
+                    _('Domain %s not found') % name)
+            readings = self._readings[name]
+        return readings
+
+    def inspect_cpu_util(self, instance, duration=None):
+        readings = self._get_readings(instance, duration)
+        ring = readings.rings.get('cpu')
+        rates = ring.rates() if ring is not None else None
+        if rates is None:
+            raise virt_inspector.NoDataException(
+                _('No previous CPU time reading for %s')
+                % virt_inspector.instance_name(instance))
+        cpus = readings.stats.cpu.number or 1
+        return virt_inspector.CPUUtilStats(
+            util=rates[0] * 100.0 / (10 ** 9 * cpus))
+
+    def inspect_vnic_rates(self, instance, duration=None):
+        readings = self._get_readings(instance, duration)
+        vnic_rates = []
+        for vnic, info in readings.stats.vnics:
+            rates = readings.rings[('vnic', vnic.name)].rates()
+            if rates is not None:
+                vnic_rates.append((vnic, virt_inspector.InterfaceRateStats(
+                    rx_bytes_rate=rates[0], tx_bytes_rate=rates[1])))
+        if readings.stats.vnics and not vnic_rates:
+            raise virt_inspector.NoDataException(
+                _('No previous vNIC readings for %s')
+                % virt_inspector.instance_name(instance))
+        return vnic_rates
+
+    def inspect_disk_rates(self, instance, duration=None):
+        readings = self._get_readings(instance, duration)
+        disk_rates = []
+        for disk, info in readings.stats.disks:
+            rates = readings.rings[('disk', disk.device)].rates()
+            if rates is not None:
+                disk_rates.append((disk, virt_inspector.DiskRateStats(
+                    read_bytes_rate=rates[0],
+                    read_requests_rate=rates[1],
+                    write_bytes_rate=rates[2],
+                    write_requests_rate=rates[3])))
+        if readings.stats.disks and not disk_rates:
+            raise virt_inspector.NoDataException(
+                _('No previous disk readings for %s')
+                % virt_inspector.instance_name(instance))
+        return disk_rates
@@ -15,18 +15,57 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 import collections
+
+import eventlet
+from oslo.config import cfg
 from stevedore import driver
 
 from ceilometer.openstack.common.gettextutils import _
 from ceilometer.openstack.common import log
+from ceilometer.openstack.common import processutils
 from ceilometer import utils
 import time
 import os
 
 from time import sleep
 from ovirtga.guestagent import GuestAgent
+from ovirtga.registry import AgentRegistry
+from ovirtga import sockwatch
+from ovirtga.statestore import GuestState
+from ovirtga.statestore import GuestStateStore
+from ovirtga import vmchannels
 from ovirtga.vmchannels import Listener
 #from ovirtga.vmgreenchannels import Listener
+
+OPTS = [
+    cfg.StrOpt('listener_mode',
+               default=vmchannels.GREEN,
+               help='How the VM channels listener waits for guest agent '
+                    'messages: "green" waits for epoll through the eventlet '
+                    'hub, "native" blocks in epoll on a native thread of '
+                    'the eventlet thread pool. The messages are handled on '
+                    'the eventlet hub either way.'),
+    cfg.IntOpt('connect_workers',
+               default=4,
+               help='Number of workers fixing the permissions of and '
+                    'connecting to new guest agent sockets in the '
+                    'background.'),
+    cfg.BoolOpt('watch_sockets',
+                default=True,
+                help='Watch the libvirt qemu directory with inotify to '
+                     'connect to and disconnect from the guest agents as '
+                     'soon as their sockets appear and disappear. Sockets '
+                     'are otherwise looked up when their instance is '
+                     'polled.'),
+    cfg.IntOpt('max_agents',
+               default=1024,
+               help='Maximum number of guest agents kept connected, the '
+                    'least recently polled ones are disconnected first. '
+                    '0 means unlimited.'),
+]
+
+cfg.CONF.register_opts(OPTS, group='oga')
+
 LOG = log.getLogger(__name__)
 
 _VMCHANNEL_DEVICE_NAME = 'com.redhat.rhevm.vdsm'
@@ -34,6 +73,8 @@ _VMCHANNEL_DEVICE_NAME = 'com.redhat.rhevm.vdsm'
 # service/daemon and in libvirtd (to be used with the quiesce flag).
 _QEMU_GA_DEVICE_NAME = 'org.qemu.guest_agent.0'
 _QEMU_GA_DEVICE_DIR = '/var/lib/libvirt/qemu/'
+# Number of socket files passed to a single chmod call.
+_CHMOD_BATCH_SIZE = 64
 
 # Named tuple representing disk usage.
 #
@@ -43,47 +84,170 @@ _QEMU_GA_DEVICE_DIR = '/var/lib/libvirt/qemu/'
 DiskUsage = collections.namedtuple('DiskUsage',
                                    ['mount_point', 'usage'])
 
+# Named tuple representing a snapshot of the guest agent report.
+#
+# mem_total: total memory in kB, or None if not reported
+# mem_unused: unused memory in kB, or None if not reported
+# mem_cached: cached memory in kB, or None if not reported
+# mem_swap: total swap in kB, or None if not reported
+# mem_buffer: buffer memory in kB, or None if not reported
+# disk_usage: tuple of DiskUsage, or None if not reported
+# sys_info: tuple of (attribute, value) pairs of system information
+#
+GuestInfo = collections.namedtuple('GuestInfo',
+                                   ['mem_total', 'mem_unused', 'mem_cached',
+                                    'mem_swap', 'mem_buffer', 'disk_usage',
+                                    'sys_info'])
+
+_SYS_INFO_ATTRS = ("netIfaces", "guestFQDN", "lastLogin",
+                   "guestOs", "guestIPs")
+
 
 class OGAInspector(object):
 
     INSPECTOR_TIMEOUT = 120
 
     def __init__(self):
-        self.oga_dict = {}
-        self.channelListener = Listener()
+        self.agents = AgentRegistry(cfg.CONF.oga.max_agents,
+                                    self.INSPECTOR_TIMEOUT,
+                                    self._agent_age,
+                                    on_remove=self._on_agent_removed)
+        # Sockets waiting to be connected, keyed by instance name.
+        self._pending = {}
+        self._connecting = set()
+        self._connect_pool = eventlet.GreenPool(cfg.CONF.oga.connect_workers)
+        self.store = GuestStateStore()
+        self.channelListener = Listener(store=self.store,
+                                        mode=cfg.CONF.oga.listener_mode)
         self.channelListener.settimeout(30)
         self.channelListener.start()
         #self._prepare_socket_dir()
+        self._watcher = None
+        if cfg.CONF.oga.watch_sockets:
+            self._start_watcher()
+
+    def _start_watcher(self):
+        watcher = sockwatch.SocketWatcher(_QEMU_GA_DEVICE_DIR,
+                                          _VMCHANNEL_DEVICE_NAME + '.',
+                                          '.sock',
+                                          self._on_socket_created,
+                                          self._on_socket_deleted)
+        try:
+            watcher.start()
+        except OSError as e:
+            LOG.warning("Unable to watch %s for guest agent sockets, they "
+                        "will be looked up on polling: %s" %
+                        (_QEMU_GA_DEVICE_DIR, e))
+        else:
+            self._watcher = watcher
+
+    def _on_socket_created(self, instance_name, guestSocketFile):
+        if (instance_name not in self.agents and
+                instance_name not in self._connecting):
+            self._schedule_connect(instance_name, guestSocketFile)
+
+    def _on_socket_deleted(self, instance_name):
+        LOG.debug("Guest agent socket of instance %s was removed" %
+                  instance_name)
+        self._pending.pop(instance_name, None)
+        self._connecting.discard(instance_name)
+        self._remove_agent(instance_name)
+
+    def _remove_agent(self, instance_name):
+        self.agents.remove(instance_name)
+        self.store.remove(instance_name)
+
+    def _on_agent_removed(self, instance_name, guest_agent):
+        guest_agent.stop()
+        self.store.remove(instance_name)
 
     def _get_agent(self, instance_name):
+        """Return the connected agent of an instance.
 
-        if instance_name in self.oga_dict:
-            return self.oga_dict[instance_name]
+        The first time an instance is seen its socket is connected in the
+        background and None is returned, so polling never waits for it.
+        """
+        self.agents.expire()
+        guest_agent = self.agents.get(instance_name)
+        if guest_agent is not None:
+            return guest_agent
+        if instance_name in self._connecting:
+            return None
 
         guestSocketFile = self._make_channel_path(_VMCHANNEL_DEVICE_NAME,
                                                   instance_name)
         if os.path.exists(guestSocketFile):
-            guest_agent = GuestAgent(guestSocketFile, self.channelListener)
-            guest_agent.connect()
-            self.oga_dict[instance_name] = guest_agent
-            return guest_agent
+            self._schedule_connect(instance_name, guestSocketFile)
         else:
             LOG.error("Instance %s socket file %s does not exist!" %
                       (instance_name, guestSocketFile))
-            return None
+        return None
+
+    def _schedule_connect(self, instance_name, guestSocketFile):
+        self._connecting.add(instance_name)
+        if not self._pending:
+            # The batch is connected once the current green thread yields,
+            # so it also gathers the sockets scheduled meanwhile by the
+            # other pollsters and by the socket watcher.
+            eventlet.spawn_n(self._connect_pending)
+        self._pending[instance_name] = guestSocketFile
+
+    def _connect_pending(self):
+        # Sockets scheduled from now on start a new batch instead of
+        # changing the one being connected.
+        pending, self._pending = self._pending, {}
+        pending = sorted(pending.items())
+        for i in range(0, len(pending), _CHMOD_BATCH_SIZE):
+            self._connect_pool.spawn_n(self._connect_batch,
+                                       pending[i:i + _CHMOD_BATCH_SIZE])
+
+    def _connect_batch(self, batch):
+        try:
+            self._prepare_sockets([path for _name, path in batch])
+        except processutils.ProcessExecutionError as e:
+            # Some sockets may have gone away meanwhile, the others were
+            # still changed and the agents retry to connect by themselves.
+            LOG.warning("Unable to fix the permissions of guest agent "
+                        "sockets: %s" % e)
+        for instance_name, guestSocketFile in batch:
+            if instance_name not in self._connecting:
+                # The socket was removed meanwhile.
+                continue
+            try:
+                guest_agent = GuestAgent(guestSocketFile,
+                                         self.channelListener,
+                                         vmName=instance_name)
+                guest_agent.connect(prepare=False)
+                self.agents.add(instance_name, guest_agent)
+            except Exception:
+                LOG.exception("Unable to connect to the guest agent of "
+                              "instance %s" % instance_name)
+            finally:
+                self._connecting.discard(instance_name)
+
+    def _prepare_sockets(self, paths):
+        paths = [path for path in paths if os.path.exists(path)]
+        if paths:
+            utils.execute('chmod', 'g+rw', *paths, run_as_root=True)
+
+    def _agent_age(self, instance_name, guest_agent):
+        age = self.store.age(instance_name)
+        if age is None:
+            # Nothing was reported yet, rely on the connection time.
+            age = time.time() - guest_agent.update_time()
+        return age
 
     def clear_outdated_agent(self):
+        self.agents.expire()
 
-        del_keys = []
-        for instance_name in self.oga_dict:
-            guest_agent = self.oga_dict[instance_name]
-            if (time.time() - guest_agent.update_time()
-                    > self.INSPECTOR_TIMEOUT):
-                guest_agent.stop()
-                del_keys.append(instance_name)
+        for key in self.store.names():
+            if key not in self.agents:
+                self.store.remove(key)
+        LOG.debug("Guest agents: %s" % self.stats())
 
-        for key in del_keys:
-            del self.oga_dict[key]
+    def stats(self):
+        """Return the counters of the guest agent registry."""
+        return self.agents.stats()
 
     def _prepare_socket_dir(self):
         chmod_dir_cmd = ['chmod', '-R', 'g+rwx', _QEMU_GA_DEVICE_DIR]
@@ -108,40 +272,63 @@ class OGAInspector(object):
             self.inspect_sys(instance_name)
             sleep(1)
 
-    def inspect_sys(self, instance_name):
-        """Inspect the system information for an instance.
+    def inspect_guest(self, instance_name):
+        """Inspect everything the guest agent reported for an instance.
+
+        All the guest agent backed pollsters share this snapshot, so the
+        agent is looked up and its report is read once per instance.
 
         :param instance_name: the name of the target instance
-        :return: the dict of system information
+        :return: a GuestInfo snapshot or None if no agent is available
         """
         agt = self._get_agent(instance_name)
         if agt is None:
             return None
-        sys_dict = {}
-        for attr in ["netIfaces", "guestFQDN", "lastLogin",
-                     "guestOs", "guestIPs"]:
-            val = agt.getGuestInfo().get(attr)
-            if val is not None and val != '':
-                sys_dict[attr] = val
-                print attr, val
-        return sys_dict
+        guestInfo = dict(agt.getGuestInfo() or {})
+        # The reports pushed by the listener are the freshest data.
+        state = self.store.get(instance_name)
+        if (state is not None and
+                self.store.age(instance_name) <= self.INSPECTOR_TIMEOUT):
+            for kind in GuestState.KINDS:
+                value = getattr(state, kind)
+                if value is not None:
+                    guestInfo[kind] = value
+        return _make_guest_info(guestInfo)
+
+    def inspect_guest_changes(self, since_version=0):
+        """Inspect the guests which reported since a given store version.
+
+        The snapshots are made of the pushed reports only, read from the
+        store without looking up the agents.
+
+        :param since_version: the store version seen by the previous call
+        :return: the current store version and a dict of GuestInfo
+                 snapshots keyed by instance name
+        """
+        version, states = self.store.changed_since(since_version)
+        changes = {}
+        for state in states:
+            changes[state.name] = _make_guest_info(
+                dict((kind, getattr(state, kind))
+                     for kind in GuestState.KINDS))
+        return version, changes
 
-    def inspect_mem_total(self, instance_name):
-        """Inspect the Total Memory for an instance.
+    def inspect_sys(self, instance_name):
+        """Inspect the system information for an instance.
 
         :param instance_name: the name of the target instance
-        :return: the size of the total memory or -1 if none data retrieved
+        :return: the dict of system information
         """
-        agt = self._get_agent(instance_name)
-        if agt is None:
-            return -1
-        guestInfo = agt.getGuestInfo()
-        if (guestInfo is not None and
-            guestInfo.get("memoryStats") is not None and
-            guestInfo.get("memoryStats").get("mem_total") is not None):
-            return guestInfo.get("memoryStats").get("mem_total")
-        else:
+        guest = self.inspect_guest(instance_name)
+        if guest is None:
+            return None
+        return dict(guest.sys_info)
+
+    def _inspect_guest_field(self, instance_name, field):
+        guest = self.inspect_guest(instance_name)
+        if guest is None or getattr(guest, field) is None:
             return -1
+        return getattr(guest, field)
 
     def inspect_mem_total(self, instance_name):
         """Inspect the Total Memory for an instance.
@@ -149,16 +336,7 @@ class OGAInspector(object):
         :param instance_name: the name of the target instance
         :return: the size of the total memory or -1 if none data retrieved
         """
-        agt = self._get_agent(instance_name)
-        if agt is None:
-            return -1
-        guestInfo = agt.getGuestInfo()
-        if (guestInfo is not None and
-            guestInfo.get("memoryStats") is not None and
-            guestInfo.get("memoryStats").get("mem_total") is not None):
-            return guestInfo.get("memoryStats").get("mem_total")
-        else:
-            return -1
+        return self._inspect_guest_field(instance_name, 'mem_total')
 
     def inspect_mem_unused(self, instance_name):
         """Inspect the unused Memory for an instance.
@@ -166,16 +344,7 @@ class OGAInspector(object):
         :param instance_name: the name of the target instance
         :return: the size of the unused memory or -1 if none data retrieved
         """
-        agt = self._get_agent(instance_name)
-        if agt is None:
-            return -1
-        guestInfo = agt.getGuestInfo()
-        if (guestInfo is not None and
-            guestInfo.get("memoryStats") is not None and
-            guestInfo.get("memoryStats").get("mem_unused") is not None):
-            return guestInfo.get("memoryStats").get("mem_unused")
-        else:
-            return -1
+        return self._inspect_guest_field(instance_name, 'mem_unused')
 
     def inspect_mem_cached(self, instance_name):
         """Inspect the cached Memory for an instance.
@@ -183,16 +352,7 @@ class OGAInspector(object):
         :param instance_name: the name of the target instance
         :return: the size of the cached memory or -1 if none data retrieved
         """
-        agt = self._get_agent(instance_name)
-        if agt is None:
-            return -1
-        guestInfo = agt.getGuestInfo()
-        if (guestInfo is not None and
-            guestInfo.get("memoryStats") is not None and
-            guestInfo.get("memoryStats").get("mem_cached") is not None):
-            return guestInfo.get("memoryStats").get("mem_cached")
-        else:
-            return -1
+        return self._inspect_guest_field(instance_name, 'mem_cached')
 
     def inspect_mem_swap(self, instance_name):
         """Inspect the swap Memory for an instance.
@@ -200,16 +360,7 @@ class OGAInspector(object):
         :param instance_name: the name of the target instance
         :return: the size of the swap memory or -1 if none data retrieved
         """
-        agt = self._get_agent(instance_name)
-        if agt is None:
-            return -1
-        guestInfo = agt.getGuestInfo()
-        if (guestInfo is not None and
-            guestInfo.get("memoryStats") is not None and
-            guestInfo.get("memoryStats").get("swap_total") is not None):
-            return guestInfo.get("memoryStats").get("swap_total")
-        else:
-            return -1
+        return self._inspect_guest_field(instance_name, 'mem_swap')
 
     def inspect_mem_buffer(self, instance_name):
         """Inspect the buffer Memory for an instance.
@@ -217,16 +368,7 @@ class OGAInspector(object):
         :param instance_name: the name of the target instance
         :return: the size of the buffer memory or -1 if none data retrieved
         """
-        agt = self._get_agent(instance_name)
-        if agt is None:
-            return -1
-        guestInfo = agt.getGuestInfo()
-        if (guestInfo is not None and
-            guestInfo.get("memoryStats") is not None and
-            guestInfo.get("memoryStats").get("mem_buffers") is not None):
-            return guestInfo.get("memoryStats").get("mem_buffers")
-        else:
-            return -1
+        return self._inspect_guest_field(instance_name, 'mem_buffer')
 
     def inspect_disk_usage(self, instance_name):
         """Inspect the disk_usage for an instance.
@@ -234,30 +376,49 @@ class OGAInspector(object):
         :param instance_name: the name of the target instance
         :return: the list of disk usage or none if no data retrieved
         """
-        agt = self._get_agent(instance_name)
-        if agt is None:
+        guest = self.inspect_guest(instance_name)
+        if guest is None or guest.disk_usage is None:
             return None
-        guestInfo = agt.getGuestInfo()
-        if (guestInfo is not None and
-            guestInfo.get("disksUsage") is not None):
+        return list(guest.disk_usage)
 
-            usage_list = []
 
-            for per_disk in guestInfo["disksUsage"]:
-                used = per_disk["used"]
-                total = per_disk["total"]
-                path = per_disk["path"]
-                usage = float(used)/float(total)
-                usage = round(usage, 3)
-                usage = usage * 100
-                disk_usage = DiskUsage(mount_point=path,
-                                       usage=usage)
-                usage_list.append(disk_usage)
+def _make_guest_info(guestInfo):
+    memoryStats = guestInfo.get("memoryStats") or {}
+    return GuestInfo(
+        mem_total=_to_int(memoryStats.get("mem_total")),
+        mem_unused=_to_int(memoryStats.get("mem_unused")),
+        mem_cached=_to_int(memoryStats.get("mem_cached")),
+        mem_swap=_to_int(memoryStats.get("swap_total")),
+        mem_buffer=_to_int(memoryStats.get("mem_buffers")),
+        disk_usage=_make_disk_usage(guestInfo.get("disksUsage")),
+        sys_info=tuple((attr, guestInfo[attr])
+                       for attr in _SYS_INFO_ATTRS
+                       if guestInfo.get(attr) not in (None, '')))
 
-            return usage_list
 
-        else:
-            return None
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _make_disk_usage(disks):
+    if disks is None:
+        return None
+    usage_list = []
+    for per_disk in disks:
+        try:
+            used = float(per_disk["used"])
+            total = float(per_disk["total"])
+            path = per_disk["path"]
+        except (KeyError, TypeError, ValueError):
+            continue
+        if not total:
+            continue
+        usage = round(used / total, 3) * 100
+        usage_list.append(DiskUsage(mount_point=path, usage=usage))
+    return tuple(usage_list)
 
 
 def get_oga_inspector():
@@ -23,7 +23,7 @@ import time
 import socket
 import errno
 import json
-import unicodedata
+import codecs
 import os
 import stat
 
@@ -48,6 +48,20 @@ __RESTRICTED_CHARS = set(range(8 + 1)). \
     union(set(range(0x86, 0x9F + 1)))
 
 
+# Translation table mapping every code point not allowed in XML documents
+# to the replacement character. Surrogates are included since a narrow
+# Python build represents code points outside the BMP as surrogate pairs.
+__XML_CHAR_TABLE = dict.fromkeys(
+    __RESTRICTED_CHARS.union(range(0xD800, 0xDFFF + 1), (0xFFFE, 0xFFFF)),
+    __REPLACEMENT_CHAR)
+
+# Only the messages whose strings end up in the published guest info are
+# filtered, the others (e.g. the applications list) are never exposed.
+_FILTERED_MESSAGES = frozenset(['host-name', 'os-version',
+                                'network-interfaces', 'active-user', 'fqdn',
+                                'disks-usage'])
+
+
 def _filterXmlChars(u):
     """
     The set of characters allowed in XML documents is described in
@@ -69,19 +83,7 @@ def _filterXmlChars(u):
     if not isinstance(u, unicode):
         raise TypeError
 
-    def filterXmlChar(c):
-        if ord(c) > 0x10ffff:
-            return __REPLACEMENT_CHAR  # Outside Unicode range
-        elif unicodedata.category(c) == 'Cs':
-            return __REPLACEMENT_CHAR  # Surrogate pair code point
-        elif (ord(c) == 0xFFFE) or (ord(c) == 0xFFFF):
-            return __REPLACEMENT_CHAR  # Specifically excluded code points
-        elif ord(c) in __RESTRICTED_CHARS:
-            return __REPLACEMENT_CHAR  # Restricted character
-        else:
-            return c
-
-    return ''.join(filterXmlChar(c) for c in u)
+    return u.translate(__XML_CHAR_TABLE)
 
 
 def _filterObject(obj):
@@ -90,11 +92,13 @@ def _filterObject(obj):
     """
     def filt(o):
         if isinstance(o, dict):
-            return dict(map(filt, o.iteritems()))
+            return dict((filt(k), filt(v)) for k, v in o.iteritems())
         elif isinstance(o, list):
-            return map(filt, o)
+            return [filt(v) for v in o]
         elif isinstance(o, tuple):
-            return tuple(map(filt, o))
+            return tuple(filt(v) for v in o)
+        elif isinstance(o, unicode):
+            return o.translate(__XML_CHAR_TABLE)
         elif isinstance(o, basestring):
             return _filterXmlChars(o)
         return o
@@ -106,6 +110,69 @@ class MessageState:
     TOO_BIG = 'too-big'
 
 
+class LineFramer(object):
+    """Split the stream read from a guest into newline terminated messages.
+
+    The data is accumulated in a single bytearray and only the newly
+    received bytes are searched for the message end. Complete lines are
+    decoded straight from the buffer, without joining partial chunks.
+    """
+
+    __slots__ = ('_buffer', '_scanned', '_maxSize', 'state')
+
+    def __init__(self, maxSize):
+        self._buffer = bytearray()
+        self._scanned = 0
+        self._maxSize = maxSize
+        self.state = MessageState.NORMAL
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def clear(self):
+        del self._buffer[:]
+        self._scanned = 0
+        self.state = MessageState.NORMAL
+
+    def feed(self, data):
+        """Append data and return the list of complete lines.
+
+        Bad UTF8 encoding from the (untrusted) guest is replaced with the
+        Unicode replacement character. Messages larger than the maximum
+        size are dropped.
+        """
+        buf = self._buffer
+        buf.extend(data)
+        lines = []
+        start = 0
+        end = buf.find(b'\n', self._scanned)
+        if end != -1:
+            view = memoryview(buf)
+            while end != -1:
+                if self.state is MessageState.TOO_BIG:
+                    self.state = MessageState.NORMAL
+                    LOG.warning("Not processing current message because it "
+                                "was too big")
+                else:
+                    lines.append(codecs.utf_8_decode(view[start:end],
+                                                     'replace', True)[0])
+                start = end + 1
+                end = buf.find(b'\n', start)
+            # The buffer can't be resized while a view is exported.
+            del view
+            del buf[:start]
+        self._scanned = len(buf)
+
+        if self._scanned >= self._maxSize:
+            LOG.warning("Discarding buffer with size: %d because the "
+                        "message reached maximum size of %d bytes before "
+                        "message end was reached.", self._scanned,
+                        self._maxSize)
+            self.clear()
+            self.state = MessageState.TOO_BIG
+        return lines
+
+
 class GuestAgentUnsupportedMessage(Exception):
     def __init__(self, cmd, requiredVersion, currentVersion):
         message = "Guest Agent command '%s' requires version '%d'. Current " \
@@ -117,9 +184,10 @@ class GuestAgent(object):
     MAX_MESSAGE_SIZE = 2 ** 20  # 1 MiB for now
 
     def __init__(self, socketName, channelListener, user='Unknown',
-                 ips=''):
+                 ips='', vmName=None):
         self.effectiveApiVersion = _IMPLICIT_API_VERSION_ZERO
         self._socketName = socketName
+        self._vmName = vmName or socketName
         self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self._stopped = True
         self.guestStatus = None
@@ -137,7 +205,9 @@ class GuestAgent(object):
             'memoryStats': {}}
         self._agentTimestamp = time.time()
         self._channelListener = channelListener
-        self._messageState = MessageState.NORMAL
+        self._framer = LineFramer(self.MAX_MESSAGE_SIZE)
+        # Number of successful connections to the guest
+        self.connects = 0
 
     @property
     def guestDiskMapping(self):
@@ -152,8 +222,14 @@ class GuestAgent(object):
     def diskMappingHash(self):
         return self._diskMappingHash
 
-    def connect(self):
-        self._prepare_socket()
+    def connect(self, prepare=True):
+        """Register the agent channel with the listener.
+
+        :param prepare: fix the socket permissions first, callers which
+                        already did it for a batch of sockets pass False
+        """
+        if prepare:
+            self._prepare_socket()
         self._channelListener.register(
             self._create,
             self._connect,
@@ -216,13 +292,13 @@ class GuestAgent(object):
             result = self._sock.connect_ex(self._socketName)
             if result == 0:
                 LOG.debug("Connected to %s", self._socketName)
-                self._messageState = MessageState.NORMAL
                 self._clearReadBuffer()
                 # Report the _MAX_SUPPORTED_API_VERSION on refresh to enable
                 # the other side to see that we support API versioning
                 self._forward('refresh',
                               {'apiVersion': _MAX_SUPPORTED_API_VERSION})
                 self._stopped = False
+                self.connects += 1
                 ret = True
                 self._agentTimestamp = time.time()
             else:
@@ -257,6 +333,8 @@ class GuestAgent(object):
                     # Convert the value to string since 64-bit integer is not
                     # supported in XMLRPC
                     self.guestInfo['memoryStats'][k] = str(v)
+                self._report('memoryStats',
+                             dict(self.guestInfo['memoryStats']))
 
             if 'apiVersion' in args:
                 # The guest agent supports API Versioning
@@ -284,6 +362,7 @@ class GuestAgent(object):
                 old_ips += ' '.join(iface['inet']) + ' '
             self.guestInfo['netIfaces'] = interfaces
             self.guestInfo['guestIPs'] = old_ips.strip()
+            self._report('netIfaces', interfaces)
         elif message == 'applications':
             self.guestInfo['appsList'] = args['applications']
         elif message == 'active-user':
@@ -321,11 +400,17 @@ class GuestAgent(object):
                 disks.append(disk)
             self.guestInfo['disksUsage'] = disks
             self.guestDiskMapping = args.get('mapping', {})
+            self._report('disksUsage', disks)
         elif message == 'number-of-cpus':
             self.guestInfo['guestCPUCount'] = int(args['count'])
         else:
             LOG.error('Unknown message type %s', message)
 
+    def _report(self, kind, value):
+        report = getattr(self._channelListener, 'report', None)
+        if report is not None:
+            report(self._vmName, kind, value)
+
     def stop(self):
         self._stopped = True
         try:
@@ -418,8 +503,7 @@ class GuestAgent(object):
             self.guestStatus = None
 
     def _clearReadBuffer(self):
-        self._buffer = []
-        self._bufferSize = 0
+        self._framer.clear()
 
     def _processMessage(self, line):
         try:
@@ -430,27 +514,10 @@ class GuestAgent(object):
             LOG.error("%s: %s" % (err, repr(line)))
 
     def _handleData(self, data):
-        while (not self._stopped) and '\n' in data:
-            line, data = data.split('\n', 1)
-            line = ''.join(self._buffer) + line
-            self._clearReadBuffer()
-            if self._messageState is MessageState.TOO_BIG:
-                self._messageState = MessageState.NORMAL
-                LOG.warning("Not processing current message because it "
-                                 "was too big")
-            else:
-                self._processMessage(line)
-
-        self._buffer.append(data)
-        self._bufferSize += len(data)
-
-        if self._bufferSize >= self.MAX_MESSAGE_SIZE:
-            LOG.warning("Discarding buffer with size: %d because the "
-                             "message reached maximum size of %d bytes before "
-                             "message end was reached.", self._bufferSize,
-                             self.MAX_MESSAGE_SIZE)
-            self._messageState = MessageState.TOO_BIG
-            self._clearReadBuffer()
+        for line in self._framer.feed(data):
+            if self._stopped:
+                break
+            self._processMessage(line)
 
     @staticmethod
     def _onChannelRead(self):
@@ -472,17 +539,18 @@ class GuestAgent(object):
         return result
 
     def _parseLine(self, line):
-        # Deal with any bad UTF8 encoding from the (untrusted) guest,
-        # by replacing them with the Unicode replacement character
-        uniline = line.decode('utf8', 'replace')
-        args = json.loads(uniline)
+        # The framer already replaced any bad UTF8 encoding from the
+        # (untrusted) guest with the Unicode replacement character
+        if not isinstance(line, unicode):
+            line = line.decode('utf8', 'replace')
+        args = json.loads(line)
+        name = args.pop('__name__')
         # Filter out any characters in the untrusted guest response
         # that aren't permitted in XML.  This must be done _after_ the
         # JSON decoding, since otherwise JSON's \u escape decoding
         # could be used to generate the bad characters
-        args = _filterObject(args)
-        name = args['__name__']
-        del args['__name__']
+        if name in _FILTERED_MESSAGES:
+            args = _filterObject(args)
         return (name, args)
 
     def update_time(self):
@@ -0,0 +1,135 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Bounded registry of the connected guest agents."""
+
+import heapq
+
+from ceilometer.compute.virt.ovirtga import statestore
+
+
+def get_ordereddict():
+    """A fix for py26 not having ordereddict."""
+    try:
+        import collections
+        return collections.OrderedDict
+    except AttributeError:
+        import ordereddict
+        return ordereddict.OrderedDict
+
+OrderedDict = get_ordereddict()
+
+
+class AgentRegistry(object):
+    """Guest agents by instance name, with LRU and TTL eviction.
+
+    When the registry is full, adding an agent evicts the least recently
+    used one. Each agent also has an expiry deadline kept in a heap, so
+    checking for expired agents only looks at the heap top. A deadline is
+    only a hint: when it is reached the actual age of the agent is asked
+    to `age`, and the agent is rescheduled if it was active meanwhile.
+
+    :param capacity: maximum number of agents
+    :param ttl: seconds of inactivity after which an agent expires
+    :param age: callable returning the seconds since the last activity of
+                an agent, given its name and the agent
+    :param on_remove: callable called with the name and the agent of every
+                      agent leaving the registry
+    """
+
+    def __init__(self, capacity, ttl, age, on_remove=None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._age = age
+        self._on_remove = on_remove
+        self._agents = OrderedDict()
+        self._deadlines = []
+        self.evictions = 0
+        self.expirations = 0
+        self._removed_reconnects = 0
+
+    def __len__(self):
+        return len(self._agents)
+
+    def __contains__(self, name):
+        return name in self._agents
+
+    def names(self):
+        return list(self._agents)
+
+    def get(self, name):
+        """Return the agent of an instance and mark it recently used."""
+        agent = self._agents.pop(name, None)
+        if agent is not None:
+            self._agents[name] = agent
+        return agent
+
+    def add(self, name, agent):
+        if name in self._agents:
+            self.remove(name)
+        while self.capacity and len(self._agents) >= self.capacity:
+            oldest = next(iter(self._agents))
+            self.evictions += 1
+            self.remove(oldest)
+        self._agents[name] = agent
+        heapq.heappush(self._deadlines,
+                       (statestore.monotonic() + self.ttl, name, agent))
+
+    def remove(self, name):
+        agent = self._agents.pop(name, None)
+        if agent is not None:
+            self._removed_reconnects += _reconnects(agent)
+            if self._on_remove is not None:
+                self._on_remove(name, agent)
+        return agent
+
+    def expire(self):
+        """Remove the agents inactive for more than ttl seconds.
+
+        :return: the names of the expired agents
+        """
+        expired = []
+        now = statestore.monotonic()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _deadline, name, agent = heapq.heappop(self._deadlines)
+            if self._agents.get(name) is not agent:
+                # Stale entry of an agent removed or replaced meanwhile.
+                continue
+            age = self._age(name, agent)
+            if age > self.ttl:
+                self.expirations += 1
+                self.remove(name)
+                expired.append(name)
+            else:
+                heapq.heappush(self._deadlines,
+                               (now + self.ttl - age, name, agent))
+        if len(self._deadlines) > 2 * len(self._agents) + 64:
+            # Drop the stale entries so the heap does not outgrow the
+            # registry when agents are removed before expiring.
+            self._deadlines = [entry for entry in self._deadlines
+                               if self._agents.get(entry[1]) is entry[2]]
+            heapq.heapify(self._deadlines)
+        return expired
+
+    def stats(self):
+        return {
+            'live': len(self._agents),
+            'capacity': self.capacity,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'reconnects': self._removed_reconnects + sum(
+                _reconnects(agent) for agent in self._agents.values()),
+        }
+
+
+def _reconnects(agent):
+    return max(getattr(agent, 'connects', 0) - 1, 0)
@@ -0,0 +1,184 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Inotify based discovery of the guest agent channel sockets."""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+import eventlet
+from eventlet import hubs
+
+from ceilometer.openstack.common import log
+
+LOG = log.getLogger(__name__)
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM | \
+    IN_DELETE_SELF
+
+# struct inotify_event {int wd; uint32_t mask, cookie, len; char name[];}
+_EVENT = struct.Struct('iIII')
+
+
+class InotifyUnavailable(OSError):
+    pass
+
+
+def _load_inotify():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        init = libc.inotify_init1
+        add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError) as e:
+        raise InotifyUnavailable(errno.ENOSYS, 'inotify unavailable: %s' % e)
+    init.argtypes = [ctypes.c_int]
+    add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return init, add_watch
+
+
+def parse_events(data):
+    """Return the list of (mask, name) of a buffer of inotify events."""
+    events = []
+    offset = 0
+    while offset + _EVENT.size <= len(data):
+        _wd, mask, _cookie, length = _EVENT.unpack_from(data, offset)
+        offset += _EVENT.size
+        name = data[offset:offset + length].rstrip(b'\0')
+        offset += length
+        events.append((mask, name))
+    return events
+
+
+class SocketWatcher(object):
+    """Report the sockets created in and removed from a directory.
+
+    The directory is watched with inotify from a green thread. Sockets
+    already present are reported when the watcher starts, and again when
+    the kernel event queue overflowed.
+
+    :param directory: the directory to watch
+    :param prefix: prefix of the file names of the sockets
+    :param suffix: suffix of the file names of the sockets
+    :param on_created: called with the name stripped of the prefix and
+                       suffix and the path of each new socket
+    :param on_deleted: called with the name of each removed socket
+    """
+
+    def __init__(self, directory, prefix, suffix, on_created, on_deleted):
+        self._directory = directory
+        self._prefix = prefix
+        self._suffix = suffix
+        self._on_created = on_created
+        self._on_deleted = on_deleted
+        self._fd = None
+        self._thread = None
+
+    def start(self):
+        init, add_watch = _load_inotify()
+        fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise InotifyUnavailable(err, os.strerror(err))
+        # Watch before scanning so no socket created meanwhile is missed.
+        if add_watch(fd, self._directory.encode('utf8'), _WATCH_MASK) < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise InotifyUnavailable(err, os.strerror(err))
+        self._fd = fd
+        self.scan()
+        self._thread = eventlet.spawn(self._run)
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.kill()
+            self._thread = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _name(self, filename):
+        if (filename.startswith(self._prefix) and
+                filename.endswith(self._suffix) and
+                len(filename) > len(self._prefix) + len(self._suffix)):
+            return filename[len(self._prefix):-len(self._suffix)]
+        return None
+
+    def _created(self, filename):
+        name = self._name(filename)
+        if name is not None:
+            self._on_created(name, os.path.join(self._directory, filename))
+
+    def _deleted(self, filename):
+        name = self._name(filename)
+        if name is not None:
+            self._on_deleted(name)
+
+    def scan(self):
+        """Report every socket currently in the directory."""
+        try:
+            filenames = os.listdir(self._directory)
+        except OSError as e:
+            LOG.warning("Unable to list %s: %s" % (self._directory, e))
+            return
+        for filename in filenames:
+            self._created(filename)
+
+    def _read(self):
+        try:
+            return os.read(self._fd, 64 * 1024)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return b''
+            raise
+
+    def handle_events(self, data):
+        for mask, filename in parse_events(data):
+            if mask & IN_Q_OVERFLOW:
+                LOG.warning("Inotify queue of %s overflowed, rescanning."
+                            % self._directory)
+                self.scan()
+            elif mask & (IN_IGNORED | IN_DELETE_SELF):
+                LOG.warning("%s is no longer watched." % self._directory)
+                return False
+            elif mask & IN_ISDIR:
+                continue
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                self._created(filename)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._deleted(filename)
+        return True
+
+    def _run(self):
+        LOG.info("Watching %s for guest agent sockets." % self._directory)
+        while True:
+            try:
+                hubs.trampoline(self._fd, read=True)
+                if not self.handle_events(self._read()):
+                    break
+            except Exception:
+                LOG.exception("Error while watching %s." % self._directory)
+                break
+        self._thread = None
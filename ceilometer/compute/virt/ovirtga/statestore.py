@@ -0,0 +1,149 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Per-host store of the latest reports pushed by the guest agents."""
+
+import ctypes
+import ctypes.util
+import os
+import time
+
+from eventlet import patcher
+
+_native_threading = patcher.original('threading')
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _get_monotonic():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    # Python 2 has no monotonic clock, fall back to clock_gettime(2).
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        t = _Timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t)) != 0:
+            errno_ = ctypes.get_errno()
+            raise OSError(errno_, os.strerror(errno_))
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+    return monotonic
+
+
+monotonic = _get_monotonic()
+
+
+class GuestState(object):
+    """Latest report of a single guest.
+
+    :param name: the name the guest is stored under
+    :param seq: number of reports received from this guest
+    :param version: store version of the last report of this guest
+    :param timestamp: monotonic time of the last report of this guest
+    """
+
+    KINDS = ('memoryStats', 'disksUsage', 'netIfaces')
+
+    __slots__ = ('name', 'seq', 'version', 'timestamp') + KINDS
+
+    def __init__(self, name):
+        self.name = name
+        self.seq = 0
+        self.version = 0
+        self.timestamp = None
+        self.memoryStats = None
+        self.disksUsage = None
+        self.netIfaces = None
+
+
+class GuestStateStore(object):
+    """Versioned store of the guest agent reports of a host.
+
+    Every accepted report bumps the store version, so readers can ask for
+    the guests which changed since the version they saw last, and the
+    receive time of each guest gives an exact staleness check.
+    """
+
+    __slots__ = ('_states', '_version', '_lock', '_watchers')
+
+    def __init__(self):
+        self._states = {}
+        self._version = 0
+        self._watchers = []
+        # The critical sections never yield, so a native lock is safe for
+        # green threads.
+        self._lock = _native_threading.Lock()
+
+    @property
+    def version(self):
+        return self._version
+
+    def update(self, name, kind, value):
+        """Record a report of the given kind received from a guest."""
+        if kind not in GuestState.KINDS:
+            raise ValueError('Unknown guest report kind %s' % kind)
+        with self._lock:
+            state = self._states.get(name)
+            if state is None:
+                state = self._states[name] = GuestState(name)
+            self._version += 1
+            state.seq += 1
+            state.version = self._version
+            state.timestamp = monotonic()
+            setattr(state, kind, value)
+            seq = state.seq
+        for callback in self._watchers:
+            callback()
+        return seq
+
+    def watch(self, callback):
+        """Call back, with no argument, after every accepted report."""
+        self._watchers.append(callback)
+
+    def get(self, name):
+        return self._states.get(name)
+
+    def remove(self, name):
+        with self._lock:
+            return self._states.pop(name, None)
+
+    def names(self):
+        return list(self._states)
+
+    def changed_since(self, version):
+        """Return the current version and the guests updated after version."""
+        with self._lock:
+            return self._version, [s for s in self._states.values()
+                                   if s.version > version]
+
+    def age(self, name):
+        """Seconds since the last report of a guest, None if never seen."""
+        state = self._states.get(name)
+        if state is None:
+            return None
+        return monotonic() - state.timestamp
+
+    def expired(self, max_age):
+        """Return the names of the guests silent for more than max_age."""
+        deadline = monotonic() - max_age
+        return [s.name for s in list(self._states.values())
+                if s.timestamp < deadline]
@@ -18,12 +18,17 @@
 # Refer to the README and COPYING files for full details of the license
 #
 
+import fcntl
+import os
 import threading
 import time
 import select
 import errno
+from ceilometer.compute.virt.ovirtga import statestore
 from ceilometer.openstack.common import log
-from eventlet import greenthread
+from eventlet import hubs
+from eventlet import patcher
+from eventlet import tpool
 
 
 LOG = log.getLogger(__name__)
@@ -32,6 +37,22 @@ LOG = log.getLogger(__name__)
 # applied
 COOLDOWN_RECONNECT_THRESHOLD = 5
 
+# How often (in seconds) unconnected channels are given a chance to connect
+UNCONNECTED_RETRY_INTERVAL = 1.0
+
+# Listener modes: 'green' waits for the epoll descriptor through the eventlet
+# hub, 'native' blocks in epoll on a thread of the eventlet native thread pool.
+# The messages are handled by a green thread either way.
+GREEN = 'green'
+NATIVE = 'native'
+MODES = (GREEN, NATIVE)
+
+_native_threading = patcher.original('threading')
+
+
+class _PollTimeout(Exception):
+    pass
+
 
 # NOTE: it would be best to try and unify NoIntrCall and NoIntrPoll.
 # We could do so defining a new object that can be used as a placeholer
@@ -58,26 +79,45 @@ def NoIntrPoll(pollfun, timeout=-1):
         if endtime is not None:
             timeout = max(0, endtime - time.time())
 
-        # Note(luogangyi): Since native thread is replaced by eventlet,
-        # we must add sleep here to switch green thread manually.
-        greenthread.sleep(1)
-
 
 class Listener(threading.Thread):
     """
     An events driven listener which handle messages from virtual machines.
+
+    The reports parsed from the channels are pushed into `store`, a
+    GuestStateStore shared by every channel of the host.
+
+    The listener runs as a green thread. In GREEN mode it waits for the
+    epoll descriptor to become readable through the eventlet hub. In
+    NATIVE mode the epoll wait only is run on a native thread through
+    tpool, the ready descriptors being handed back to the green thread,
+    so that the callbacks, the logging and the socket I/O all stay on the
+    hub. Either way a wakeup pipe registered in epoll lets channel updates
+    and stop requests interrupt the wait at once.
     """
-    def __init__(self):
+    def __init__(self, store=None, mode=GREEN):
+        if mode not in MODES:
+            raise ValueError("Unknown listener mode %s" % mode)
         threading.Thread.__init__(self, name='VM Channels Listener')
         self.daemon = True
+        self._mode = mode
         self._quit = False
         self._epoll = select.epoll()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._epoll.register(self._wakeup_r, select.EPOLLIN)
         self._channels = {}
         self._unconnected = {}
-        self._update_lock = threading.Lock()
+        # The critical sections never yield, no logging included, so a
+        # native lock is safe for green threads.
+        self._update_lock = _native_threading.Lock()
         self._add_channels = {}
         self._del_channels = []
         self._timeout = None
+        self.store = store if store is not None else \
+            statestore.GuestStateStore()
 
     def _handle_event(self, fileno, event):
         """ Handle an epoll event occurred on a specific file descriptor. """
@@ -136,28 +176,29 @@ class Listener(threading.Thread):
                 except:
                     LOG.exception("Exception on timeout callback.")
 
-    def _do_add_channels(self):
+    def _do_add_channels(self, add_channels):
         """ Add new channels to unconnected channels list. """
-        for (fileno, obj) in self._add_channels.items():
+        for (fileno, obj) in add_channels.items():
             LOG.debug("fileno %d was added to unconnected channels.",
                            fileno)
             self._unconnected[fileno] = obj
-        self._add_channels.clear()
 
-    def _do_del_channels(self):
+    def _do_del_channels(self, del_channels):
         """ Remove requested channels from listener. """
-        for fileno in self._del_channels:
-            self._add_channels.pop(fileno, None)
+        for fileno in del_channels:
             self._unconnected.pop(fileno, None)
             self._channels.pop(fileno, None)
             LOG.debug("fileno %d was removed from listener.", fileno)
-        self._del_channels = []
 
     def _update_channels(self):
         """ Update channels list. """
+        # The requests are taken under the lock and applied out of it, as
+        # the logging may yield.
         with self._update_lock:
-            self._do_add_channels()
-            self._do_del_channels()
+            add_channels, self._add_channels = self._add_channels, {}
+            del_channels, self._del_channels = self._del_channels, []
+        self._do_add_channels(add_channels)
+        self._do_del_channels(del_channels)
 
     def _handle_unconnected(self):
         """
@@ -194,35 +235,92 @@ class Listener(threading.Thread):
                         LOG.info("fileno %d was moved into "
                                      "cooldown", fileno)
 
+    def _wakeup(self):
+        """ Interrupt the epoll wait of the listener thread. """
+        if self._wakeup_w is None:
+            # The listener has ended.
+            return
+        try:
+            os.write(self._wakeup_w, b'x')
+        except OSError as e:
+            # A full pipe already guarantees a wakeup
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _next_timeout(self):
+        """ Seconds until the listener has some work due, -1 if none. """
+        timeouts = []
+        if self._unconnected or self._add_channels:
+            timeouts.append(UNCONNECTED_RETRY_INTERVAL)
+        if self._timeout and self._channels:
+            oldest = min(obj['read_time'] for obj in self._channels.values())
+            timeouts.append(max(0, oldest + self._timeout - time.time()))
+        return min(timeouts) if timeouts else -1
+
+    def _poll(self, timeout):
+        """ Poll epoll without blocking the eventlet hub. """
+        if self._mode == NATIVE and timeout != 0:
+            return tpool.execute(self._epoll.poll, timeout)
+        if self._mode == GREEN and timeout != 0:
+            try:
+                hubs.trampoline(self._epoll.fileno(), read=True,
+                                timeout=timeout if timeout > 0 else None,
+                                timeout_exc=_PollTimeout)
+            except _PollTimeout:
+                return []
+            timeout = 0
+        return self._epoll.poll(timeout)
+
     def _wait_for_events(self):
         """ Wait for an epoll event and handle channels' timeout. """
-        events = NoIntrPoll(self._epoll.poll, 1)
+        events = NoIntrPoll(self._poll, self._next_timeout())
         for (fileno, event) in events:
-            self._handle_event(fileno, event)
-        else:
-            self._update_channels()
-            if (self._timeout is not None) and (self._timeout > 0):
-                self._handle_timeouts()
-            self._handle_unconnected()
+            if fileno == self._wakeup_r:
+                self._drain_wakeup()
+            else:
+                self._handle_event(fileno, event)
+        self._update_channels()
+        if (self._timeout is not None) and (self._timeout > 0):
+            self._handle_timeouts()
+        self._handle_unconnected()
 
     def run(self):
         """ The listener thread's function. """
-        LOG.info("Starting VM channels listener thread.")
+        LOG.info("Starting VM channels listener thread (%s mode).",
+                 self._mode)
         self._quit = False
         try:
             while not self._quit:
                 self._wait_for_events()
-                # Note(luogangyi): Since native thread is replaced by eventlet,
-                # we must add sleep here to switch green thread manually.
-                greenthread.sleep(1)
         except:
             LOG.exception("Unhandled exception caught in vm channels "
                                "listener thread")
+        finally:
+            self._close_wakeup()
         LOG.info("VM channels listener thread has ended.")
 
+    def _close_wakeup(self):
+        wakeup_r, wakeup_w = self._wakeup_r, self._wakeup_w
+        self._wakeup_r = self._wakeup_w = None
+        try:
+            self._epoll.unregister(wakeup_r)
+        except (IOError, OSError, ValueError):
+            pass
+        os.close(wakeup_r)
+        os.close(wakeup_w)
+
     def stop(self):
         """" Stop the listener execution. """
         self._quit = True
+        self._wakeup()
         LOG.info("VM channels listener was stopped.")
 
     def settimeout(self, seconds):
@@ -242,11 +340,20 @@ class Listener(threading.Thread):
                 'opaque': opaque, 'create_cb': create_callback,
                 'read_time': 0.0,
             }
+        self._wakeup()
+
+    def report(self, name, kind, value):
+        """ Push a report parsed from the channel of a guest to the store. """
+        try:
+            self.store.update(name, kind, value)
+        except Exception:
+            LOG.exception("Failed to store %s report of %s.", kind, name)
 
     def unregister(self, fileno):
         """ Unregister an exist file descriptor from the listener. """
         LOG.debug("Delete fileno %d from listener.", fileno)
         with self._update_lock:
             self._del_channels.append(fileno)
+        self._wakeup()
 
 
@@ -22,6 +22,7 @@ import threading
 import time
 import select
 import errno
+from ceilometer.compute.virt.ovirtga import statestore
 from ceilometer.openstack.common import log
 from eventlet import greenthread
 
@@ -66,8 +67,11 @@ def NoIntrPoll(pollfun, timeout=-1):
 class Listener():
     """
     An events driven listener which handle messages from virtual machines.
+
+    The reports parsed from the channels are pushed into `store`, a
+    GuestStateStore shared by every channel of the host.
     """
-    def __init__(self):
+    def __init__(self, store=None):
         #threading.Thread.__init__(self, name='VM Channels Listener')
         self._quit = False
         self._epoll = select.epoll()
@@ -77,6 +81,8 @@ class Listener():
         self._add_channels = {}
         self._del_channels = []
         self._timeout = None
+        self.store = store if store is not None else \
+            statestore.GuestStateStore()
 
     def _handle_event(self, fileno, event):
         """ Handle an epoll event occurred on a specific file descriptor. """
@@ -242,6 +248,13 @@ class Listener():
                 'read_time': 0.0,
             }
 
+    def report(self, name, kind, value):
+        """ Push a report parsed from the channel of a guest to the store. """
+        try:
+            self.store.update(name, kind, value)
+        except Exception:
+            LOG.exception("Failed to store %s report of %s.", kind, name)
+
     def unregister(self, fileno):
         """ Unregister an exist file descriptor from the listener. """
         LOG.debug("Delete fileno %d from listener.", fileno)
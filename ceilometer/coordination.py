@@ -15,12 +15,15 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+import time
 import uuid
 
 from oslo.config import cfg
+from oslo.serialization import jsonutils
 import tooz.coordination
 
-from ceilometer.openstack.common.gettextutils import _LE, _LI
+from ceilometer.openstack.common.gettextutils import _LE, _LI, _LW
 from ceilometer.openstack.common import log
 from ceilometer import utils
 
@@ -37,10 +40,70 @@ OPTS = [
     cfg.FloatOpt('heartbeat',
                  default=1.0,
                  help='Number of seconds between heartbeats for distributed '
-                      'coordination (float)')
+                      'coordination (float)'),
+    cfg.FloatOpt('weight',
+                 default=1.0,
+                 help='Share of the partitioned workload taken by this '
+                      'agent, relative to the other members of its groups. '
+                      'An agent of weight 2 is assigned twice as many '
+                      'objects as an agent of weight 1 (float)'),
+    cfg.StrOpt('hash_function',
+               default='md5',
+               choices=utils.HashRing.HASH_FUNCTIONS,
+               help='Hash function of the ring partitioning the workload. '
+                    'md5 assigns the objects as the previous releases did. '
+                    'crc32 is faster and spreads the objects more evenly, '
+                    'but assigns them differently, so all the agents of a '
+                    'group must be switched to it at once.'),
+    cfg.IntOpt('max_state_size',
+               default=65536,
+               help='Maximum size in bytes, serialized to JSON, of the '
+                    'transformer state handed over through the coordination '
+                    'backend when objects move to other agents. A larger '
+                    'state is kept by the agent losing the objects.'),
 ]
 cfg.CONF.register_opts(OPTS, group='coordination')
 
+# Number of seconds after a membership change during which the objects
+# partitioned are compared with their assignment before the change.
+REBALANCE_WINDOW = 600
+
+# Number of memoized assignments of a group above which they are dropped.
+MAX_ASSIGNMENTS = 100000
+
+
+# Named tuple representing the objects moved by a membership change.
+#
+# group_id: the group whose membership changed
+# gained: the objects now assigned to this agent
+# lost: the objects no longer assigned to this agent
+#
+Rebalance = collections.namedtuple('Rebalance',
+                                   ['group_id', 'gained', 'lost'])
+
+
+def _make_ring(members, weights):
+    return utils.HashRing(
+        members, weights=weights,
+        hash_function=cfg.CONF.coordination.hash_function)
+
+
+class _GroupRing(object):
+    """The hash ring of a group, with the one before the last change."""
+
+    __slots__ = ('members', 'ring', 'assigned', 'previous', 'changed_at',
+                 'compared')
+
+    def __init__(self, members, previous=None, weights=None):
+        self.members = frozenset(members)
+        self.ring = _make_ring(members, weights)
+        # Node of the objects partitioned with this ring, by key.
+        self.assigned = {}
+        self.previous = previous
+        self.changed_at = time.time()
+        # Keys of the objects already compared with the previous ring.
+        self.compared = set()
+
 
 class PartitionCoordinator(object):
     """Workload partitioning coordinator.
@@ -60,7 +123,25 @@ class PartitionCoordinator(object):
         self._coordinator = None
         self._groups = set()
         self._my_id = my_id or str(uuid.uuid4())
+        self._weight = cfg.CONF.coordination.weight
         self._started = False
+        # The members of the groups whose membership changes are watched,
+        # dropped when they change.
+        self._members = {}
+        self._watched = set()
+        # Whether the backend can run the membership watchers.
+        self._can_watch = True
+        # The weight of the members of each group, fetched once per member.
+        self._weights = {}
+        # The serial number and state published by this agent, and the
+        # serial number of the state of the members taken over, by group.
+        self._states = {}
+        self._acks = {}
+        # The _GroupRing of each group.
+        self._rings = {}
+        self._rebalance_listeners = []
+        # The last Rebalance of each group.
+        self.rebalances = {}
 
     def start(self):
         backend_url = cfg.CONF.coordination.backend_url
@@ -70,6 +151,9 @@ class PartitionCoordinator(object):
                     backend_url, self._my_id)
                 self._coordinator.start()
                 self._started = True
+                # Membership changes may have been missed while away.
+                self._members.clear()
+                self._watched.clear()
                 LOG.info(_LI('Coordination backend started successfully.'))
             except tooz.coordination.ToozError:
                 self._started = False
@@ -88,13 +172,51 @@ class PartitionCoordinator(object):
             except tooz.coordination.ToozError:
                 LOG.exception(_LE('Error sending a heartbeat to coordination '
                                   'backend.'))
+            if self._watched:
+                self._run_watchers()
+
+    def _run_watchers(self):
+        try:
+            self._coordinator.run_watchers()
+        except NotImplementedError:
+            LOG.info(_LI('The coordination backend does not report the '
+                         'membership changes, the members of the groups '
+                         'are read every time.'))
+            self._can_watch = False
+            self._members.clear()
+            self._watched.clear()
+        except tooz.coordination.ToozError:
+            LOG.exception(_LE('Error getting the group membership changes '
+                              'from coordination backend.'))
+            self._members.clear()
+            self._watched.clear()
+
+    def _watch_group(self, group_id):
+        """Watch the membership changes of a group, if the backend can."""
+        try:
+            self._coordinator.watch_join_group(group_id,
+                                               self._on_membership_change)
+            self._coordinator.watch_leave_group(group_id,
+                                                self._on_membership_change)
+        except NotImplementedError:
+            return
+        except tooz.coordination.ToozError:
+            LOG.exception(_LE('Error watching the membership of group %s.'),
+                          group_id)
+            return
+        self._watched.add(group_id)
+
+    def _on_membership_change(self, event):
+        LOG.debug('Membership of group %s changed', event.group_id)
+        self._members.pop(event.group_id, None)
 
     def join_group(self, group_id):
         if not self._coordinator or not self._started or not group_id:
             return
         while True:
             try:
-                join_req = self._coordinator.join_group(group_id)
+                join_req = self._coordinator.join_group(
+                    group_id, capabilities=self._capabilities(group_id))
                 join_req.get()
                 LOG.info(_LI('Joined partitioning group %s'), group_id)
                 break
@@ -112,12 +234,226 @@ class PartitionCoordinator(object):
         if not self._coordinator:
             return [self._my_id]
 
+        if group_id in self._members:
+            return self._members[group_id]
+        if self._can_watch and group_id not in self._watched:
+            self._watch_group(group_id)
         while True:
             get_members_req = self._coordinator.get_members(group_id)
             try:
-                return get_members_req.get()
+                members = get_members_req.get()
+                break
             except tooz.coordination.GroupNotCreated:
                 self.join_group(group_id)
+        if group_id in self._watched:
+            self._members[group_id] = members
+        return members
+
+    def _capabilities(self, group_id):
+        """Return the capabilities published as a member of a group."""
+        capabilities = {'weight': self._weight}
+        serial, state = self._states.get(group_id, (0, None))
+        if state is not None:
+            capabilities['serial'] = serial
+            capabilities['state'] = state
+        if self._acks.get(group_id):
+            capabilities['acks'] = self._acks[group_id]
+        return capabilities
+
+    def _update_capabilities(self, group_id):
+        try:
+            self._coordinator.update_capabilities(
+                group_id, self._capabilities(group_id)).get()
+            return True
+        except tooz.coordination.ToozError:
+            LOG.exception(_LE('Error updating the capabilities of this '
+                              'member of group %s.'), group_id)
+            return False
+
+    def _get_member_capabilities(self, group_id, member):
+        capabilities = self._coordinator.get_member_capabilities(
+            group_id, member).get()
+        return capabilities if isinstance(capabilities, dict) else {}
+
+    def _get_weights(self, group_id, members):
+        """Return the weights of the members of a group differing from 1.
+
+        The weight of a member is only fetched the first time it is seen.
+        The members which did not publish a weight, such as the agents of
+        older releases, have a weight of 1.
+        """
+        known = self._weights.setdefault(group_id, {})
+        for member in [m for m in known if m not in members]:
+            del known[member]
+        known[self._my_id] = self._weight
+        for member in members:
+            if member in known:
+                continue
+            try:
+                weight = self._get_member_capabilities(
+                    group_id, member).get('weight')
+            except NotImplementedError:
+                return {}
+            except tooz.coordination.ToozError:
+                LOG.exception(_LE('Error fetching the weight of member '
+                                  '%(member)s of group %(group)s.'),
+                              {'member': member, 'group': group_id})
+                continue
+            known[member] = 1.0 if weight is None else float(weight)
+        return dict((m, w) for m, w in known.items()
+                    if m in members and w != 1)
+
+    def _get_ring(self, group_id, members):
+        """Return the hash ring of a group, built once per membership."""
+        group = self._rings.get(group_id)
+        if group is None or group.members != frozenset(members):
+            LOG.debug('Members of group %(group)s: %(members)s',
+                      {'group': group_id, 'members': members})
+            weights = (self._get_weights(group_id, members)
+                       if self._coordinator else None)
+            if group is not None:
+                previous = group.ring if group.assigned else None
+            elif len(members) > 1 and self._my_id in members:
+                # Joining a group, the objects were assigned to the others.
+                previous = _make_ring(
+                    [m for m in members if m != self._my_id], weights)
+            else:
+                previous = None
+            group = _GroupRing(members, previous, weights)
+            self._rings[group_id] = group
+        return group
+
+    def watch_rebalance(self, callback):
+        """Call back with a Rebalance when objects move to or from us.
+
+        The objects moved by a membership change are only known once
+        partitioned again, so the callback is called from
+        extract_my_subset, possibly several times per change.
+        """
+        self._rebalance_listeners.append(callback)
+
+    def _compare(self, group_id, group, values, keys, nodes):
+        """Report the objects assigned differently by the previous ring."""
+        if time.time() - group.changed_at > REBALANCE_WINDOW:
+            group.previous = None
+            group.compared = set()
+            return
+        new = [(v, k, n) for v, k, n in zip(values, keys, nodes)
+               if k not in group.compared]
+        if not new:
+            return
+        before = group.previous.get_nodes([k for v, k, n in new])
+        group.compared.update(k for v, k, n in new)
+        gained = [v for (v, k, n), b in zip(new, before)
+                  if n == self._my_id and b != self._my_id]
+        lost = [v for (v, k, n), b in zip(new, before)
+                if b == self._my_id and n != self._my_id]
+        if not gained and not lost:
+            return
+        LOG.info(_LI('Rebalance of group %(group)s: %(gained)d gained, '
+                     '%(lost)d lost'),
+                 {'group': group_id, 'gained': len(gained),
+                  'lost': len(lost)})
+        rebalance = Rebalance(group_id, gained, lost)
+        self.rebalances[group_id] = rebalance
+        for callback in self._rebalance_listeners:
+            try:
+                callback(rebalance)
+            except Exception:
+                LOG.exception(_LE('Error handling the rebalance of group '
+                                  '%s.'), group_id)
+
+    def publish_state(self, group_id, state):
+        """Publish state for the other members of a group to fetch.
+
+        The state is published as the capabilities of this member, along
+        with its weight and a serial number, and replaces the previously
+        published state. As the backends limit the size of the
+        capabilities, a state larger than max_state_size is not published.
+
+        :param state: a JSON serializable state, None to withdraw it
+        :return: the serial number of the state, None if not published
+        """
+        if not self._coordinator or group_id not in self._groups:
+            return None
+        size = len(jsonutils.dumps(state))
+        if size > cfg.CONF.coordination.max_state_size:
+            LOG.warn(_LW('State of %(size)d bytes too large to be published '
+                         'to group %(group)s.'),
+                     {'size': size, 'group': group_id})
+            return None
+        serial = self._states.get(group_id, (0, None))[0] + 1
+        self._states[group_id] = (serial, state)
+        if not self._update_capabilities(group_id):
+            return None
+        return serial
+
+    def fetch_state(self, group_id):
+        """Return the state published by the other members of a group.
+
+        :return: a list of (member, serial number, state)
+        """
+        if not self._coordinator:
+            return []
+        states = []
+        try:
+            for member in self._get_members(group_id):
+                if member == self._my_id:
+                    continue
+                capabilities = self._get_member_capabilities(group_id,
+                                                             member)
+                if capabilities.get('state'):
+                    states.append((member, capabilities.get('serial'),
+                                   capabilities['state']))
+        except tooz.coordination.ToozError:
+            LOG.exception(_LE('Error fetching state from group %s.'),
+                          group_id)
+        return states
+
+    def acknowledge_state(self, group_id, member, serial):
+        """Tell a member of a group its state was taken over."""
+        if not self._coordinator or group_id not in self._groups:
+            return
+        acks = self._acks.setdefault(group_id, {})
+        if acks.get(member) == serial:
+            return
+        acks[member] = serial
+        group = self._rings.get(group_id)
+        if group is not None:
+            for gone in [m for m in acks if m not in group.members]:
+                del acks[gone]
+        self._update_capabilities(group_id)
+
+    def state_acknowledged(self, group_id, serial, members):
+        """Return whether members of a group took a published state over.
+
+        :param serial: the serial number returned by publish_state
+        :param members: the members which must have acknowledged it
+        """
+        if not self._coordinator:
+            return False
+        try:
+            for member in members:
+                if member == self._my_id:
+                    continue
+                acks = self._get_member_capabilities(group_id,
+                                                     member).get('acks')
+                if not acks or (acks.get(self._my_id) or 0) < serial:
+                    return False
+        except tooz.coordination.ToozError:
+            LOG.exception(_LE('Error fetching state acknowledgements from '
+                              'group %s.'), group_id)
+            return False
+        return True
+
+    def get_owners(self, group_id, iterable):
+        """Return the members the objects are currently assigned to."""
+        group = self._rings.get(group_id)
+        if group is None:
+            return set()
+        keys = [str(v) for v in iterable]
+        return set(group.assigned[k] if k in group.assigned
+                   else group.ring.get_node(k) for k in keys)
 
     def extract_my_subset(self, group_id, iterable):
         """Filters an iterable, returning only objects assigned to this agent.
@@ -132,10 +468,19 @@ class PartitionCoordinator(object):
             self.join_group(group_id)
         try:
             members = self._get_members(group_id)
-            LOG.debug('Members of group: %s', members)
-            hr = utils.HashRing(members)
-            filtered = [v for v in iterable
-                        if hr.get_node(str(v)) == self._my_id]
+            group = self._get_ring(group_id, members)
+            if len(group.assigned) > MAX_ASSIGNMENTS:
+                group.assigned.clear()
+            assigned = group.assigned
+            values = list(iterable)
+            keys = [str(v) for v in values]
+            missing = [k for k in keys if k not in assigned]
+            assigned.update(zip(missing, group.ring.get_nodes(missing)))
+            nodes = [assigned[k] for k in keys]
+            if group.previous is not None:
+                self._compare(group_id, group, values, keys, nodes)
+            filtered = [v for v, n in zip(values, nodes)
+                        if n == self._my_id]
             LOG.debug('My subset: %s', filtered)
             return filtered
         except tooz.coordination.ToozError:
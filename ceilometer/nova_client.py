@@ -14,6 +14,7 @@
 # under the License.
 
 import functools
+import time
 
 import novaclient
 from novaclient.v1_1 import client as nova_client
@@ -26,6 +27,11 @@ nova_opts = [
     cfg.BoolOpt('nova_http_log_debug',
                 default=False,
                 help='Allow novaclient\'s debug log output.'),
+    cfg.IntOpt('nova_lookup_cache_ttl',
+               default=3600,
+               help='Number of seconds the flavors and images looked up '
+                    'for the instances are cached for, 0 caches them only '
+                    'for the listing they are looked up for.'),
 ]
 
 service_types_opts = [
@@ -78,26 +84,46 @@ class Client(object):
             timeout=cfg.CONF.http_timeout,
             http_log_debug=cfg.CONF.nova_http_log_debug,
             no_cache=True)
+        # The flavors and images, by id, with the time they expire at.
+        self._flavors = {}
+        self._images = {}
+
+    @staticmethod
+    def _lookup(cache, key, get, now):
+        """Return a cached flavor or image, getting it if expired.
+
+        An entry expires nova_lookup_cache_ttl seconds after being got, so
+        with a ttl of 0 it is still shared by the instances of a listing.
+        """
+        expiry, value = cache.get(key, (None, None))
+        if expiry is None or expiry < now:
+            try:
+                value = get(key)
+            except novaclient.exceptions.NotFound:
+                value = None
+            cache[key] = (now + cfg.CONF.nova_lookup_cache_ttl, value)
+        return value
+
+    @staticmethod
+    def _prune(cache, now):
+        for key, (expiry, value) in list(cache.items()):
+            if expiry < now:
+                del cache[key]
 
     def _with_flavor_and_image(self, instances):
-        flavor_cache = {}
-        image_cache = {}
+        now = time.time()
+        self._prune(self._flavors, now)
+        self._prune(self._images, now)
         for instance in instances:
-            self._with_flavor(instance, flavor_cache)
-            self._with_image(instance, image_cache)
+            self._with_flavor(instance, now)
+            self._with_image(instance, now)
 
         return instances
 
-    def _with_flavor(self, instance, cache):
+    def _with_flavor(self, instance, now):
         fid = instance.flavor['id']
-        if fid in cache:
-            flavor = cache.get(fid)
-        else:
-            try:
-                flavor = self.nova_client.flavors.get(fid)
-            except novaclient.exceptions.NotFound:
-                flavor = None
-            cache[fid] = flavor
+        flavor = self._lookup(self._flavors, fid,
+                              self.nova_client.flavors.get, now)
 
         attr_defaults = [('name', 'unknown-id-%s' % fid),
                          ('vcpus', 0), ('ram', 0), ('disk', 0),
@@ -109,7 +135,7 @@ class Client(object):
                 continue
             instance.flavor[attr] = getattr(flavor, attr, default)
 
-    def _with_image(self, instance, cache):
+    def _with_image(self, instance, now):
         try:
             iid = instance.image['id']
         except TypeError:
@@ -118,14 +144,8 @@ class Client(object):
             instance.ramdisk_id = None
             return
 
-        if iid in cache:
-            image = cache.get(iid)
-        else:
-            try:
-                image = self.nova_client.images.get(iid)
-            except novaclient.exceptions.NotFound:
-                image = None
-            cache[iid] = image
+        image = self._lookup(self._images, iid,
+                             self.nova_client.images.get, now)
 
         attr_defaults = [('kernel_id', None),
                          ('ramdisk_id', None)]
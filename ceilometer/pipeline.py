@@ -18,9 +18,10 @@
 # under the License.
 
 import fnmatch
-import itertools
+import logging
 import operator
 import os
+import re
 
 from oslo.config import cfg
 import yaml
@@ -43,6 +44,24 @@ cfg.CONF.register_opts(OPTS)
 LOG = log.getLogger(__name__)
 
 
+def get_ordereddict():
+    """A fix for py26 not having ordereddict."""
+    try:
+        import collections
+        return collections.OrderedDict
+    except AttributeError:
+        import ordereddict
+        return ordereddict.OrderedDict
+
+OrderedDict = get_ordereddict()
+
+# Number of meter names whose routing is memoized, above which the memo
+# is dropped.
+MAX_ROUTES = 10000
+
+_WILDCARD = re.compile(r'[*?[]')
+
+
 class PipelineException(Exception):
     def __init__(self, message, pipeline_cfg):
         self.msg = message
@@ -54,19 +73,46 @@ class PipelineException(Exception):
 
 class PublishContext(object):
 
-    def __init__(self, context, pipelines=None):
+    def __init__(self, context, pipelines=None, route=None):
         pipelines = pipelines or []
         self.pipelines = set(pipelines)
         self.context = context
+        # Returns the pipelines supporting a meter name, by default
+        # memoized here for the pipelines of this context.
+        self._route = route or self._pipelines_for
+        self._routes = {}
 
     def add_pipelines(self, pipelines):
         self.pipelines.update(pipelines)
+        self._routes.clear()
+
+    def _pipelines_for(self, meter_name):
+        try:
+            return self._routes[meter_name]
+        except KeyError:
+            pass
+        pipelines = tuple(p for p in self.pipelines
+                          if p.support_meter(meter_name))
+        if len(self._routes) >= MAX_ROUTES:
+            self._routes.clear()
+        self._routes[meter_name] = pipelines
+        return pipelines
 
     def __enter__(self):
         def p(samples):
-            for p in self.pipelines:
-                p.publish_samples(self.context,
-                                  samples)
+            # Each pipeline is only handed the samples it supports, the
+            # pipelines of a meter being looked up once per meter name.
+            routes = {}
+            routed = OrderedDict()
+            for s in samples:
+                try:
+                    pipelines = routes[s.name]
+                except KeyError:
+                    pipelines = routes[s.name] = self._route(s.name)
+                for pipeline in pipelines:
+                    routed.setdefault(pipeline, []).append(s)
+            for pipeline, supported in routed.items():
+                pipeline.publish_supported_samples(self.context, supported)
         return p
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -109,6 +155,7 @@ class Source(object):
         if not isinstance(self.discovery, list):
             raise PipelineException("Discovery should be a list", cfg)
         self._check_meters()
+        self._compile_meters()
 
     def __str__(self):
         return self.name
@@ -148,26 +195,58 @@ class Source(object):
         else:
             return name
 
-    def support_meter(self, meter_name):
-        meter_name = self._variable_meter_name(meter_name)
-
+    @staticmethod
+    def _compile_patterns(patterns):
+        """Split meter patterns into exact names and one wildcard regex."""
+        exact = frozenset(p for p in patterns if not _WILDCARD.search(p))
+        regexes = []
+        for pattern in patterns:
+            if pattern not in exact:
+                regex = fnmatch.translate(pattern)
+                # Python 2 appends the flags, which can only be global.
+                if regex.endswith('(?ms)'):
+                    regex = regex[:-len('(?ms)')]
+                regexes.append(regex)
+        regex = (re.compile('|'.join('(?:%s)' % r for r in regexes),
+                            re.DOTALL)
+                 if regexes else None)
+        return exact, regex
+
+    def _compile_meters(self):
         # Special case: if we only have negation, we suppose the default is
         # allow
-        default = all(meter.startswith('!') for meter in self.meters)
+        self._default = all(meter.startswith('!') for meter in self.meters)
+        self._included = self._compile_patterns(
+            [meter for meter in self.meters if meter[0] != '!'])
+        self._excluded = self._compile_patterns(
+            [meter[1:] for meter in self.meters if meter[0] == '!'])
+        self._supported = {}
+
+    @staticmethod
+    def _match(meter_name, compiled):
+        exact, regex = compiled
+        return meter_name in exact or bool(regex and regex.match(meter_name))
+
+    def support_meter(self, meter_name):
+        meter_name = self._variable_meter_name(meter_name)
+        try:
+            return self._supported[meter_name]
+        except KeyError:
+            pass
 
         # Support wildcard like storage.* and !disk.*
         # Start with negation, we consider that the order is deny, allow
-        if any(fnmatch.fnmatch(meter_name, meter[1:])
-               for meter in self.meters
-               if meter[0] == '!'):
-            return False
-
-        if any(fnmatch.fnmatch(meter_name, meter)
-               for meter in self.meters
-               if meter[0] != '!'):
-            return True
+        if self._match(meter_name, self._excluded):
+            supported = False
+        elif self._match(meter_name, self._included):
+            supported = True
+        else:
+            supported = self._default
 
-        return default
+        if len(self._supported) >= MAX_ROUTES:
+            self._supported.clear()
+        self._supported[meter_name] = supported
+        return supported
 
     def check_sinks(self, sinks):
         if not self.sinks:
@@ -206,6 +285,9 @@ class Sink(object):
 
     If no transformers are included in the chain, the publishers are
     passed samples directly from the sink which are published unchanged.
+
+    When all the transformers of the chain support it, the samples are
+    passed to them in batches rather than one by one.
     """
 
     def __init__(self, cfg, transformer_manager):
@@ -233,6 +315,7 @@ class Sink(object):
                 LOG.exception(_("Unable to load publisher %s"), p)
 
         self.transformers = self._setup_transformers(cfg, transformer_manager)
+        self.batch = all(t.supports_batch for t in self.transformers)
 
     def __str__(self):
         return self.name
@@ -264,8 +347,8 @@ class Sink(object):
                 if not sample:
                     LOG.debug(_(
                         "Pipeline %(pipeline)s: Sample dropped by "
-                        "transformer %(trans)s") % ({'pipeline': self.name,
-                                                     'trans': transformer}))
+                        "transformer %(trans)s"), {'pipeline': self.name,
+                                                   'trans': transformer})
                     return
             return sample
         except Exception as err:
@@ -276,9 +359,32 @@ class Sink(object):
                                                        'smp': sample}))
             LOG.exception(err)
 
+    def _transform_samples(self, start, ctxt, samples):
+        for i, transformer in enumerate(self.transformers[start:], start):
+            try:
+                samples = transformer.handle_samples(ctxt, samples)
+            except Exception as err:
+                LOG.warning(_("Pipeline %(pipeline)s: Error from transformer "
+                              "%(trans)s for a batch of %(count)d samples, "
+                              "transforming them one by one"),
+                            {'pipeline': self.name, 'trans': transformer,
+                             'count': len(samples)})
+                LOG.exception(err)
+                return [s for s in (self._transform_sample(i, ctxt, sample)
+                                    for sample in samples) if s]
+            if not samples:
+                LOG.debug(_("Pipeline %(pipeline)s: Batch dropped by "
+                            "transformer %(trans)s"),
+                          {'pipeline': self.name, 'trans': transformer})
+                return []
+        return samples
+
     def _publish_samples(self, start, ctxt, samples):
         """Push samples into pipeline for publishing.
 
+        The samples coming out of the transformers are published in a
+        single batch per publisher.
+
         :param start: The first transformer that the sample will be injected.
                       This is mainly for flush() invocation that transformer
                       may emit samples.
@@ -287,16 +393,23 @@ class Sink(object):
 
         """
 
-        transformed_samples = []
-        for sample in samples:
-            LOG.debug(_(
-                "Pipeline %(pipeline)s: Transform sample "
-                "%(smp)s from %(trans)s transformer") % ({'pipeline': self.name,
-                                                          'smp': sample,
-                                                          'trans': start}))
-            sample = self._transform_sample(start, ctxt, sample)
-            if sample:
-                transformed_samples.append(sample)
+        if start < len(self.transformers) and self.batch:
+            transformed_samples = self._transform_samples(start, ctxt,
+                                                          list(samples))
+        elif start < len(self.transformers):
+            debug = LOG.isEnabledFor(logging.DEBUG)
+            transformed_samples = []
+            for sample in samples:
+                if debug:
+                    LOG.debug(_("Pipeline %(pipeline)s: Transform sample "
+                                "%(smp)s from %(trans)s transformer"),
+                              {'pipeline': self.name, 'smp': sample,
+                               'trans': start})
+                sample = self._transform_sample(start, ctxt, sample)
+                if sample:
+                    transformed_samples.append(sample)
+        else:
+            transformed_samples = [sample for sample in samples if sample]
 
         if transformed_samples:
             for p in self.publishers:
@@ -309,10 +422,10 @@ class Sink(object):
                                                       'pub': p}))
 
     def publish_samples(self, ctxt, samples):
-        for meter_name, samples in itertools.groupby(
-                sorted(samples, key=operator.attrgetter('name')),
-                operator.attrgetter('name')):
-            self._publish_samples(0, ctxt, samples)
+        if self.transformers:
+            # The transformers are passed the samples meter after meter.
+            samples = sorted(samples, key=operator.attrgetter('name'))
+        self._publish_samples(0, ctxt, samples)
 
     def flush(self, ctxt):
         """Flush data after all samples have been injected to pipeline."""
@@ -364,7 +477,11 @@ class Pipeline(object):
 
     def publish_samples(self, ctxt, samples):
         supported = [s for s in samples if self.source.support_meter(s.name)]
-        self.sink.publish_samples(ctxt, supported)
+        self.publish_supported_samples(ctxt, supported)
+
+    def publish_supported_samples(self, ctxt, samples):
+        """Publish samples already known to be supported by the source."""
+        self.sink.publish_samples(ctxt, samples)
 
     def flush(self, ctxt):
         self.sink.flush(ctxt)
@@ -478,6 +595,8 @@ class PipelineManager(object):
 
         """
         self.pipelines = []
+        # The pipelines supporting a meter, by meter name.
+        self._routes = {}
         if 'sources' in cfg or 'sinks' in cfg:
             if not ('sources' in cfg and 'sinks' in cfg):
                 raise PipelineException("Both sources & sinks are required",
@@ -498,12 +617,26 @@ class PipelineManager(object):
                 sink = Sink(pipedef, transformer_manager)
                 self.pipelines.append(Pipeline(source, sink))
 
+    def pipelines_for(self, meter_name):
+        """Return the pipelines supporting a meter, in definition order."""
+        try:
+            return self._routes[meter_name]
+        except KeyError:
+            pass
+        pipelines = tuple(p for p in self.pipelines
+                          if p.support_meter(meter_name))
+        if len(self._routes) >= MAX_ROUTES:
+            self._routes.clear()
+        self._routes[meter_name] = pipelines
+        return pipelines
+
     def publisher(self, context):
         """Build a new Publisher for these manager pipelines.
 
         :param context: The context.
         """
-        return PublishContext(context, self.pipelines)
+        return PublishContext(context, self.pipelines,
+                              route=self.pipelines_for)
 
 
 def setup_pipeline(transformer_manager=None):
@@ -197,3 +197,13 @@ class DiscoveryBase(object):
         of workload partitioning at all.
         """
         return 'global'
+
+    @property
+    def cache_ttl(self):
+        """Return the number of seconds the discovered resources are kept.
+
+        The resources are discovered again by the polling cycle following
+        their expiry, or following a call to the invalidate_discovery method
+        of the manager. By default they are discovered on every cycle.
+        """
+        return 0
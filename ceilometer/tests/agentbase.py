@@ -22,15 +22,19 @@
 # under the License.
 
 import abc
+import contextlib
 import copy
 import datetime
+import time
 
+import eventlet
 import mock
 from oslo.config import fixture as fixture_config
 from oslotest import mockpatch
 import six
 from stevedore import extension
 
+from ceilometer import coordination
 from ceilometer import pipeline
 from ceilometer import plugin
 from ceilometer import publisher
@@ -38,6 +42,7 @@ from ceilometer.publisher import test as test_publisher
 from ceilometer import sample
 from ceilometer.tests import base
 from ceilometer import transformer
+from ceilometer.transformer import conversions
 from ceilometer import utils
 
 
@@ -402,6 +407,125 @@ class BaseAgentManagerTestCase(base.BaseTestCase):
         pub = self.mgr.pipeline_manager.pipelines[0].publishers[0]
         self.assertEqual(0, len(pub.samples))
 
+    def test_polling_stats(self):
+        polling_tasks = self.mgr.setup_polling_tasks()
+        self.mgr.polling_tasks = polling_tasks
+        self.mgr.interval_task(polling_tasks.get(60))
+        self.mgr.interval_task(polling_tasks.get(60))
+        stats = self.mgr.polling_stats()
+        self.assertEqual([60], list(stats))
+        self.assertIsNotNone(stats[60]['last_duration'])
+        pollster_stats = stats[60]['pollsters']['test_pipeline-test']
+        self.assertEqual(2, pollster_stats['runs'])
+        self.assertEqual(2, pollster_stats['samples'])
+        self.assertEqual(0, pollster_stats['errors'])
+        self.assertEqual(0, pollster_stats['skips'])
+
+    def test_rebalance_state_handover(self):
+        def rate_transformer():
+            return conversions.RateOfChangeTransformer(
+                target={'name': 'test_rate', 'unit': '/s',
+                        'type': sample.TYPE_GAUGE})
+
+        def test_sample(resource_id, volume, timestamp):
+            s = copy.copy(default_test_data)
+            s.resource_id = resource_id
+            s.volume = volume
+            s.timestamp = timestamp
+            return s
+
+        losing = rate_transformer()
+        losing.handle_sample(None, test_sample('vm1-vda', 10,
+                                               '2015-01-01T00:00:00'))
+        losing.handle_sample(None, test_sample('vm2-vda', 10,
+                                               '2015-01-01T00:00:00'))
+        gaining = rate_transformer()
+        coordinator = mock.MagicMock()
+        coordinator.get_owners.return_value = set(['agent2'])
+        coordinator.publish_state.return_value = 1
+        coordinator.state_acknowledged.return_value = False
+        self.mgr.partition_coordinator = coordinator
+        vm1 = mock.Mock(id='vm1')
+        with mock.patch.object(self.mgr, '_transformers',
+                               return_value=[('sink:0', losing)]):
+            self.mgr._on_rebalance(coordination.Rebalance('group', [],
+                                                          [vm1]))
+            coordinator.publish_state.assert_called_once_with(
+                'group', {'sink:0': [['test', 'vm1-vda', 10,
+                                      '2015-01-01T00:00:00+00:00']]})
+            # The state is kept until the take over is acknowledged.
+            self.mgr._confirm_hand_over('group')
+            coordinator.state_acknowledged.assert_called_once_with(
+                'group', 1, set(['agent2']))
+            self.assertEqual(2, len(losing.cache))
+        state = coordinator.publish_state.call_args[0][1]
+
+        coordinator.fetch_state.return_value = [('agent1', 1, state)]
+        with mock.patch.object(self.mgr, '_transformers',
+                               return_value=[('sink:0', gaining)]):
+            self.mgr._on_rebalance(coordination.Rebalance('group', [vm1],
+                                                          []))
+            self.mgr._take_over_state('group')
+        coordinator.acknowledge_state.assert_called_once_with(
+            'group', 'agent1', 1)
+        rate = gaining.handle_sample(None, test_sample(
+            'vm1-vda', 70, '2015-01-01T00:01:00'))
+        self.assertEqual(1.0, rate.volume)
+
+        coordinator.state_acknowledged.return_value = True
+        with mock.patch.object(self.mgr, '_transformers',
+                               return_value=[('sink:0', losing)]):
+            self.mgr._confirm_hand_over('group')
+        self.assertEqual([('test', 'vm2-vda')], list(losing.cache))
+        coordinator.publish_state.assert_called_with('group', None)
+        self.assertNotIn('group', self.mgr._hand_overs)
+
+    def test_resource_matcher(self):
+        match = self.mgr._resource_matcher([mock.Mock(id='1'), 'a-b'])
+        self.assertTrue(match('1'))
+        self.assertTrue(match('1-vda'))
+        self.assertTrue(match('instance-00000001-1-tap0'))
+        self.assertTrue(match('a-b-vda'))
+        self.assertFalse(match('10'))
+        self.assertFalse(match('10-vda'))
+        self.assertFalse(match('a-bc'))
+        self.assertFalse(match(None))
+
+    def test_polling_budget(self):
+        self.pipeline_cfg[0]['counters'] = ['test', 'testanother']
+        self.setup_pipeline()
+        polling_task = self.mgr.setup_polling_tasks().get(60)
+        clock = [1000.0]
+
+        def get_samples(*args, **kwargs):
+            clock[0] += 100
+            return []
+
+        with contextlib.nested(
+                mock.patch('time.time', side_effect=lambda: clock[0]),
+                mock.patch.object(self.Pollster, 'get_samples',
+                                  side_effect=get_samples),
+                mock.patch.object(self.PollsterAnother, 'get_samples',
+                                  side_effect=get_samples)):
+            polling_task.poll_and_publish()
+            stats = polling_task.stats
+            first, second = sorted(stats, key=lambda k: stats[k].skips)
+            self.assertEqual(1, stats[first].runs)
+            self.assertTrue(stats[first].over_budget)
+            self.assertEqual(1, stats[second].skips)
+            self.assertEqual(0, stats[second].runs)
+
+            # The skipped pollster runs first in the next cycle.
+            polling_task.poll_and_publish()
+            self.assertEqual(1, stats[second].runs)
+            self.assertEqual(1, stats[first].skips)
+
+            # Without a budget, nothing is skipped.
+            self.CONF.set_override('polling_budget', 0)
+            polling_task.poll_and_publish()
+            self.assertEqual(2, stats[first].runs)
+            self.assertEqual(2, stats[second].runs)
+
     def test_agent_manager_start(self):
         mgr = self.create_manager()
         mgr.pollster_manager = self.mgr.pollster_manager
@@ -541,6 +665,71 @@ class BaseAgentManagerTestCase(base.BaseTestCase):
         self.assertEqual(discovered_resources, self.Pollster.resources)
         self.assertEqual(discovered_resources, self.PollsterAnother.resources)
 
+    def test_per_pollster_discovery_concurrent(self):
+        # concurrent pollsters wait for the discovery in progress
+        self.CONF.set_override('pollster_workers', 2)
+        discovered_resources = ['discovered_1', 'discovered_2']
+        self.Pollster.discovery = 'testdiscovery'
+        self.PollsterAnother.discovery = 'testdiscovery'
+        self.mgr.discovery_manager = self.create_discovery_manager()
+        self.Discovery.resources = discovered_resources
+        self.pipeline_cfg[0]['counters'].append('testanother')
+        self.pipeline_cfg[0]['resources'] = []
+        self.setup_pipeline()
+        polling_tasks = self.mgr.setup_polling_tasks()
+        discover = self.Discovery.discover
+
+        def slow_discover(discovery, manager, param=None):
+            eventlet.sleep(0.01)
+            return discover(discovery, manager, param)
+
+        with mock.patch.object(self.Discovery, 'discover', slow_discover):
+            self.mgr.interval_task(polling_tasks.get(60))
+        self.assertEqual(1, len(self.Discovery.params))
+        self.assertEqual(discovered_resources, self.Pollster.resources)
+        self.assertEqual(discovered_resources, self.PollsterAnother.resources)
+
+    def test_concurrent_polling_failure_logged(self):
+        self.CONF.set_override('pollster_workers', 2)
+        self.Pollster.discovery = 'testdiscovery'
+        self.PollsterAnother.discovery = 'testdiscovery'
+        self.pipeline_cfg[0]['counters'].append('testanother')
+        self.setup_pipeline()
+        polling_tasks = self.mgr.setup_polling_tasks()
+
+        def discover(discovery=None, discovery_cache=None):
+            if discovery:
+                raise RuntimeError('failed')
+            return []
+
+        with contextlib.nested(
+                mock.patch.object(self.mgr, 'discover', side_effect=discover),
+                mock.patch('ceilometer.agent.LOG')) as (_, log):
+            self.mgr.interval_task(polling_tasks.get(60))
+        self.assertEqual(2, log.exception.call_count)
+
+    def test_per_pollster_discovery_cache_ttl(self):
+        # discoveries with a cache_ttl are kept across the polling cycles
+        discovered_resources = ['discovered_1', 'discovered_2']
+        self.Pollster.discovery = 'testdiscovery'
+        self.mgr.discovery_manager = self.create_discovery_manager()
+        self.Discovery.resources = discovered_resources
+        self.pipeline_cfg[0]['resources'] = []
+        self.setup_pipeline()
+        polling_tasks = self.mgr.setup_polling_tasks()
+        with mock.patch.object(self.Discovery, 'cache_ttl', 60):
+            self.mgr.interval_task(polling_tasks.get(60))
+            self.mgr.interval_task(polling_tasks.get(60))
+            self.assertEqual(1, len(self.Discovery.params))
+            self.mgr.invalidate_discovery(
+                self.mgr._discoverer('testdiscovery'))
+            self.mgr.interval_task(polling_tasks.get(60))
+            self.assertEqual(2, len(self.Discovery.params))
+            with mock.patch('time.time', return_value=time.time() + 61):
+                self.mgr.interval_task(polling_tasks.get(60))
+            self.assertEqual(3, len(self.Discovery.params))
+        self.assertEqual(discovered_resources * 4, self.Pollster.resources)
+
     def _do_test_per_pipeline_discovery(self,
                                         discovered_resources,
                                         static_resources):
@@ -20,6 +20,8 @@
 import mock
 from oslotest import mockpatch
 
+import ceilometer
+
 import ceilometer.tests.base as base
 
 
@@ -29,6 +31,7 @@ class TestPollsterBase(base.BaseTestCase):
         super(TestPollsterBase, self).setUp()
 
         self.inspector = mock.Mock()
+        self.inspector.inspect_all.side_effect = ceilometer.NotImplementedError
         self.instance = mock.MagicMock()
         self.instance.name = 'instance-00000001'
         setattr(self.instance, 'OS-EXT-SRV-ATTR:instance_name',
@@ -42,3 +45,9 @@ class TestPollsterBase(base.BaseTestCase):
             'ceilometer.compute.virt.inspector.get_hypervisor_inspector',
             new=mock.Mock(return_value=self.inspector))
         self.useFixture(patch_virt)
+
+        self.oga_inspector = mock.Mock()
+        patch_oga = mockpatch.Patch(
+            'ceilometer.compute.virt.oga_inspector.get_oga_inspector',
+            new=mock.Mock(return_value=self.oga_inspector))
+        self.useFixture(patch_oga)
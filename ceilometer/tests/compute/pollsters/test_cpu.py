@@ -23,6 +23,7 @@ import mock
 
 from ceilometer.compute import manager
 from ceilometer.compute.pollsters import cpu
+from ceilometer.compute.pollsters import util
 from ceilometer.compute.virt import inspector as virt_inspector
 from ceilometer.tests.compute.pollsters import base
 
@@ -75,7 +76,25 @@ class TestCPUPollster(base.TestPollsterBase):
         samples = list(pollster.get_samples(mgr, cache, [self.instance]))
         self.assertEqual(1, len(samples))
         self.assertEqual(10 ** 6, samples[0].volume)
-        self.assertEqual(0, len(cache))
+        # Only the bulk statistics shared by all the pollsters are cached.
+        self.assertEqual([util.CACHE_KEY_STATS], list(cache))
+
+    @mock.patch('ceilometer.pipeline.setup_pipeline', mock.MagicMock())
+    def test_get_samples_bulk_stats(self):
+        cpu_stats = virt_inspector.CPUStats(time=5 * (10 ** 6), number=4)
+        self.inspector.inspect_all.side_effect = None
+        self.inspector.inspect_all.return_value = {
+            self.instance.name: virt_inspector.InstanceStats(
+                cpu=cpu_stats, vnics=[], disks=[], balloon=None)}
+
+        mgr = manager.AgentManager()
+        pollster = cpu.CPUPollster()
+
+        samples = list(pollster.get_samples(mgr, {}, [self.instance]))
+        self.assertEqual(1, len(samples))
+        self.assertEqual(5 * (10 ** 6), samples[0].volume)
+        self.assertEqual(4, samples[0].resource_metadata.get('cpu_number'))
+        self.assertFalse(self.inspector.inspect_cpus.called)
 
 
 class TestCPUUtilPollster(base.TestPollsterBase):
@@ -109,3 +128,14 @@ class TestCPUUtilPollster(base.TestPollsterBase):
 
         _verify_cpu_util_metering(40)
         _verify_cpu_util_metering(60)
+
+    @mock.patch('ceilometer.pipeline.setup_pipeline', mock.MagicMock())
+    def test_get_samples_no_data(self):
+        self.inspector.inspect_cpu_util = mock.Mock(
+            side_effect=virt_inspector.NoDataException('first reading'))
+        mgr = manager.AgentManager()
+        pollster = cpu.CPUUtilPollster()
+        with mock.patch.object(cpu.LOG, 'exception') as log_exception:
+            samples = list(pollster.get_samples(mgr, {}, [self.instance]))
+        self.assertEqual([], samples)
+        self.assertFalse(log_exception.called)
@@ -18,12 +18,16 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import eventlet
 import mock
+from oslo.config import fixture as fixture_config
 from oslotest import mockpatch
 
+import ceilometer
 from ceilometer.compute import manager
 from ceilometer.compute.pollsters import disk
 from ceilometer.compute.virt import inspector as virt_inspector
+from ceilometer.compute.virt.libvirt import inspector as libvirt_inspector
 import ceilometer.tests.base as base
 
 
@@ -35,6 +39,7 @@ class TestBaseDiskIO(base.BaseTestCase):
         super(TestBaseDiskIO, self).setUp()
 
         self.inspector = mock.Mock()
+        self.inspector.inspect_all.side_effect = ceilometer.NotImplementedError
         self.instance = self._get_fake_instances()
         patch_virt = mockpatch.Patch(
             'ceilometer.compute.virt.inspector.get_hypervisor_inspector',
@@ -106,6 +111,86 @@ class TestDiskPollsters(TestBaseDiskIO):
         super(TestDiskPollsters, self).setUp()
         self.inspector.inspect_disks = mock.Mock(return_value=self.DISKS)
 
+    @mock.patch('ceilometer.pipeline.setup_pipeline', mock.MagicMock())
+    def test_disk_bulk_stats(self):
+        self.inspector.inspect_all.side_effect = None
+        self.inspector.inspect_all.return_value = dict(
+            (i.name, virt_inspector.InstanceStats(cpu=None, vnics=[],
+                                                  disks=self.DISKS,
+                                                  balloon=None))
+            for i in self.instance)
+        mgr = manager.AgentManager()
+        cache = {}
+        for factory in (disk.ReadBytesPollster, disk.WriteBytesPollster):
+            samples = list(factory().get_samples(mgr, cache, self.instance))
+            self.assertEqual(2, len(samples))
+        self.assertEqual(8L, samples[0].volume)
+        self.inspector.inspect_all.assert_called_once_with(mock.ANY)
+        self.assertEqual(set(['instance-1', 'instance-2']),
+                         set(self.inspector.inspect_all.call_args[0][0]))
+        self.assertFalse(self.inspector.inspect_disks.called)
+
+    @mock.patch('ceilometer.pipeline.setup_pipeline', mock.MagicMock())
+    def test_disk_concurrent_inspection(self):
+        conf = self.useFixture(fixture_config.Config()).conf
+        conf.set_override('inspection_workers', 2, group='compute')
+        conf.set_override('inspection_timeout', 0.05, group='compute')
+
+        def inspect_disks(name):
+            if name == 'instance-1':
+                # A domain hanging in libvirt.
+                eventlet.sleep(5)
+            return self.DISKS
+
+        self.inspector.inspect_disks.side_effect = inspect_disks
+        mgr = manager.AgentManager()
+        cache = {}
+        samples = list(disk.ReadBytesPollster().get_samples(
+            mgr, cache, self.instance))
+        self.assertEqual([2], [s.resource_id for s in samples])
+        self.assertEqual(2, self.inspector.inspect_disks.call_count)
+
+        # The other pollsters reuse the results, the failure included.
+        samples = list(disk.WriteBytesPollster().get_samples(
+            mgr, cache, self.instance))
+        self.assertEqual([2], [s.resource_id for s in samples])
+        self.assertEqual(2, self.inspector.inspect_disks.call_count)
+
+    @mock.patch('ceilometer.pipeline.setup_pipeline', mock.MagicMock())
+    def test_disk_missing_from_bulk_stats(self):
+        conf = self.useFixture(fixture_config.Config()).conf
+        conf.set_override('inspection_workers', 2, group='compute')
+        conf.set_override('inspection_timeout', 0.05, group='compute')
+        libvirt = self.useFixture(mockpatch.PatchObject(
+            libvirt_inspector, 'libvirt')).mock
+        libvirt.VIR_DOMAIN_SHUTOFF = 5
+        inspector = libvirt_inspector.LibvirtInspector()
+        inspector.connection = mock.Mock()
+
+        # The bulk statistics leave out instance-1, whose domain then
+        # hangs in libvirt.
+        listed = mock.Mock()
+        listed.name.return_value = 'instance-2'
+        stats = {'state.state': 1, 'block.count': 1, 'block.0.name': 'vda',
+                 'block.0.rd.reqs': 1L, 'block.0.rd.bytes': 2L,
+                 'block.0.wr.reqs': 3L, 'block.0.wr.bytes': 4L}
+        inspector.connection.getAllDomainStats.return_value = [(listed,
+                                                                stats)]
+        hanging = mock.Mock()
+        hanging.info.side_effect = lambda: eventlet.sleep(5)
+        inspector.connection.lookupByName.return_value = hanging
+
+        with mock.patch.object(virt_inspector, 'get_hypervisor_inspector',
+                               return_value=inspector):
+            mgr = manager.AgentManager()
+        with eventlet.Timeout(2):
+            samples = list(disk.ReadBytesPollster().get_samples(
+                mgr, {}, self.instance))
+        self.assertEqual([(2, 2L)],
+                         [(s.resource_id, s.volume) for s in samples])
+        inspector.connection.lookupByName.assert_called_once_with(
+            'instance-1')
+
     @mock.patch('ceilometer.pipeline.setup_pipeline', mock.MagicMock())
     def _check_get_samples(self, factory, name, expected_count=2):
         pollster = factory()
@@ -113,3 +113,45 @@ class TestLocationMetadata(base.BaseTestCase):
         md = util._get_metadata_from_object(self.instance)
         self.assertEqual(1, md['image_ref'])
         self.assertIsNone(md['image_ref_url'])
+
+
+class TestSharedMetadata(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestSharedMetadata, self).setUp()
+        self.instance = FauxInstance(
+            id='uuid-1', name='display name', user_id='user',
+            tenant_id='project', hostId='1234-5678', status='active',
+            image=None, metadata={},
+            flavor={'id': 1, 'disk': 20, 'ram': 512, 'vcpus': 2,
+                    'ephemeral': 0})
+        setattr(self.instance, 'OS-EXT-SRV-ATTR:instance_name',
+                'instance-000001')
+
+    def test_metadata_built_once(self):
+        with mock.patch.object(util, '_get_metadata_from_object',
+                               wraps=util._get_metadata_from_object) as get:
+            first = util.make_sample_from_instance(
+                self.instance, name='cpu', type='cumulative', unit='ns',
+                volume=1)
+            second = util.make_sample_from_instance(
+                self.instance, name='vcpus', type='gauge', unit='vcpu',
+                volume=2)
+            extra = util.make_sample_from_instance(
+                self.instance, name='cpu', type='cumulative', unit='ns',
+                volume=1, additional_metadata={'cpu_number': 2})
+        self.assertEqual(1, get.call_count)
+        self.assertIs(first.resource_metadata, second.resource_metadata)
+        self.assertEqual(2, extra.resource_metadata['cpu_number'])
+        self.assertNotIn('cpu_number', first.resource_metadata)
+
+    def test_metadata_rebuilt_on_change(self):
+        first = util.get_metadata(self.instance)
+        self.assertIs(first, util.get_metadata(self.instance))
+        # Resized while kept by the discovery.
+        self.instance.flavor = dict(self.instance.flavor, id=2, vcpus=4)
+        second = util.get_metadata(self.instance)
+        self.assertEqual(2, second['instance_type'])
+        self.assertEqual(4, second['vcpus'])
+        self.instance.status = 'paused'
+        self.assertEqual('paused', util.get_metadata(self.instance)['status'])
@@ -18,6 +18,7 @@ import mock
 from ceilometer.compute import manager
 from ceilometer.compute.pollsters import memory
 from ceilometer.compute.virt import inspector as virt_inspector
+from ceilometer.compute.virt import oga_inspector
 from ceilometer.tests.compute.pollsters import base
 
 
@@ -52,3 +53,60 @@ class TestMemoryPollster(base.TestPollsterBase):
 
         _verify_memory_metering(1.0)
         _verify_memory_metering(2.0)
+
+
+class TestGuestMemoryPollster(base.TestPollsterBase):
+
+    GUEST_INFO = oga_inspector.GuestInfo(
+        mem_total=2097152, mem_unused=1048576, mem_cached=None,
+        mem_swap=524288, mem_buffer=0, disk_usage=None, sys_info=())
+
+    def setUp(self):
+        super(TestGuestMemoryPollster, self).setUp()
+        self.oga_inspector.inspect_guest = mock.Mock(
+            return_value=self.GUEST_INFO)
+
+    @mock.patch('ceilometer.pipeline.setup_pipeline', mock.MagicMock())
+    def _check_get_samples(self, factory, name, expected_volume):
+        mgr = manager.AgentManager()
+        pollster = factory()
+        samples = list(pollster.get_samples(mgr, {}, [self.instance]))
+        self.assertEqual(1, len(samples))
+        self.assertEqual(name, samples[0].name)
+        self.assertEqual(expected_volume, samples[0].volume)
+
+    def test_memory_total(self):
+        self._check_get_samples(memory.MemoryTotalPollster,
+                                'memory.total', 2048)
+
+    def test_memory_unused(self):
+        self._check_get_samples(memory.MemoryUnusedPollster,
+                                'memory.unused', 1024)
+
+    def test_memory_swap(self):
+        self._check_get_samples(memory.MemorySwapPollster,
+                                'memory.swap', 512)
+
+    def test_memory_buffer(self):
+        self._check_get_samples(memory.MemoryBufferPollster,
+                                'memory.buffer', 0)
+
+    @mock.patch('ceilometer.pipeline.setup_pipeline', mock.MagicMock())
+    def test_memory_cached_not_reported(self):
+        mgr = manager.AgentManager()
+        pollster = memory.MemoryCachedPollster()
+        samples = list(pollster.get_samples(mgr, {}, [self.instance]))
+        self.assertEqual([], samples)
+
+    @mock.patch('ceilometer.pipeline.setup_pipeline', mock.MagicMock())
+    def test_snapshot_shared_through_cache(self):
+        mgr = manager.AgentManager()
+        cache = {}
+        for factory in (memory.MemoryTotalPollster,
+                        memory.MemoryUnusedPollster,
+                        memory.MemorySwapPollster,
+                        memory.MemoryBufferPollster,
+                        memory.MemoryCachedPollster):
+            list(factory().get_samples(mgr, cache, [self.instance]))
+        self.oga_inspector.inspect_guest.assert_called_once_with(
+            self.instance.name)
@@ -0,0 +1,156 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/compute/discovery.py
+"""
+
+import time
+
+from lxml import etree
+import mock
+from oslo.config import fixture as fixture_config
+from oslotest import base
+
+from ceilometer.compute import discovery
+from ceilometer.compute.pollsters import util
+from ceilometer.compute.virt import inspector as virt_inspector
+
+NOVA_METADATA = """
+<nova:instance xmlns:nova="http://openstack.org/xmlns/libvirt/nova/1.0">
+  <nova:package version="2014.2.3"/>
+  <nova:name>test-vm</nova:name>
+  <nova:creationTime>2015-04-21 12:00:00</nova:creationTime>
+  <nova:flavor name="m1.tiny">
+    <nova:memory>512</nova:memory>
+    <nova:disk>1</nova:disk>
+    <nova:swap>0</nova:swap>
+    <nova:ephemeral>0</nova:ephemeral>
+    <nova:vcpus>1</nova:vcpus>
+  </nova:flavor>
+  <nova:owner>
+    <nova:user uuid="user-id">admin</nova:user>
+    <nova:project uuid="project-id">admin</nova:project>
+  </nova:owner>
+  <nova:root type="image" uuid="image-id"/>
+</nova:instance>
+"""
+
+
+class TestInstanceDiscovery(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestInstanceDiscovery, self).setUp()
+        self.CONF = self.useFixture(fixture_config.Config()).conf
+        self.CONF.set_override('host', 'compute-1')
+        self.CONF.set_override('instance_discovery_method',
+                               'libvirt_metadata', group='compute')
+        with mock.patch('ceilometer.nova_client.Client'):
+            self.discovery = discovery.InstanceDiscovery()
+        self.nova_cli = self.discovery.nova_cli
+        self.manager = mock.Mock()
+        self.manager.inspector.inspect_instances_metadata.return_value = [
+            (virt_inspector.Instance(name='instance-00000001', UUID='uuid'),
+             etree.fromstring(NOVA_METADATA)),
+            (virt_inspector.Instance(name='not-nova', UUID='uuid-2'), None),
+        ]
+        self.spawn_n = mock.patch('eventlet.spawn_n').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_discover_naive(self):
+        self.CONF.set_override('instance_discovery_method', 'naive',
+                               group='compute')
+        server = mock.Mock()
+        self.nova_cli.instance_get_all_by_host.return_value = [server]
+        self.assertEqual([server], self.discovery.discover(self.manager))
+        self.nova_cli.instance_get_all_by_host.assert_called_once_with(
+            'compute-1')
+        self.assertFalse(
+            self.manager.inspector.inspect_instances_metadata.called)
+
+    def test_discover_libvirt_metadata(self):
+        instances = self.discovery.discover(self.manager)
+        self.assertEqual(1, len(instances))
+        instance = instances[0]
+        self.assertEqual('uuid', instance.id)
+        self.assertEqual('test-vm', instance.name)
+        self.assertEqual('instance-00000001',
+                         getattr(instance, 'OS-EXT-SRV-ATTR:instance_name'))
+        self.assertEqual('project-id', instance.tenant_id)
+        self.assertEqual('user-id', instance.user_id)
+        self.assertEqual({'id': None, 'name': 'm1.tiny', 'vcpus': 1,
+                          'ram': 512, 'disk': 1, 'ephemeral': 0},
+                         instance.flavor)
+        self.assertEqual({'id': 'image-id'}, instance.image)
+        metadata = util.get_metadata(instance)
+        self.assertEqual('active', metadata['status'])
+        self.assertEqual(1, metadata['root_gb'])
+        # The Nova API is only listed in the background.
+        self.assertFalse(self.nova_cli.instance_get_all_by_host.called)
+        self.spawn_n.assert_called_once_with(self.discovery._reconcile)
+
+    def test_discover_libvirt_metadata_invalid(self):
+        self.manager.inspector.inspect_instances_metadata.return_value = [
+            (virt_inspector.Instance(name='instance-00000001', UUID='uuid'),
+             etree.fromstring(NOVA_METADATA.replace('nova:flavor',
+                                                    'nova:other')))]
+        self.assertEqual([], self.discovery.discover(self.manager))
+
+    def test_discover_libvirt_metadata_no_project(self):
+        self.manager.inspector.inspect_instances_metadata.return_value = [
+            (virt_inspector.Instance(name='instance-00000001', UUID='uuid'),
+             etree.fromstring(NOVA_METADATA.replace(' uuid="project-id"',
+                                                    '')))]
+        self.assertEqual([], self.discovery.discover(self.manager))
+
+    def test_discover_libvirt_metadata_empty_number(self):
+        self.manager.inspector.inspect_instances_metadata.return_value = [
+            (virt_inspector.Instance(name='instance-00000001', UUID='uuid'),
+             etree.fromstring(NOVA_METADATA.replace(
+                 '<nova:vcpus>1</nova:vcpus>', '<nova:vcpus/>')))]
+        self.assertEqual([], self.discovery.discover(self.manager))
+
+    def test_reconciliation(self):
+        server = mock.Mock(id='uuid', status='PAUSED',
+                           metadata={'metering.stack': 'stack-id'},
+                           flavor={'id': '1', 'name': 'm1.tiny'},
+                           image={'id': 'image-id', 'name': 'cirros'})
+        setattr(server, 'OS-EXT-STS:vm_state', 'paused')
+        self.nova_cli.instance_get_all_by_host.return_value = [server]
+        self.discovery.discover(self.manager)
+        self.discovery._reconcile()
+        instance = self.discovery.discover(self.manager)[0]
+        self.assertEqual('PAUSED', instance.status)
+        self.assertEqual({'metering.stack': 'stack-id'}, instance.metadata)
+        self.assertEqual('1', instance.flavor['id'])
+        self.assertEqual('cirros', instance.image['name'])
+        # The next reconciliation is not due yet.
+        self.assertEqual(1, self.spawn_n.call_count)
+        with mock.patch('time.time', return_value=time.time() + 600):
+            self.discovery.discover(self.manager)
+        self.assertEqual(2, self.spawn_n.call_count)
+
+    def test_reconciliation_unknown_instance(self):
+        self.nova_cli.instance_get_all_by_host.return_value = []
+        self.discovery.discover(self.manager)
+        self.discovery._reconcile()
+        self.discovery.discover(self.manager)
+        self.assertEqual(1, self.spawn_n.call_count)
+        with mock.patch('time.time', return_value=time.time() + 60):
+            self.discovery.discover(self.manager)
+        self.assertEqual(2, self.spawn_n.call_count)
+
+    def test_reconciliation_failure(self):
+        self.nova_cli.instance_get_all_by_host.side_effect = Exception()
+        self.discovery.discover(self.manager)
+        self.discovery._reconcile()
+        self.assertFalse(self.discovery._reconciling)
+        self.assertEqual(1, len(self.discovery.discover(self.manager)))
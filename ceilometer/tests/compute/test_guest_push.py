@@ -0,0 +1,179 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/compute/guest_push.py
+"""
+
+import eventlet
+import mock
+from oslotest import base
+from stevedore import extension
+
+from ceilometer.compute import guest_push
+from ceilometer.compute.pollsters import memory
+from ceilometer.compute.virt import oga_inspector
+from ceilometer.compute.virt.ovirtga import statestore
+
+
+def _guest_info(mem_total):
+    return oga_inspector.GuestInfo(
+        mem_total=mem_total, mem_unused=None, mem_cached=None, mem_swap=None,
+        mem_buffer=None, disk_usage=None, sys_info=())
+
+
+def _instance(flavor_id=2):
+    instance = mock.MagicMock()
+    instance.id = 'uuid-1'
+    instance.name = 'vm1'
+    setattr(instance, 'OS-EXT-SRV-ATTR:instance_name', 'instance-00000001')
+    instance.flavor = {'name': 'm1.small', 'id': flavor_id, 'vcpus': 1,
+                       'ram': 512, 'disk': 20, 'ephemeral': 0}
+    instance.image = {'id': 1, 'links': [{"rel": "bookmark", 'href': 1}]}
+    instance.metadata = {}
+    return instance
+
+
+class TestGuestReportEmitter(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestGuestReportEmitter, self).setUp()
+        self.instance = _instance()
+
+        self.store = statestore.GuestStateStore()
+        self.manager = mock.Mock()
+        self.manager.oga_inspector.store = self.store
+        self.manager.discover.return_value = [self.instance]
+        self.manager.pollster_manager = extension.ExtensionManager.\
+            make_test_instance([
+                extension.Extension('memory.total', None, None,
+                                    memory.MemoryTotalPollster()),
+                extension.Extension('memory.usage', None, None,
+                                    memory.MemoryUsagePollster()),
+            ])
+
+        self.pipeline = mock.Mock()
+        self.pipeline.support_meter.side_effect = lambda m: m != 'disk.usage'
+        self.emitter = guest_push.GuestReportEmitter(self.manager,
+                                                     min_interval=10)
+
+        self.time = 1000.0
+        patcher = mock.patch('time.time', side_effect=lambda: self.time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _report(self, mem_total):
+        version = self.store.update('instance-00000001', 'memoryStats', {})
+        self.manager.oga_inspector.inspect_guest_changes.return_value = (
+            self.store.version,
+            {'instance-00000001': _guest_info(mem_total)})
+        return version
+
+    def _published(self):
+        publish = self.pipeline.publish_supported_samples
+        return [s for call in publish.call_args_list for s in call[0][1]]
+
+    def test_setup(self):
+        self.assertTrue(self.emitter.setup([self.pipeline]))
+        self.assertEqual(['memory.total'],
+                         [p.name for p, ctx in self.emitter._publishers])
+        self.assertFalse(self.emitter.setup([]))
+
+    def test_push(self):
+        self.emitter.setup([self.pipeline])
+        self.emitter.push()
+        self.assertFalse(self.pipeline.publish_supported_samples.called)
+
+        self._report(2048)
+        self.emitter.push()
+        samples = self._published()
+        self.assertEqual(1, len(samples))
+        self.assertEqual('memory.total', samples[0].name)
+        self.assertEqual(2, samples[0].volume)
+        self.assertEqual('uuid-1', samples[0].resource_id)
+        self.pipeline.flush.assert_called_once_with(self.manager.context)
+
+        # Nothing new was reported.
+        self.emitter.push()
+        self.assertEqual(1, len(self._published()))
+
+    def test_push_coalesced(self):
+        self.emitter.setup([self.pipeline])
+        self._report(1024)
+        self.emitter.push()
+        self.time += 1
+        self._report(2048)
+        self.emitter.push()
+        self._report(3072)
+        self.emitter.push()
+        self.assertEqual(1, len(self._published()))
+
+        self.time += 10
+        self.emitter.push()
+        samples = self._published()
+        self.assertEqual(2, len(samples))
+        self.assertEqual(3, samples[1].volume)
+
+    def test_push_unknown_instance(self):
+        self.emitter.setup([self.pipeline])
+        self.manager.discover.return_value = []
+        self._report(1024)
+        self.emitter.push()
+        self.assertFalse(self.pipeline.publish_supported_samples.called)
+        self.assertEqual({}, self.emitter._pending)
+        self.manager.discover.assert_called_once_with()
+
+        # Discovery is not repeated for every report.
+        self._report(1024)
+        self.emitter.push()
+        self.assertEqual(1, self.manager.discover.call_count)
+
+    def test_push_refreshes_instances(self):
+        self.emitter.setup([self.pipeline])
+        self._report(1024)
+        self.emitter.push()
+        # The instance was resized.
+        self.manager.discover.return_value = [_instance(flavor_id=3)]
+        self.time += 30
+        self._report(2048)
+        self.emitter.push()
+        self.assertEqual(1, self.manager.discover.call_count)
+        self.assertEqual(2, self._published()[-1].resource_metadata[
+            'instance_type'])
+
+        # The instances are discovered again once outdated.
+        self.time += 31
+        self._report(3072)
+        self.emitter.push()
+        self.assertEqual(2, self.manager.discover.call_count)
+        self.assertEqual(3, self._published()[-1].resource_metadata[
+            'instance_type'])
+
+    def test_run(self):
+        self.emitter.setup([self.pipeline])
+        thread = eventlet.spawn(self.emitter.run)
+        self.addCleanup(thread.kill)
+        eventlet.sleep(0)
+        # A report is pushed as soon as it is received.
+        self._report(1024)
+        eventlet.sleep(0)
+        self.assertEqual(1, len(self._published()))
+
+        # A report within push_min_interval is pushed once it is over.
+        self.time += 9.99
+        self._report(2048)
+        eventlet.sleep(0)
+        self.assertEqual(1, len(self._published()))
+        self.time += 1
+        eventlet.sleep(0.1)
+        samples = self._published()
+        self.assertEqual(2, len(samples))
+        self.assertEqual(2, samples[1].volume)
@@ -0,0 +1,63 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/compute/virt/libvirt/counters.py
+"""
+
+from oslotest import base
+
+from ceilometer.compute.virt.libvirt import counters
+
+
+class TestCounterRing(base.BaseTestCase):
+
+    def test_rates(self):
+        ring = counters.CounterRing(2)
+        self.assertIsNone(ring.timestamp)
+        ring.add(100.0, (1000, 10))
+        self.assertIsNone(ring.rates())
+        ring.add(110.0, (3000, 10))
+        self.assertEqual([200.0, 0.0], ring.rates())
+        self.assertEqual(110.0, ring.timestamp)
+
+        # The oldest reading is overwritten.
+        ring.add(120.0, (3500, 20))
+        self.assertEqual(2, len(ring))
+        self.assertEqual([50.0, 1.0], ring.rates())
+
+    def test_rates_depth(self):
+        ring = counters.CounterRing(1, depth=3)
+        for i in range(5):
+            ring.add(10.0 * i, (100 * i * i,))
+        # Between the readings at 20 and 40 seconds.
+        self.assertEqual([60.0], ring.rates())
+
+    def test_close_reading_replaced(self):
+        ring = counters.CounterRing(1)
+        ring.add(100.0, (1000,))
+        ring.add(110.0, (2000,))
+        ring.add(110.5, (2155,), min_interval=1)
+        self.assertEqual(2, len(ring))
+        self.assertEqual([110.0], ring.rates())
+
+    def test_counter_reset(self):
+        ring = counters.CounterRing(2)
+        ring.add(100.0, (1000, 10))
+        ring.add(110.0, (2000, 20))
+        ring.add(120.0, (5, 30))
+        self.assertEqual(1, len(ring))
+        self.assertIsNone(ring.rates())
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, counters.CounterRing, 1, depth=1)
+        ring = counters.CounterRing(2)
+        self.assertRaises(ValueError, ring.add, 100.0, (1,))
@@ -20,10 +20,14 @@
 
 import contextlib
 
+import eventlet
+from eventlet import tpool
 import fixtures
 import mock
+from oslo.config import fixture as fixture_config
 from oslotest import base
 
+import ceilometer
 from ceilometer.compute.virt import inspector as virt_inspector
 from ceilometer.compute.virt.libvirt import inspector as libvirt_inspector
 
@@ -62,6 +66,65 @@ class TestLibvirtInspection(base.BaseTestCase):
             self.assertEqual('fake_name', inspected_instance.name)
             self.assertEqual('uuid', inspected_instance.UUID)
 
+    def test_inspect_instances_metadata(self):
+        class FakeError(Exception):
+            pass
+
+        libvirt_inspector.libvirt.libvirtError = FakeError
+        nova = 'http://openstack.org/xmlns/libvirt/nova/1.0'
+        self.domain.name.return_value = 'instance-00000001'
+        self.domain.UUIDString.return_value = 'uuid'
+        self.domain.metadata.return_value = (
+            '<instance xmlns="%s"><name>vm</name></instance>' % nova)
+        other = mock.Mock()
+        other.name.return_value = 'other'
+        other.UUIDString.return_value = 'other-uuid'
+        other.metadata.side_effect = FakeError()
+        connection = self.inspector.connection
+        with contextlib.nested(mock.patch.object(connection, 'listDomainsID',
+                                                 return_value=[0, 1, 2]),
+                               mock.patch.object(connection, 'lookupByID',
+                                                 side_effect=[self.domain,
+                                                              other])):
+            inspected = list(self.inspector.inspect_instances_metadata(nova))
+        self.assertEqual(2, len(inspected))
+        instance, metadata = inspected[0]
+        self.assertEqual('instance-00000001', instance.name)
+        self.assertEqual('uuid', instance.UUID)
+        self.assertEqual('{%s}instance' % nova, metadata.tag)
+        self.assertEqual('vm', metadata.findtext('{%s}name' % nova))
+        self.domain.metadata.assert_called_once_with(
+            libvirt_inspector.VIR_DOMAIN_METADATA_ELEMENT, nova)
+        self.assertEqual('other-uuid', inspected[1][0].UUID)
+        self.assertIsNone(inspected[1][1])
+
+    def test_inspect_instances_metadata_malformed(self):
+        libvirt_inspector.libvirt.libvirtError = type('FakeError',
+                                                      (Exception,), {})
+        nova = 'http://openstack.org/xmlns/libvirt/nova/1.0'
+        self.domain.name.return_value = 'instance-00000001'
+        self.domain.metadata.return_value = '<instance xmlns="%s">' % nova
+        connection = self.inspector.connection
+        with contextlib.nested(mock.patch.object(connection, 'listDomainsID',
+                                                 return_value=[1]),
+                               mock.patch.object(connection, 'lookupByID',
+                                                 return_value=self.domain)):
+            inspected = list(self.inspector.inspect_instances_metadata(nova))
+        self.assertEqual(1, len(inspected))
+        self.assertEqual('instance-00000001', inspected[0][0].name)
+        self.assertIsNone(inspected[0][1])
+
+    def test_get_connection_concurrent(self):
+        conf = self.useFixture(fixture_config.Config()).conf
+        conf.set_override('inspection_workers', 4, group='compute')
+        self.inspector.connection = None
+        libvirt = libvirt_inspector.libvirt
+        with mock.patch.object(libvirt_inspector.tpool, 'Proxy') as proxy:
+            connection = self.inspector._get_connection()
+        proxy.assert_called_once_with(libvirt.openReadOnly.return_value,
+                                      autowrap=(libvirt.virDomain,))
+        self.assertEqual(proxy.return_value, connection)
+
     def test_inspect_cpus(self):
         with contextlib.nested(mock.patch.object(self.inspector.connection,
                                                  'lookupByName',
@@ -245,6 +308,327 @@ class TestLibvirtInspection(base.BaseTestCase):
             disks = list(self.inspector.inspect_disks(self.instance_name))
             self.assertEqual(disks, [])
 
+    def test_inspect_all_bulk(self):
+        dom_xml = """
+             <domain type='kvm'>
+                 <devices>
+                     <interface type='bridge'>
+                         <mac address='fa:16:3e:71:ec:6d'/>
+                         <target dev='vnet0'/>
+                         <filterref
+                          filter='nova-instance-00000001-fa163e71ec6d'/>
+                     </interface>
+                 </devices>
+             </domain>
+        """
+        other = mock.Mock()
+        other.name.return_value = 'instance-00000002'
+        self.domain.name.return_value = self.instance_name
+        self.domain.XMLDesc.return_value = dom_xml
+        stats = {'state.state': 1, 'cpu.time': 999999L, 'vcpu.current': 2,
+                 'balloon.current': 524288L,
+                 'net.count': 1, 'net.0.name': 'vnet0',
+                 'net.0.rx.bytes': 1L, 'net.0.rx.pkts': 2L,
+                 'net.0.tx.bytes': 3L, 'net.0.tx.pkts': 4L,
+                 'block.count': 1, 'block.0.name': 'vda',
+                 'block.0.rd.reqs': 1L, 'block.0.rd.bytes': 2L,
+                 'block.0.wr.reqs': 3L, 'block.0.wr.bytes': 4L}
+        connection = self.inspector.connection
+        connection.getAllDomainStats.return_value = [(self.domain, stats),
+                                                     (other, {})]
+
+        result = self.inspector.inspect_all([self.instance_name])
+
+        connection.getAllDomainStats.assert_called_once_with(
+            libvirt_inspector._ALL_DOMAIN_STATS,
+            libvirt_inspector.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+        self.assertEqual([self.instance_name], list(result))
+        inst_stats = result[self.instance_name]
+        self.assertEqual(virt_inspector.CPUStats(number=2, time=999999L),
+                         inst_stats.cpu)
+        self.assertEqual(524288L, inst_stats.balloon)
+        vnic, info = inst_stats.vnics[0]
+        self.assertEqual('fa:16:3e:71:ec:6d', vnic.mac)
+        self.assertEqual('nova-instance-00000001-fa163e71ec6d', vnic.fref)
+        self.assertEqual(virt_inspector.InterfaceStats(
+            rx_bytes=1L, rx_packets=2L, tx_bytes=3L, tx_packets=4L), info)
+        disk, info = inst_stats.disks[0]
+        self.assertEqual('vda', disk.device)
+        self.assertEqual(virt_inspector.DiskStats(
+            read_bytes=2L, read_requests=1L, write_bytes=4L,
+            write_requests=3L, errors=-1), info)
+        self.assertFalse(connection.lookupByName.called)
+
+    def test_inspect_all_bulk_concurrent(self):
+        self.domain.name.return_value = self.instance_name
+        connection = self.inspector.connection
+        connection.getAllDomainStats.return_value = [(self.domain, {})]
+        self.inspector.connection = tpool.Proxy(connection)
+
+        with mock.patch.object(libvirt_inspector.tpool, 'execute',
+                               side_effect=lambda f, *args: f(*args)
+                               ) as execute:
+            records = self.inspector._get_all_domain_stats()
+            domain, stats = records[0]
+            self.assertIsInstance(domain, tpool.Proxy)
+            execute.reset_mock()
+            self.assertEqual(self.instance_name, domain.name())
+        execute.assert_called_once_with(self.domain.name)
+
+    def test_inspect_all_no_bulk(self):
+        del self.inspector.connection.getAllDomainStats
+        connection = self.inspector.connection
+        with mock.patch.object(connection, 'lookupByName',
+                               return_value=self.domain):
+            result = self.inspector.inspect_all([self.instance_name])
+
+        # The instances are left to the pollsters, which inspect them
+        # with a timeout.
+        self.assertEqual({}, result)
+        self.assertFalse(connection.lookupByName.called)
+
+    def test_inspect_all_missing_from_bulk(self):
+        other = mock.Mock()
+        other.name.return_value = 'instance-00000002'
+        connection = self.inspector.connection
+        connection.getAllDomainStats.return_value = [(other, {})]
+        with mock.patch.object(connection, 'lookupByName',
+                               return_value=self.domain):
+            result = self.inspector.inspect_all([self.instance_name,
+                                                 'instance-00000002'])
+
+        self.assertEqual(['instance-00000002'], list(result))
+        self.assertFalse(connection.lookupByName.called)
+
+    def _bulk_stats(self, *vnics):
+        stats = {'state.state': 1, 'net.count': len(vnics)}
+        for i, vnic in enumerate(vnics):
+            stats['net.%d.name' % i] = vnic
+        return stats
+
+    def test_inspect_all_topology_cached(self):
+        dom_xml = """
+             <domain type='kvm'>
+                 <devices>
+                     <interface type='bridge'>
+                         <mac address='fa:16:3e:71:ec:6d'/>
+                         <target dev='vnet0'/>
+                     </interface>
+                 </devices>
+             </domain>
+        """
+        self.domain.name.return_value = self.instance_name
+        self.domain.ID.return_value = 3
+        self.domain.XMLDesc.return_value = dom_xml
+        connection = self.inspector.connection
+        connection.getAllDomainStats.return_value = [
+            (self.domain, self._bulk_stats('vnet0'))]
+
+        for i in range(3):
+            result = self.inspector.inspect_all([self.instance_name])
+            vnic, info = result[self.instance_name].vnics[0]
+            self.assertEqual('fa:16:3e:71:ec:6d', vnic.mac)
+        self.assertEqual(1, self.domain.XMLDesc.call_count)
+
+        # A hot plugged vNIC changes the device list.
+        connection.getAllDomainStats.return_value = [
+            (self.domain, self._bulk_stats('vnet0', 'vnet1'))]
+        self.inspector.inspect_all([self.instance_name])
+        self.assertEqual(2, self.domain.XMLDesc.call_count)
+
+        # A restarted domain gets a new ID.
+        self.domain.ID.return_value = 4
+        self.inspector.inspect_all([self.instance_name])
+        self.assertEqual(3, self.domain.XMLDesc.call_count)
+
+        # The topology of the domains no longer active is dropped.
+        connection.getAllDomainStats.return_value = []
+        del connection.lookupByName
+        self.inspector.inspect_all([])
+        self.assertEqual({}, self.inspector._topology)
+
+    def test_topology_max_age(self):
+        self.domain.XMLDesc.return_value = '<domain/>'
+        with mock.patch('time.time', return_value=1000.0) as now:
+            self.inspector._get_topology(self.domain)
+            self.inspector._get_topology(self.domain)
+            self.assertEqual(1, self.domain.XMLDesc.call_count)
+            now.return_value += libvirt_inspector.TOPOLOGY_MAX_AGE
+            self.inspector._get_topology(self.domain)
+            self.assertEqual(2, self.domain.XMLDesc.call_count)
+
+            # Domain events make the cached topology valid until notified.
+            self.inspector._events = True
+            now.return_value += libvirt_inspector.TOPOLOGY_MAX_AGE
+            self.inspector._get_topology(self.domain)
+            self.assertEqual(2, self.domain.XMLDesc.call_count)
+            self.inspector._on_domain_event(self.domain.name())
+            self.inspector._get_topology(self.domain)
+            self.assertEqual(3, self.domain.XMLDesc.call_count)
+
+    def test_inspect_disks_error_invalidates_topology(self):
+        class FakeLibvirtError(Exception):
+            pass
+
+        libvirt_inspector.libvirt.libvirtError = FakeLibvirtError
+        dom_xml = """
+             <domain type='kvm'>
+                 <devices>
+                     <disk type='file' device='disk'>
+                         <target dev='vda' bus='virtio'/>
+                     </disk>
+                 </devices>
+             </domain>
+        """
+        self.domain.name.return_value = self.instance_name
+        self.domain.info.return_value = (0L, 0L, 0L, 2L, 999999L)
+        self.domain.XMLDesc.return_value = dom_xml
+        self.domain.blockStats.side_effect = FakeLibvirtError('gone')
+        self.inspector.connection.lookupByName.return_value = self.domain
+
+        self.assertRaises(FakeLibvirtError, list,
+                          self.inspector.inspect_disks(self.instance_name))
+        self.assertEqual({}, self.inspector._topology)
+
+    def test_register_events(self):
+        connection = self.inspector.connection
+        self.assertTrue(self.inspector._register_events(connection))
+        self.assertEqual(
+            [libvirt_inspector.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+             libvirt_inspector.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED,
+             libvirt_inspector.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED],
+            [c[0][1] for c in
+             connection.domainEventRegisterAny.call_args_list])
+
+    def test_watch_instances(self):
+        conf = self.useFixture(fixture_config.Config()).conf
+        conf.set_override('libvirt_events', True)
+        callback = mock.Mock()
+        self.inspector.connection = None
+        with mock.patch.object(self.inspector, '_start_event_loop'):
+            self.assertTrue(self.inspector.watch_instances(callback))
+        connection = self.inspector.connection
+        args = connection.domainEventRegisterAny.call_args_list[0][0]
+        self.domain.name.return_value = self.instance_name
+        self.inspector._topology[self.instance_name] = mock.Mock()
+        # The events are handed over by the native event loop thread to a
+        # green thread.
+        loop = libvirt_inspector.native_threading.Thread(
+            target=args[2], args=(connection, self.domain, 2, 0, args[3]))
+        loop.start()
+        loop.join()
+        self.assertFalse(callback.called)
+        with eventlet.Timeout(5):
+            while not callback.called:
+                eventlet.sleep(0.01)
+        callback.assert_called_once_with()
+        self.assertEqual({}, self.inspector._topology)
+
+    def test_watch_instances_not_registered(self):
+        class FakeLibvirtError(Exception):
+            pass
+
+        conf = self.useFixture(fixture_config.Config()).conf
+        conf.set_override('libvirt_events', True)
+        libvirt = libvirt_inspector.libvirt
+        libvirt.libvirtError = FakeLibvirtError
+        connection = libvirt.openReadOnly.return_value
+        connection.domainEventRegisterAny.side_effect = FakeLibvirtError()
+        self.inspector.connection = None
+        with mock.patch.object(self.inspector, '_start_event_loop'):
+            self.assertFalse(self.inspector.watch_instances(mock.Mock()))
+
+
+class TestLibvirtLocalRates(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestLibvirtLocalRates, self).setUp()
+        self.CONF = self.useFixture(fixture_config.Config()).conf
+        self.CONF.set_override('libvirt_local_rates', True)
+        self.inspector = libvirt_inspector.LibvirtInspector()
+        self.inspector.connection = mock.Mock()
+        libvirt_inspector.libvirt = mock.Mock()
+        libvirt_inspector.libvirt.VIR_DOMAIN_SHUTOFF = 5
+        self.instance = mock.Mock()
+        setattr(self.instance, 'OS-EXT-SRV-ATTR:instance_name',
+                'instance-00000001')
+        self.domain = mock.Mock()
+        self.domain.name.return_value = 'instance-00000001'
+        self.domain.XMLDesc.return_value = """
+             <domain type='kvm'>
+                 <devices>
+                     <interface type='bridge'>
+                         <mac address='fa:16:3e:71:ec:6d'/>
+                         <target dev='vnet0'/>
+                     </interface>
+                 </devices>
+             </domain>
+        """
+        self.time = 1000.0
+        patcher = mock.patch('time.time', side_effect=lambda: self.time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _read(self, cpu_time, net_bytes, disk_bytes):
+        stats = {'state.state': 1, 'cpu.time': cpu_time, 'vcpu.current': 2,
+                 'net.count': 1, 'net.0.name': 'vnet0',
+                 'net.0.rx.bytes': net_bytes, 'net.0.tx.bytes': net_bytes,
+                 'block.count': 1, 'block.0.name': 'vda',
+                 'block.0.rd.bytes': disk_bytes,
+                 'block.0.wr.bytes': disk_bytes}
+        self.inspector.connection.getAllDomainStats.return_value = [
+            (self.domain, stats)]
+
+    def test_rates(self):
+        self._read(0, 0, 0)
+        self.assertRaises(virt_inspector.NoDataException,
+                          self.inspector.inspect_cpu_util, self.instance, 600)
+        self.assertRaises(virt_inspector.NoDataException,
+                          self.inspector.inspect_vnic_rates, self.instance,
+                          600)
+
+        self.time += 10
+        self._read(10 * 10 ** 9, 1000, 4000)
+        cpu_util = self.inspector.inspect_cpu_util(self.instance, 10)
+        self.assertEqual(50.0, cpu_util.util)
+        vnic, info = self.inspector.inspect_vnic_rates(self.instance, 10)[0]
+        self.assertEqual('fa:16:3e:71:ec:6d', vnic.mac)
+        self.assertEqual(100.0, info.rx_bytes_rate)
+        disk, info = self.inspector.inspect_disk_rates(self.instance, 10)[0]
+        self.assertEqual('vda', disk.device)
+        self.assertEqual(400.0, info.write_bytes_rate)
+        self.assertEqual(0.0, info.read_requests_rate)
+
+        # All the rates of a cycle come from a single reading.
+        self.assertEqual(
+            2, self.inspector.connection.getAllDomainStats.call_count)
+
+    def test_rates_fed_by_inspect_all(self):
+        self._read(0, 0, 0)
+        self.inspector.inspect_all(['instance-00000001'])
+        self.time += 10
+        self._read(5 * 10 ** 9, 0, 0)
+        self.inspector.inspect_all(['instance-00000001'])
+        self.assertEqual(
+            25.0, self.inspector.inspect_cpu_util(self.instance, 10).util)
+        self.assertEqual(
+            2, self.inspector.connection.getAllDomainStats.call_count)
+
+    def test_instance_not_found(self):
+        self.inspector.connection.getAllDomainStats.return_value = []
+        self.inspector._inspect_instance_stats = mock.Mock(
+            side_effect=virt_inspector.InstanceNotFoundException())
+        self.assertRaises(virt_inspector.InstanceNotFoundException,
+                          self.inspector.inspect_disk_rates, self.instance)
+
+    def test_disabled(self):
+        self.CONF.set_override('libvirt_local_rates', False)
+        self.assertRaises(ceilometer.NotImplementedError,
+                          self.inspector.inspect_cpu_util, self.instance)
+        self._read(0, 0, 0)
+        self.inspector.inspect_all(['instance-00000001'])
+        self.assertEqual({}, self.inspector._readings)
+
 
 class TestLibvirtInspectionWithError(base.BaseTestCase):
 
@@ -0,0 +1,93 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for the guest agent message parsing.
+"""
+
+import json
+
+import mock
+from oslotest import base
+
+from ceilometer.compute.virt.ovirtga import guestagent
+
+
+class TestLineFramer(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestLineFramer, self).setUp()
+        self.framer = guestagent.LineFramer(32)
+
+    def test_split_messages(self):
+        self.assertEqual([], self.framer.feed(b'{"a"'))
+        self.assertEqual([u'{"a": 1}', u'{}'],
+                         self.framer.feed(b': 1}\n{}\n{"b'))
+        self.assertEqual(3, len(self.framer))
+        self.assertEqual([u'{"b": 2}'], self.framer.feed(b'": 2}\n'))
+        self.assertEqual(0, len(self.framer))
+
+    def test_bad_utf8(self):
+        self.assertEqual([u'caf\ufffd'], self.framer.feed(b'caf\xe9\n'))
+
+    def test_too_big(self):
+        self.assertEqual([], self.framer.feed(b'x' * 40))
+        self.assertEqual(0, len(self.framer))
+        self.assertIs(guestagent.MessageState.TOO_BIG, self.framer.state)
+        # The end of the oversized message is dropped as well.
+        self.assertEqual([u'ok'], self.framer.feed(b'xxx\nok\n'))
+        self.assertIs(guestagent.MessageState.NORMAL, self.framer.state)
+
+    def test_clear(self):
+        self.framer.feed(b'partial')
+        self.framer.clear()
+        self.assertEqual([u'new'], self.framer.feed(b'new\n'))
+
+
+class TestGuestAgentParsing(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestGuestAgentParsing, self).setUp()
+        self.listener = mock.Mock()
+        self.agent = guestagent.GuestAgent('/tmp/guest.sock', self.listener,
+                                           vmName='vm1')
+        self.agent._stopped = False
+
+    def _send(self, name, **args):
+        args['__name__'] = name
+        self.agent._handleData((json.dumps(args) + '\n').encode('utf8'))
+
+    def test_filter_xml_chars(self):
+        self.assertEqual(u'a\ufffdb\ufffdc\ufffd\xe9',
+                         guestagent._filterXmlChars(u'a\x01b\ud800c\uffff'
+                                                    u'\xe9'))
+        self.assertRaises(TypeError, guestagent._filterXmlChars, 'abc')
+
+    def test_published_message_filtered(self):
+        self._send('fqdn', fqdn=u'vm\x07.example.com')
+        self.assertEqual(u'vm\ufffd.example.com',
+                         self.agent.guestInfo['guestFQDN'])
+
+    def test_applications_not_filtered(self):
+        self._send('applications', applications=[u'app\x07'])
+        self.assertEqual([u'app\x07'], self.agent.guestInfo['appsList'])
+
+    def test_heartbeat_reported(self):
+        self._send('heartbeat', **{'free-ram': 10,
+                                   'memory-stat': {'mem_total': 1024}})
+        self.assertEqual(10, self.agent.guestInfo['memUsage'])
+        self.listener.report.assert_called_once_with(
+            'vm1', 'memoryStats', {'mem_total': '1024'})
+
+    def test_stopped_agent_ignores_data(self):
+        self.agent._stopped = True
+        self._send('fqdn', fqdn=u'vm1')
+        self.assertEqual('', self.agent.guestInfo['guestFQDN'])
@@ -0,0 +1,166 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for the oVirt guest agent inspector.
+"""
+
+import eventlet
+import mock
+from oslo.config import fixture as fixture_config
+from oslotest import base
+from oslotest import mockpatch
+
+from ceilometer.compute.virt import oga_inspector
+from ceilometer.openstack.common import processutils
+
+
+class TestOGAInspector(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestOGAInspector, self).setUp()
+        self.CONF = self.useFixture(fixture_config.Config()).conf
+        self.CONF.set_override('watch_sockets', False, group='oga')
+        self.useFixture(mockpatch.Patch(
+            'ceilometer.compute.virt.oga_inspector.Listener'))
+        self.agent_cls = self.useFixture(mockpatch.Patch(
+            'ceilometer.compute.virt.oga_inspector.GuestAgent')).mock
+        self.execute = self.useFixture(mockpatch.Patch(
+            'ceilometer.utils.execute')).mock
+        self.exists = self.useFixture(mockpatch.Patch(
+            'os.path.exists', return_value=True)).mock
+        self.inspector = oga_inspector.OGAInspector()
+
+    def _wait_for_connects(self):
+        eventlet.sleep(0)
+        self.inspector._connect_pool.waitall()
+
+    def test_connect_in_background(self):
+        self.assertIsNone(self.inspector._get_agent('vm1'))
+        self.assertIsNone(self.inspector._get_agent('vm2'))
+        self.assertIsNone(self.inspector._get_agent('vm1'))
+        self.assertFalse(self.agent_cls.called)
+
+        self._wait_for_connects()
+
+        self.execute.assert_called_once_with(
+            'chmod', 'g+rw',
+            '/var/lib/libvirt/qemu/com.redhat.rhevm.vdsm.vm1.sock',
+            '/var/lib/libvirt/qemu/com.redhat.rhevm.vdsm.vm2.sock',
+            run_as_root=True)
+        self.assertEqual(2, self.agent_cls.call_count)
+        self.agent_cls.return_value.connect.assert_called_with(prepare=False)
+        self.assertIs(self.agent_cls.return_value,
+                      self.inspector._get_agent('vm1'))
+
+    def test_chmod_batches(self):
+        with mock.patch.object(oga_inspector, '_CHMOD_BATCH_SIZE', 2):
+            for i in range(5):
+                self.inspector._get_agent('vm%d' % i)
+            self._wait_for_connects()
+        self.assertEqual(3, self.execute.call_count)
+        self.assertEqual(5, self.agent_cls.call_count)
+
+    def test_chmod_failure(self):
+        self.execute.side_effect = processutils.ProcessExecutionError()
+        self.inspector._get_agent('vm1')
+        self._wait_for_connects()
+        self.assertIs(self.agent_cls.return_value,
+                      self.inspector._get_agent('vm1'))
+
+    def test_missing_socket(self):
+        self.exists.return_value = False
+        self.assertIsNone(self.inspector._get_agent('vm1'))
+        self._wait_for_connects()
+        self.assertFalse(self.execute.called)
+        self.assertFalse(self.agent_cls.called)
+
+    def test_watcher_unavailable(self):
+        self.CONF.set_override('watch_sockets', True, group='oga')
+        with mock.patch('ceilometer.compute.virt.ovirtga.sockwatch.'
+                        'SocketWatcher.start',
+                        side_effect=OSError(38, 'ENOSYS')):
+            inspector = oga_inspector.OGAInspector()
+        self.assertIsNone(inspector._watcher)
+
+    def test_socket_created(self):
+        self.inspector._on_socket_created('vm1', '/tmp/vm1.sock')
+        self._wait_for_connects()
+        self.agent_cls.assert_called_once_with(
+            '/tmp/vm1.sock', self.inspector.channelListener, vmName='vm1')
+        self.inspector._on_socket_created('vm1', '/tmp/vm1.sock')
+        self._wait_for_connects()
+        self.assertEqual(1, self.agent_cls.call_count)
+
+    def test_socket_created_while_connecting(self):
+        def chmod(*args, **kwargs):
+            if len(self.execute.call_args_list) == 1:
+                self.inspector._on_socket_created('vm2', '/tmp/vm2.sock')
+
+        self.execute.side_effect = chmod
+        self.inspector._on_socket_created('vm1', '/tmp/vm1.sock')
+        self._wait_for_connects()
+        self._wait_for_connects()
+
+        self.assertEqual([mock.call('chmod', 'g+rw', '/tmp/vm1.sock',
+                                    run_as_root=True),
+                          mock.call('chmod', 'g+rw', '/tmp/vm2.sock',
+                                    run_as_root=True)],
+                         self.execute.call_args_list)
+        self.assertEqual(2, self.agent_cls.call_count)
+        self.assertEqual({}, self.inspector._pending)
+
+    def test_socket_deleted(self):
+        agent = mock.Mock(connects=1)
+        self.inspector.agents.add('vm1', agent)
+        self.inspector.store.update('vm1', 'memoryStats', {})
+        self.inspector._on_socket_deleted('vm1')
+        agent.stop.assert_called_once_with()
+        self.assertNotIn('vm1', self.inspector.agents)
+        self.assertIsNone(self.inspector.store.get('vm1'))
+
+    def test_socket_deleted_before_connect(self):
+        self.inspector._on_socket_created('vm1', '/tmp/vm1.sock')
+        self.inspector._on_socket_deleted('vm1')
+        self._wait_for_connects()
+        self.assertFalse(self.agent_cls.called)
+        self.assertNotIn('vm1', self.inspector.agents)
+
+    def test_clear_outdated_agent(self):
+        agent = mock.Mock(connects=1)
+        agent.update_time.return_value = 0
+        self.inspector.agents.add('vm1', agent)
+        self.inspector.store.update('vm2', 'memoryStats', {})
+        with mock.patch('ceilometer.compute.virt.ovirtga.statestore.'
+                        'monotonic', return_value=10 ** 9):
+            self.inspector.clear_outdated_agent()
+        agent.stop.assert_called_once_with()
+        self.assertEqual(0, len(self.inspector.agents))
+        self.assertEqual([], self.inspector.store.names())
+        self.assertEqual(1, self.inspector.stats()['expirations'])
+
+    def test_inspect_guest_changes(self):
+        self.inspector.store.update('vm1', 'memoryStats',
+                                    {'mem_total': '2048'})
+        version = self.inspector.store.version
+        self.inspector.store.update('vm2', 'disksUsage',
+                                    [{'path': '/', 'used': 1, 'total': 4}])
+        with mock.patch.object(self.inspector, '_get_agent') as get_agent:
+            all_version, changes = self.inspector.inspect_guest_changes()
+            self.assertEqual(2048, changes['vm1'].mem_total)
+            self.assertEqual((oga_inspector.DiskUsage('/', 25.0),),
+                             changes['vm2'].disk_usage)
+            new_version, changes = self.inspector.inspect_guest_changes(
+                version)
+        self.assertFalse(get_agent.called)
+        self.assertEqual(all_version, new_version)
+        self.assertEqual(['vm2'], list(changes))
+        self.assertFalse(self.agent_cls.called)
@@ -0,0 +1,92 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for the guest agent registry.
+"""
+
+import mock
+from oslotest import base
+
+from ceilometer.compute.virt.ovirtga import registry
+
+
+class TestAgentRegistry(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestAgentRegistry, self).setUp()
+        self.now = 100.0
+        patcher = mock.patch('ceilometer.compute.virt.ovirtga.statestore.'
+                             'monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.ages = {}
+        self.removed = []
+        self.registry = registry.AgentRegistry(
+            3, 60, lambda name, agent: self.ages.get(name, 0),
+            on_remove=lambda name, agent: self.removed.append(name))
+
+    def _add(self, *names):
+        for name in names:
+            self.registry.add(name, mock.Mock(connects=1))
+
+    def test_lru_eviction(self):
+        self._add('vm1', 'vm2', 'vm3')
+        self.registry.get('vm1')
+        self._add('vm4')
+        self.assertEqual(['vm2'], self.removed)
+        self.assertEqual(['vm3', 'vm1', 'vm4'], self.registry.names())
+        self.assertEqual(1, self.registry.stats()['evictions'])
+
+    def test_replace(self):
+        self._add('vm1', 'vm1')
+        self.assertEqual(['vm1'], self.removed)
+        self.assertEqual(1, len(self.registry))
+        self.assertEqual(0, self.registry.stats()['evictions'])
+
+    def test_expire(self):
+        self._add('vm1', 'vm2')
+        self.assertEqual([], self.registry.expire())
+        self.now += 61
+        self.ages = {'vm1': 61, 'vm2': 30}
+        self.assertEqual(['vm1'], self.registry.expire())
+        self.assertEqual(['vm1'], self.removed)
+        # vm2 was active meanwhile, it is checked again 30 seconds later.
+        self.now += 29
+        self.assertEqual([], self.registry.expire())
+        self.now += 1
+        self.ages = {'vm2': 61}
+        self.assertEqual(['vm2'], self.registry.expire())
+        self.assertEqual(2, self.registry.stats()['expirations'])
+
+    def test_expire_skips_removed(self):
+        self._add('vm1')
+        self.registry.remove('vm1')
+        self._add('vm1')
+        self.now += 61
+        self.ages = {'vm1': 61}
+        self.assertEqual(['vm1'], self.registry.expire())
+        self.assertEqual(['vm1', 'vm1'], self.removed)
+
+    def test_heap_stays_bounded(self):
+        for i in range(1000):
+            self._add('vm%d' % i)
+        self.registry.expire()
+        self.assertEqual(3, len(self.registry))
+        self.assertTrue(len(self.registry._deadlines) < 100)
+
+    def test_stats(self):
+        self._add('vm1', 'vm2')
+        self.registry.get('vm1').connects = 3
+        self.registry.remove('vm1')
+        self.assertEqual({'live': 1, 'capacity': 3, 'evictions': 0,
+                          'expirations': 0, 'reconnects': 2},
+                         self.registry.stats())
@@ -0,0 +1,93 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for the guest agent socket watcher.
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+
+import eventlet
+import mock
+from oslotest import base
+
+from ceilometer.compute.virt.ovirtga import sockwatch
+
+
+def _event(mask, name):
+    name = name + b'\0' * (16 - len(name) % 16)
+    return struct.pack('iIII', 1, mask, 0, len(name)) + name
+
+
+class TestSocketWatcher(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestSocketWatcher, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.created = mock.Mock()
+        self.deleted = mock.Mock()
+        self.watcher = sockwatch.SocketWatcher(self.tmpdir, 'agent.', '.sock',
+                                               self.created, self.deleted)
+
+    def _touch(self, filename):
+        open(os.path.join(self.tmpdir, filename), 'w').close()
+
+    def test_parse_events(self):
+        data = _event(sockwatch.IN_CREATE, b'a.sock') + \
+            _event(sockwatch.IN_DELETE, b'')
+        self.assertEqual([(sockwatch.IN_CREATE, b'a.sock'),
+                          (sockwatch.IN_DELETE, b'')],
+                         sockwatch.parse_events(data))
+
+    def test_handle_events(self):
+        data = (_event(sockwatch.IN_CREATE, b'agent.vm1.sock') +
+                _event(sockwatch.IN_MOVED_TO, b'other.sock') +
+                _event(sockwatch.IN_CREATE | sockwatch.IN_ISDIR,
+                       b'agent.dir.sock') +
+                _event(sockwatch.IN_DELETE, b'agent.vm2.sock'))
+        self.assertTrue(self.watcher.handle_events(data))
+        self.created.assert_called_once_with(
+            'vm1', os.path.join(self.tmpdir, 'agent.vm1.sock'))
+        self.deleted.assert_called_once_with('vm2')
+
+    def test_handle_overflow(self):
+        self._touch('agent.vm1.sock')
+        self.watcher.handle_events(_event(sockwatch.IN_Q_OVERFLOW, b''))
+        self.created.assert_called_once_with(
+            'vm1', os.path.join(self.tmpdir, 'agent.vm1.sock'))
+
+    def test_handle_ignored(self):
+        self.assertFalse(self.watcher.handle_events(
+            _event(sockwatch.IN_IGNORED, b'')))
+
+    def test_watch(self):
+        self._touch('agent.vm1.sock')
+        try:
+            self.watcher.start()
+        except sockwatch.InotifyUnavailable as e:
+            self.skipTest('inotify is not available: %s' % e)
+        self.addCleanup(self.watcher.stop)
+        self.created.assert_called_once_with(
+            'vm1', os.path.join(self.tmpdir, 'agent.vm1.sock'))
+
+        self._touch('agent.vm2.sock')
+        os.unlink(os.path.join(self.tmpdir, 'agent.vm1.sock'))
+        for _ in range(100):
+            if self.deleted.called:
+                break
+            eventlet.sleep(0.01)
+        self.created.assert_called_with(
+            'vm2', os.path.join(self.tmpdir, 'agent.vm2.sock'))
+        self.deleted.assert_called_once_with('vm1')
@@ -0,0 +1,82 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for the guest agent state store.
+"""
+
+import mock
+from oslotest import base
+
+from ceilometer.compute.virt.ovirtga import statestore
+
+
+class TestGuestStateStore(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestGuestStateStore, self).setUp()
+        self.store = statestore.GuestStateStore()
+
+    def test_update(self):
+        self.assertEqual(1, self.store.update('vm1', 'memoryStats',
+                                              {'mem_total': '1024'}))
+        self.assertEqual(2, self.store.update('vm1', 'disksUsage', []))
+        self.assertEqual(1, self.store.update('vm2', 'netIfaces', []))
+        state = self.store.get('vm1')
+        self.assertEqual(2, state.seq)
+        self.assertEqual(2, state.version)
+        self.assertEqual({'mem_total': '1024'}, state.memoryStats)
+        self.assertEqual([], state.disksUsage)
+        self.assertIsNone(state.netIfaces)
+        self.assertEqual(3, self.store.version)
+
+    def test_update_unknown_kind(self):
+        self.assertRaises(ValueError, self.store.update,
+                          'vm1', 'appsList', [])
+
+    def test_watch(self):
+        callback = mock.Mock()
+        self.store.watch(callback)
+        self.assertRaises(ValueError, self.store.update,
+                          'vm1', 'appsList', [])
+        self.assertFalse(callback.called)
+        self.store.update('vm1', 'disksUsage', [])
+        callback.assert_called_once_with()
+
+    def test_changed_since(self):
+        self.store.update('vm1', 'memoryStats', {})
+        version, changed = self.store.changed_since(0)
+        self.assertEqual(1, version)
+        self.assertEqual(['vm1'], [s.name for s in changed])
+
+        self.store.update('vm2', 'memoryStats', {})
+        version, changed = self.store.changed_since(version)
+        self.assertEqual(2, version)
+        self.assertEqual(['vm2'], [s.name for s in changed])
+
+        version, changed = self.store.changed_since(version)
+        self.assertEqual(2, version)
+        self.assertEqual([], changed)
+
+    def test_age_and_expired(self):
+        with mock.patch.object(statestore, 'monotonic',
+                               side_effect=[100.0, 150.0, 170.0, 180.0]):
+            self.store.update('vm1', 'memoryStats', {})
+            self.store.update('vm2', 'memoryStats', {})
+            self.assertEqual(70.0, self.store.age('vm1'))
+            self.assertEqual(['vm1'], self.store.expired(60))
+        self.assertIsNone(self.store.age('vm3'))
+
+    def test_remove(self):
+        self.store.update('vm1', 'memoryStats', {})
+        self.assertEqual('vm1', self.store.remove('vm1').name)
+        self.assertIsNone(self.store.get('vm1'))
+        self.assertEqual([], self.store.names())
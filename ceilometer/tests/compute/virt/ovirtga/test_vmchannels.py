@@ -0,0 +1,76 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for the VM channels listener.
+"""
+
+import os
+
+import eventlet
+from eventlet import tpool
+import mock
+from oslotest import base
+
+from ceilometer.compute.virt.ovirtga import vmchannels
+
+
+class TestListener(base.BaseTestCase):
+
+    def _do_test_read_callback(self, mode):
+        listener = vmchannels.Listener(mode=mode)
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        self.addCleanup(listener.join, 5)
+        self.addCleanup(listener.stop)
+        reads = []
+
+        def read(opaque):
+            reads.append(os.read(read_fd, 4096))
+            return True
+
+        listener.register(lambda opaque: read_fd, lambda opaque: True,
+                          read, lambda opaque: None, None)
+        with mock.patch.object(vmchannels.tpool, 'execute',
+                               side_effect=tpool.execute) as execute:
+            listener.start()
+            eventlet.sleep(0.1)
+            os.write(write_fd, b'report')
+            with eventlet.Timeout(5):
+                while not reads:
+                    eventlet.sleep(0.01)
+        self.assertEqual([b'report'], reads)
+        return execute
+
+    def test_read_callback_green(self):
+        execute = self._do_test_read_callback(vmchannels.GREEN)
+        self.assertFalse(execute.called)
+
+    def test_read_callback_native(self):
+        # Only the epoll wait is run on a native thread, the callbacks
+        # being run by the listener.
+        execute = self._do_test_read_callback(vmchannels.NATIVE)
+        self.assertTrue(execute.called)
+        for args, kwargs in execute.call_args_list:
+            self.assertEqual('poll', args[0].__name__)
+
+    def test_stop_closes_wakeup_pipe(self):
+        listener = vmchannels.Listener(mode=vmchannels.GREEN)
+        wakeup_fds = (listener._wakeup_r, listener._wakeup_w)
+        listener.start()
+        eventlet.sleep(0.1)
+        listener.stop()
+        listener.join(5)
+        for fd in wakeup_fds:
+            self.assertRaises(OSError, os.fstat, fd)
+        # A late wakeup is ignored.
+        listener.stop()
@@ -18,6 +18,8 @@
 # under the License.
 
 import abc
+import contextlib
+import copy
 import datetime
 import traceback
 
@@ -296,6 +298,22 @@ class BasePipelineTestCase(base.BaseTestCase):
         self.assertEqual('a_update', getattr(publisher.samples[0], "name"))
         self.assertEqual('b_update', getattr(publisher.samples[1], "name"))
 
+    def test_publisher_routes_meters(self):
+        self._set_pipeline_cfg('counters', ['a'])
+        pipeline_manager = pipeline.PipelineManager(self.pipeline_cfg,
+                                                    self.transformer_manager)
+        other = copy.copy(self.test_counter)
+        other.name = 'b'
+        with mock.patch.object(pipeline_manager, 'pipelines_for',
+                               wraps=pipeline_manager.pipelines_for) as route:
+            with pipeline_manager.publisher(None) as p:
+                p([self.test_counter, other, self.test_counter, other])
+
+        self.assertEqual(2, route.call_count)
+        publisher = pipeline_manager.pipelines[0].publishers[0]
+        self.assertEqual(['a_update', 'a_update'],
+                         [s.name for s in publisher.samples])
+
     def test_counter_dont_match(self):
         counter_cfg = ['nomatch']
         self._set_pipeline_cfg('counters', counter_cfg)
@@ -395,6 +413,35 @@ class BasePipelineTestCase(base.BaseTestCase):
         self.assertTrue(pipeline_manager.pipelines[0].
                         support_meter('instance'))
 
+    def test_wildcard_patterns_counters(self):
+        counter_cfg = ['cpu', 'disk.*.bytes', 'network.?ncoming.*',
+                       'instance:m1.[st]*']
+        self._set_pipeline_cfg('counters', counter_cfg)
+        pipeline_manager = pipeline.PipelineManager(self.pipeline_cfg,
+                                                    self.transformer_manager)
+        pipe = pipeline_manager.pipelines[0]
+        self.assertTrue(pipe.support_meter('cpu'))
+        self.assertFalse(pipe.support_meter('cpu_util'))
+        self.assertTrue(pipe.support_meter('disk.read.bytes'))
+        self.assertFalse(pipe.support_meter('disk.read.requests'))
+        self.assertTrue(pipe.support_meter('network.incoming.bytes'))
+        self.assertFalse(pipe.support_meter('network.outgoing.bytes'))
+        self.assertFalse(pipe.support_meter('instance:m1.tiny'))
+
+    def test_pipelines_for_meter(self):
+        self._augment_pipeline_cfg()
+        pipeline_manager = pipeline.PipelineManager(self.pipeline_cfg,
+                                                    self.transformer_manager)
+        self.assertEqual([pipeline_manager.pipelines[0]],
+                         list(pipeline_manager.pipelines_for('a')))
+        self.assertEqual([pipeline_manager.pipelines[1]],
+                         list(pipeline_manager.pipelines_for('b')))
+        self.assertEqual([], list(pipeline_manager.pipelines_for('c')))
+        with mock.patch.object(pipeline_manager.pipelines[0].source,
+                               'support_meter') as support_meter:
+            pipeline_manager.pipelines_for('a')
+        self.assertFalse(support_meter.called)
+
     def test_multiple_pipeline(self):
         self._augment_pipeline_cfg()
 
@@ -641,6 +688,61 @@ class BasePipelineTestCase(base.BaseTestCase):
         self.assertEqual('a_update', getattr(publisher.samples[0], 'name'))
         self.assertEqual('b_update', getattr(publisher.samples[1], 'name'))
 
+    def _interleaved_counters(self):
+        return [sample.Sample(
+            name=name,
+            type=self.test_counter.type,
+            volume=self.test_counter.volume,
+            unit=self.test_counter.unit,
+            user_id=self.test_counter.user_id,
+            project_id=self.test_counter.project_id,
+            resource_id='test_resource%d' % i,
+            timestamp=self.test_counter.timestamp,
+            resource_metadata=self.test_counter.resource_metadata,
+        ) for i, name in enumerate(['b', 'a', 'b', 'a'])]
+
+    def test_multiple_counter_single_publish(self):
+        self._set_pipeline_cfg('counters', ['a', 'b'])
+        pipeline_manager = pipeline.PipelineManager(self.pipeline_cfg,
+                                                    self.transformer_manager)
+        with pipeline_manager.publisher(None) as p:
+            p(self._interleaved_counters())
+
+        publisher = pipeline_manager.pipelines[0].publishers[0]
+        self.assertEqual(1, publisher.calls)
+        self.assertEqual(4, len(publisher.samples))
+
+    def test_multiple_counter_order_without_transformers(self):
+        self._set_pipeline_cfg('counters', ['a', 'b'])
+        self._set_pipeline_cfg('transformers', None)
+        pipeline_manager = pipeline.PipelineManager(self.pipeline_cfg,
+                                                    self.transformer_manager)
+        counters = self._interleaved_counters()
+        with pipeline_manager.publisher(None) as p:
+            p(counters)
+
+        publisher = pipeline_manager.pipelines[0].publishers[0]
+        self.assertEqual(1, publisher.calls)
+        self.assertEqual([(s.name, s.resource_id) for s in counters],
+                         [(s.name, s.resource_id) for s in publisher.samples])
+
+    def test_multiple_counter_grouped_for_transformers(self):
+        self._set_pipeline_cfg('counters', ['a', 'b'])
+        pipeline_manager = pipeline.PipelineManager(self.pipeline_cfg,
+                                                    self.transformer_manager)
+        with pipeline_manager.publisher(None) as p:
+            p(self._interleaved_counters())
+
+        # Each meter reaches the transformer in one run, resources in order.
+        self.assertEqual([('a', 'test_resource1'), ('a', 'test_resource3'),
+                          ('b', 'test_resource0'), ('b', 'test_resource2')],
+                         [(s.name, s.resource_id)
+                          for s in self.TransformerClass.samples])
+        publisher = pipeline_manager.pipelines[0].publishers[0]
+        self.assertEqual(1, publisher.calls)
+        self.assertEqual(['a_update', 'a_update', 'b_update', 'b_update'],
+                         [s.name for s in publisher.samples])
+
     def test_flush_pipeline_cache(self):
         CACHE_SIZE = 10
         extra_transformer_cfg = [
@@ -1047,6 +1149,210 @@ class BasePipelineTestCase(base.BaseTestCase):
         pipe.flush(None)
         self.assertEqual(0, len(publisher.samples))
 
+    def test_rate_of_change_state_eviction(self):
+        transformer_cfg = [
+            {
+                'name': 'rate_of_change',
+                'parameters': {
+                    'target': {'name': 'cpu_util',
+                               'unit': '%',
+                               'type': sample.TYPE_GAUGE},
+                    'max_size': 10,
+                    'ttl': 600,
+                }
+            },
+        ]
+        self._set_pipeline_cfg('transformers', transformer_cfg)
+        self._set_pipeline_cfg('counters', ['cpu'])
+        pipeline_manager = pipeline.PipelineManager(self.pipeline_cfg,
+                                                    self.transformer_manager)
+        pipe = pipeline_manager.pipelines[0]
+        rate = pipe.sink.transformers[0]
+        publisher = pipe.publishers[0]
+
+        def cpu_samples(resources, volume, timestamp):
+            return [sample.Sample(name='cpu',
+                                  type=sample.TYPE_CUMULATIVE,
+                                  volume=volume,
+                                  unit='ns',
+                                  user_id='test_user',
+                                  project_id='test_proj',
+                                  resource_id='test_resource%d' % i,
+                                  timestamp=timestamp,
+                                  resource_metadata={})
+                    for i in resources]
+
+        with mock.patch('time.time', return_value=1000.0):
+            pipe.publish_samples(None, cpu_samples(range(10), 10,
+                                                   '2015-01-01T00:00:00'))
+        self.assertEqual(10, len(rate.cache))
+        footprint = rate.cache.memory_footprint()
+
+        # The least recently updated entries make room for new ones.
+        with mock.patch('time.time', return_value=1060.0):
+            pipe.publish_samples(None, cpu_samples(range(5, 11), 70,
+                                                   '2015-01-01T00:01:00'))
+        self.assertEqual(5, len(publisher.samples))
+        self.assertEqual([1.0] * 5, [s.volume for s in publisher.samples])
+        self.assertEqual(10, len(rate.cache))
+        for i in range(5, 11):
+            self.assertIn(('cpu', 'test_resource%d' % i), rate.cache)
+        self.assertEqual(footprint, rate.cache.memory_footprint())
+
+        # The entries not updated for the ttl are dropped.
+        with mock.patch('time.time', return_value=1700.0):
+            pipe.publish_samples(None, cpu_samples([10], 130,
+                                                   '2015-01-01T00:02:00'))
+        self.assertEqual(5, len(publisher.samples))
+        self.assertEqual([('cpu', 'test_resource10')], list(rate.cache))
+
+    def test_rate_of_change_state_no_ttl(self):
+        rate = conversions.RateOfChangeTransformer(
+            target={'name': 'cpu_util', 'unit': '%',
+                    'type': sample.TYPE_GAUGE})
+        self.assertIsNone(rate.cache.ttl)
+        cpu = sample.Sample(
+            name='cpu', type=sample.TYPE_CUMULATIVE, volume=10, unit='ns',
+            user_id='test_user', project_id='test_proj',
+            resource_id='test_resource', timestamp='2015-01-01T00:00:00',
+            resource_metadata={})
+        with mock.patch('time.time', return_value=1000.0):
+            rate.handle_sample(None, cpu)
+        # The state is kept however long the resource is not sampled.
+        with mock.patch('time.time', return_value=1000.0 + 10 ** 7):
+            self.assertIsNotNone(rate.cache.get(('cpu', 'test_resource')))
+
+    def _do_test_batch_transformers(self, scale, metadata):
+        transformer_cfg = [
+            {
+                'name': 'unit_conversion',
+                'parameters': {
+                    'source': {'unit': 'ns'},
+                    'target': {'unit': 's', 'scale': scale},
+                }
+            },
+            {
+                'name': 'rate_of_change',
+                'parameters': {
+                    'target': {'name': 'cpu_util',
+                               'unit': '%',
+                               'type': sample.TYPE_GAUGE,
+                               'scale': '100.0'},
+                }
+            },
+        ]
+        self._set_pipeline_cfg('transformers', transformer_cfg)
+        self._set_pipeline_cfg('counters', ['cpu'])
+        pipeline_manager = pipeline.PipelineManager(self.pipeline_cfg,
+                                                    self.transformer_manager)
+        pipe = pipeline_manager.pipelines[0]
+        self.assertTrue(pipe.sink.batch)
+
+        now = timeutils.utcnow()
+        for minute, volume in enumerate((60, 90, 120)):
+            pipe.publish_samples(None, [
+                sample.Sample(
+                    name='cpu',
+                    type=sample.TYPE_CUMULATIVE,
+                    volume=volume * 10 ** 9 * (i + 1),
+                    unit='ns',
+                    user_id='test_user',
+                    project_id='test_proj',
+                    resource_id='test_resource%d' % i,
+                    timestamp=(now + datetime.timedelta(minutes=minute)
+                               ).isoformat(),
+                    resource_metadata=metadata[i])
+                for i in range(len(metadata))])
+        return pipe.publishers[0].samples
+
+    def test_batch_transformers(self):
+        with contextlib.nested(
+            mock.patch.object(conversions.ScalingTransformer,
+                              'handle_sample'),
+            mock.patch.object(conversions.RateOfChangeTransformer,
+                              'handle_sample'),
+        ) as (scaling, rate):
+            samples = self._do_test_batch_transformers(
+                'volume / 10**9', [{}, {}])
+        self.assertFalse(scaling.called)
+        self.assertFalse(rate.called)
+        self.assertEqual(['test_resource0', 'test_resource1'] * 2,
+                         [s.resource_id for s in samples])
+        self.assertEqual([50.0, 100.0] * 2, [s.volume for s in samples])
+
+    def test_batch_transformers_error(self):
+        self._reraise_exception = False
+        samples = self._do_test_batch_transformers(
+            'volume / (10**9 * resource_metadata.cpu_number)',
+            [{'cpu_number': 1}, {}, {'cpu_number': 2}])
+        # The faulty samples only are dropped.
+        self.assertEqual(['test_resource0', 'test_resource2'] * 2,
+                         [s.resource_id for s in samples])
+        self.assertEqual([50.0, 75.0] * 2, [s.volume for s in samples])
+
+    def test_rate_of_change_batch_error(self):
+        rate = conversions.RateOfChangeTransformer(
+            target={'name': 'cpu_util', 'unit': '%',
+                    'type': sample.TYPE_GAUGE})
+
+        def cpu(volume, timestamp):
+            return sample.Sample(
+                name='cpu', type=sample.TYPE_CUMULATIVE, volume=volume,
+                unit='ns', user_id='test_user', project_id='test_proj',
+                resource_id='test_resource', timestamp=timestamp,
+                resource_metadata={})
+
+        rate.handle_samples(None, [cpu(60, '2015-01-01T00:00:00')])
+        state = rate.cache.get(('cpu', 'test_resource'))
+        with mock.patch.object(rate, '_convert', side_effect=ValueError):
+            self.assertRaises(ValueError, rate.handle_samples, None,
+                              [cpu(120, '2015-01-01T00:01:00')])
+        # The pipeline then retries the sample alone.
+        self.assertEqual(state, rate.cache.get(('cpu', 'test_resource')))
+        self.assertEqual(1.0, rate.handle_sample(
+            None, cpu(120, '2015-01-01T00:01:00')).volume)
+
+    def test_aggregator_batch_error(self):
+        aggregator = conversions.AggregatorTransformer(size=10)
+
+        def gauge(resource_id, volume):
+            return sample.Sample(
+                name='storage.objects', type=sample.TYPE_GAUGE,
+                volume=volume, unit='object', user_id='test_user',
+                project_id='test_proj', resource_id=resource_id,
+                timestamp='2015-01-01T00:00:00', resource_metadata={})
+
+        aggregator.handle_samples(None, [gauge('test_resource1', 1.0)])
+        batch = [gauge('test_resource1', 2.0), gauge('test_resource2', 3.0),
+                 gauge('test_resource1', None)]
+        self.assertRaises(TypeError, aggregator.handle_samples, None, batch)
+        self.assertEqual(1, aggregator.aggregated_samples)
+        # The pipeline then retries the samples one by one.
+        for s in batch:
+            try:
+                aggregator.handle_sample(None, s)
+            except TypeError:
+                pass
+        self.assertEqual(3, aggregator.aggregated_samples)
+        aggregator.size = 3
+        samples = sorted(aggregator.flush(None),
+                         key=lambda s: s.resource_id)
+        self.assertEqual([('test_resource1', 1.5), ('test_resource2', 3.0)],
+                         [(s.resource_id, s.volume) for s in samples])
+
+    def test_scaling_batch_volume_type(self):
+        scaling = conversions.ScalingTransformer(target={'scale': 2})
+        samples = scaling.handle_samples(None, [
+            sample.Sample(
+                name='cpu', type=sample.TYPE_CUMULATIVE, volume=volume,
+                unit='ns', user_id='test_user', project_id='test_proj',
+                resource_id='test_resource', timestamp='2015-01-01T00:00:00',
+                resource_metadata={})
+            for volume in (3, 1.5)])
+        self.assertEqual([6, 3.0], [s.volume for s in samples])
+        self.assertIsInstance(samples[0].volume, int)
+        self.assertIsInstance(samples[1].volume, float)
+
     def test_resources(self):
         resources = ['test1://', 'test2://']
         self._set_pipeline_cfg('resources', resources)
@@ -1594,6 +1900,26 @@ class BasePipelineTestCase(base.BaseTestCase):
                     })
         self._do_test_arithmetic_expr_parse(expr, expected)
 
+    def test_arithmetic_expr_compile(self):
+        function, fields = arithmetic.ArithmeticTransformer.compile_expr(
+            'cpu.volume * (1 + cpu.volume) / mem.resource_metadata.size',
+            ['cpu', 'mem'])
+        self.assertEqual([('cpu', 'volume'), ('mem', 'resource_metadata')],
+                         fields)
+        self.assertEqual(3.0, function(2, transformer.Namespace(
+            {'size': 2})))
+
+    def test_arithmetic_expr_compile_unsafe(self):
+        for expr in ('__import__("os").getpid() + cpu.volume',
+                     'cpu.volume.__class__',
+                     'open("/etc/passwd") and cpu.volume',
+                     '[x for x in cpu.volume]',
+                     'cpu.volume.real()',
+                     'cpu.volume + unknown'):
+            self.assertRaises(SyntaxError,
+                              arithmetic.ArithmeticTransformer.compile_expr,
+                              expr, ['cpu'])
+
     def _do_test_arithmetic(self, expression, scenario, expected):
         transformer_cfg = [
             {
@@ -1722,6 +2048,32 @@ class BasePipelineTestCase(base.BaseTestCase):
         expected = [50.0]
         self._do_test_arithmetic(expression, scenario, expected)
 
+    def test_arithmetic_transformer_metadata(self):
+        expression = ('100.0 * $(memory.usage) / $(memory) * '
+                      'max($(memory).resource_metadata.weight, 1)')
+        scenario = [
+            dict(name='memory', volume=1024.0, metadata={'weight': 2}),
+            dict(name='memory.usage', volume=512.0),
+        ]
+        expected = [100.0]
+        self._do_test_arithmetic(expression, scenario, expected)
+
+    def test_arithmetic_transformer_constants(self):
+        expression = '$(memory) if True else 0'
+        scenario = [
+            dict(name='memory', volume=1024.0),
+        ]
+        expected = [1024.0]
+        self._do_test_arithmetic(expression, scenario, expected)
+
+    def test_arithmetic_transformer_unsafe(self):
+        expression = '__import__("os").getpid() * $(memory)'
+        scenario = [
+            dict(name='memory', volume=1024.0),
+        ]
+        expected = []
+        self._do_test_arithmetic(expression, scenario, expected)
+
     def test_arithmetic_transformer_cache_cleared(self):
         transformer_cfg = [
             {
@@ -29,6 +29,7 @@ class MockToozCoordinator(object):
     def __init__(self, member_id, shared_storage):
         self._member_id = member_id
         self._groups = shared_storage
+        self._watchers = {}
 
     def start(self):
         pass
@@ -62,6 +63,33 @@ class MockToozCoordinator(object):
                 tooz.coordination.GroupNotCreated(group_id))
         return MockAsyncResult(self._groups[group_id])
 
+    def watch_join_group(self, group_id, callback):
+        watched = self._watchers.setdefault(
+            group_id, [set(self._groups.get(group_id, {})), []])
+        watched[1].append(callback)
+
+    watch_leave_group = watch_join_group
+
+    def update_capabilities(self, group_id, capabilities):
+        self._groups[group_id][self._member_id]['capabilities'] = capabilities
+        return MockAsyncResult(None)
+
+    def get_member_capabilities(self, group_id, member_id):
+        return MockAsyncResult(
+            self._groups[group_id][member_id]['capabilities'])
+
+    def run_watchers(self):
+        for group_id, watched in self._watchers.items():
+            members = set(self._groups.get(group_id, {}))
+            events = ([tooz.coordination.MemberJoinedGroup(group_id, m)
+                       for m in members - watched[0]] +
+                      [tooz.coordination.MemberLeftGroup(group_id, m)
+                       for m in watched[0] - members])
+            watched[0] = members
+            for event in events:
+                for callback in set(watched[1]):
+                    callback(event)
+
 
 class MockToozCoordExceptionRaiser(MockToozCoordinator):
     def start(self):
@@ -222,3 +250,190 @@ class TestPartitioning(base.BaseTestCase):
             coord.heartbeat()
         for e in expected_errors:
             self.assertNotIn(e, self.str_handler.messages['error'])
+
+    def test_membership_cached(self):
+        coord = self._get_new_started_coordinator(self.shared_storage,
+                                                  'agent1')
+        coord.join_group('group')
+        all_resources = ['resource_%s' % i for i in range(100)]
+        with mock.patch.object(coord._coordinator, 'get_members',
+                               wraps=coord._coordinator.get_members) as gm:
+            with mock.patch.object(utils, 'HashRing',
+                                   wraps=utils.HashRing) as hash_ring:
+                self.assertEqual(all_resources,
+                                 coord.extract_my_subset('group',
+                                                         all_resources))
+                coord.heartbeat()
+                self.assertEqual(all_resources,
+                                 coord.extract_my_subset('group',
+                                                         all_resources))
+                self.assertEqual(1, gm.call_count)
+                self.assertEqual(1, hash_ring.call_count)
+
+                other = self._get_new_started_coordinator(
+                    self.shared_storage, 'agent2')
+                other.join_group('group')
+                coord.heartbeat()
+                subset = coord.extract_my_subset('group', all_resources)
+                self.assertEqual(2, gm.call_count)
+                self.assertEqual(2, hash_ring.call_count)
+        hr = utils.HashRing(['agent1', 'agent2'])
+        self.assertEqual([r for r in all_resources
+                          if hr.get_node(r) == 'agent1'], subset)
+
+    def test_partitioning_crc32(self):
+        self.CONF.set_override('hash_function', 'crc32',
+                               group='coordination')
+        all_resources = ['resource_%s' % i for i in range(1000)]
+        agent1 = self._get_new_started_coordinator(self.shared_storage,
+                                                   'agent1')
+        agent1.join_group('group')
+        agent2 = self._get_new_started_coordinator(self.shared_storage,
+                                                   'agent2')
+        agent2.join_group('group')
+        subset = agent1.extract_my_subset('group', all_resources)
+        hr = utils.HashRing(['agent1', 'agent2'], hash_function='crc32')
+        self.assertEqual([r for r in all_resources
+                          if hr.get_node(r) == 'agent1'], subset)
+        self.assertNotEqual(
+            subset, [r for r in all_resources
+                     if utils.HashRing(['agent1', 'agent2']).get_node(r) ==
+                     'agent1'])
+
+    def test_weighted_partitioning(self):
+        all_resources = ['resource_%s' % i for i in range(1000)]
+        self.CONF.set_override('weight', 3.0, group='coordination')
+        agent1 = self._get_new_started_coordinator(self.shared_storage,
+                                                   'agent1')
+        agent1.join_group('group')
+        self.CONF.set_override('weight', 1.0, group='coordination')
+        agent2 = self._get_new_started_coordinator(self.shared_storage,
+                                                   'agent2')
+        agent2.join_group('group')
+        subset1 = agent1.extract_my_subset('group', all_resources)
+        subset2 = agent2.extract_my_subset('group', all_resources)
+        hr = utils.HashRing(['agent1', 'agent2'], weights={'agent1': 3.0})
+        self.assertEqual([r for r in all_resources
+                          if hr.get_node(r) == 'agent1'], subset1)
+        self.assertEqual(set(all_resources) - set(subset1), set(subset2))
+        self.assertTrue(len(subset1) > 2 * len(subset2))
+
+        # The weight is still published along with the state.
+        agent1.publish_state('group', {'sink:0': []})
+        agent2._rings.clear()
+        self.assertEqual(subset2,
+                         agent2.extract_my_subset('group', all_resources))
+
+    def test_membership_not_watched(self):
+        coord = self._get_new_started_coordinator(self.shared_storage,
+                                                  'agent1')
+        coord.join_group('group')
+        with mock.patch.object(coord._coordinator, 'watch_join_group',
+                               side_effect=NotImplementedError):
+            with mock.patch.object(coord._coordinator, 'get_members',
+                                   wraps=coord._coordinator.get_members) as gm:
+                coord.extract_my_subset('group', ['res1'])
+                coord.extract_my_subset('group', ['res1'])
+        self.assertEqual(2, gm.call_count)
+
+    def test_membership_watchers_not_run(self):
+        coord = self._get_new_started_coordinator(self.shared_storage,
+                                                  'agent1')
+        coord.join_group('group')
+        with mock.patch.object(coord._coordinator, 'run_watchers',
+                               side_effect=NotImplementedError) as rw:
+            with mock.patch.object(coord._coordinator, 'get_members',
+                                   wraps=coord._coordinator.get_members) as gm:
+                coord.extract_my_subset('group', ['res1'])
+                coord.heartbeat()
+                coord.heartbeat()
+                other = self._get_new_started_coordinator(
+                    self.shared_storage, 'agent2')
+                other.join_group('group')
+                self.assertEqual(2, len(coord._get_members('group')))
+                coord.extract_my_subset('group', ['res1'])
+        self.assertEqual(1, rw.call_count)
+        self.assertEqual(3, gm.call_count)
+
+    def test_rebalance(self):
+        all_resources = ['resource_%s' % i for i in range(100)]
+        agent1 = self._get_new_started_coordinator(self.shared_storage,
+                                                   'agent1')
+        agent1.join_group('group')
+        rebalances = []
+        agent1.watch_rebalance(rebalances.append)
+        agent1.extract_my_subset('group', all_resources)
+        self.assertEqual([], rebalances)
+
+        agent2 = self._get_new_started_coordinator(self.shared_storage,
+                                                   'agent2')
+        agent2.join_group('group')
+        agent2.watch_rebalance(rebalances.append)
+        subset2 = agent2.extract_my_subset('group', all_resources)
+        self.assertEqual([coordination.Rebalance('group', subset2, [])],
+                         rebalances)
+
+        agent1.heartbeat()
+        subset1 = agent1.extract_my_subset('group', all_resources)
+        self.assertEqual(coordination.Rebalance('group', [], subset2),
+                         rebalances[1])
+        self.assertEqual(sorted(all_resources), sorted(subset1 + subset2))
+        # Each object is only reported once.
+        agent1.extract_my_subset('group', all_resources)
+        self.assertEqual(2, len(rebalances))
+        self.assertEqual(rebalances[1], agent1.rebalances['group'])
+
+    def test_publish_state(self):
+        agent1 = self._get_new_started_coordinator(self.shared_storage,
+                                                   'agent1')
+        agent1.join_group('group')
+        agent2 = self._get_new_started_coordinator(self.shared_storage,
+                                                   'agent2')
+        agent2.join_group('group')
+        state = {'sink:0': [['cpu', 'r', 1, 't']]}
+        self.assertEqual(1, agent1.publish_state('group', state))
+        self.assertEqual([('agent1', 1, state)],
+                         agent2.fetch_state('group'))
+        self.assertEqual([], agent1.fetch_state('group'))
+
+        self.assertFalse(agent1.state_acknowledged('group', 1, ['agent2']))
+        agent2.acknowledge_state('group', 'agent1', 1)
+        self.assertTrue(agent1.state_acknowledged('group', 1, ['agent2']))
+        self.assertEqual(2, agent1.publish_state('group', state))
+        self.assertFalse(agent1.state_acknowledged('group', 2, ['agent2']))
+
+        self.assertEqual(3, agent1.publish_state('group', None))
+        self.assertEqual([], agent2.fetch_state('group'))
+
+    def test_publish_state_too_large(self):
+        self.CONF.set_override('max_state_size', 100, group='coordination')
+        agent1 = self._get_new_started_coordinator(self.shared_storage,
+                                                   'agent1')
+        agent1.join_group('group')
+        agent2 = self._get_new_started_coordinator(self.shared_storage,
+                                                   'agent2')
+        agent2.join_group('group')
+        state = {'sink:0': [['cpu', 'r%d' % i, 1, 't'] for i in range(10)]}
+        self.assertIsNone(agent1.publish_state('group', state))
+        self.assertEqual([], agent2.fetch_state('group'))
+
+    def test_weights_fetched_once(self):
+        agent1 = self._get_new_started_coordinator(self.shared_storage,
+                                                   'agent1')
+        agent1.join_group('group')
+        agent2 = self._get_new_started_coordinator(self.shared_storage,
+                                                   'agent2')
+        agent2.join_group('group')
+        with mock.patch.object(agent1._coordinator,
+                               'get_member_capabilities',
+                               wraps=agent1._coordinator
+                               .get_member_capabilities) as gmc:
+            agent1.extract_my_subset('group', ['res1'])
+            agent3 = self._get_new_started_coordinator(self.shared_storage,
+                                                       'agent3')
+            agent3.join_group('group')
+            agent1.heartbeat()
+            agent1.extract_my_subset('group', ['res1'])
+        self.assertEqual([mock.call('group', 'agent2'),
+                          mock.call('group', 'agent3')],
+                         gmc.call_args_list)
@@ -16,6 +16,8 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import time
+
 import mock
 import novaclient
 from oslo.config import fixture as fixture_config
@@ -238,6 +240,22 @@ class TestNovaClient(base.BaseTestCase):
             self.assertIsNone(instance.kernel_id)
             self.assertIsNone(instance.ramdisk_id)
 
+    def test_with_flavor_and_image_cache_across_calls(self):
+        self.nv._with_flavor_and_image(self.fake_servers_list())
+        results = self.nv._with_flavor_and_image(self.fake_servers_list())
+        self.assertEqual('m1.tiny', results[0].flavor['name'])
+        self.assertEqual('ubuntu-12.04-x86', results[0].image['name'])
+        self.assertEqual(2, self._flavors_count)
+        self.assertEqual(2, self._images_count)
+
+    def test_with_flavor_and_image_cache_expired(self):
+        self.CONF.set_override('nova_lookup_cache_ttl', 0)
+        self.nv._with_flavor_and_image(self.fake_servers_list())
+        with mock.patch('time.time', return_value=time.time() + 1):
+            self.nv._with_flavor_and_image(self.fake_servers_list())
+        self.assertEqual(4, self._flavors_count)
+        self.assertEqual(4, self._images_count)
+
     def test_with_missing_image_instance(self):
         instances = self.fake_instance_image_missing()
         results = self.nv._with_flavor_and_image(instances)
@@ -18,9 +18,13 @@
 # under the License.
 """Tests for ceilometer/utils.py
 """
+import bisect
 import datetime
 import decimal
+import hashlib
+import struct
 
+import eventlet
 from oslotest import base
 
 from ceilometer import utils
@@ -181,3 +185,109 @@ class TestUtils(base.BaseTestCase):
             assignments[k] -= n
         reassigned = len([c for c in assignments if c != 0])
         self.assertTrue(reassigned < num_keys / num_nodes)
+
+    def test_hash_ring_crc32(self):
+        nodes = [str(x) for x in range(10)]
+        hr = utils.HashRing(nodes, hash_function='crc32')
+        buckets = dict((n, 0) for n in nodes)
+        for k in range(1000):
+            buckets[hr.get_node(str(k))] += 1
+        self.assertTrue(max(buckets.values()) - min(buckets.values()) < 30)
+        self.assertRaises(ValueError, utils.HashRing, nodes,
+                          hash_function='sha1')
+
+    def test_hash_ring_previous_layout(self):
+        # The ring of the previous releases, for rolling upgrades.
+        def md5(key):
+            return struct.unpack_from('>I', hashlib.md5(key).digest())[0]
+
+        nodes = ['agent1', 'agent2', 'agent3']
+        points = sorted((md5('%s-%s' % (node, r)), node)
+                        for node in nodes for r in range(100))
+        hr = utils.HashRing(nodes)
+        for k in range(1000):
+            position = bisect.bisect([p[0] for p in points], md5(str(k)))
+            self.assertEqual(points[position % len(points)][1],
+                             hr.get_node(str(k)))
+
+    def test_hash_ring_get_nodes(self):
+        for hash_function in utils.HashRing.HASH_FUNCTIONS:
+            hr = utils.HashRing(['a', 'b', 'c'], hash_function=hash_function)
+            keys = [str(k) for k in range(100)]
+            self.assertEqual([hr.get_node(k) for k in keys],
+                             hr.get_nodes(keys))
+            empty = utils.HashRing([], hash_function=hash_function)
+            self.assertIsNone(empty.get_node('key'))
+            self.assertEqual([None, None], empty.get_nodes(['a', 'b']))
+
+    def test_hash_ring_weights(self):
+        for hash_function in utils.HashRing.HASH_FUNCTIONS:
+            hr = utils.HashRing(['big', 'small'], weights={'big': 3},
+                                hash_function=hash_function)
+            nodes = hr.get_nodes([str(k) for k in range(4000)])
+            self.assertTrue(2.5 < nodes.count('big') /
+                            float(nodes.count('small')) < 3.5)
+            # The weight of a node moves keys from and to this node only.
+            heavier = utils.HashRing(['big', 'small', 'other'],
+                                     weights={'big': 3},
+                                     hash_function=hash_function)
+            lighter = utils.HashRing(['big', 'small', 'other'],
+                                     weights={'big': 3, 'other': 0.5},
+                                     hash_function=hash_function)
+            for k in range(1000):
+                before = heavier.get_node(str(k))
+                after = lighter.get_node(str(k))
+                self.assertTrue(before == after or before == 'other')
+
+    def test_single_flight(self):
+        cache = utils.SingleFlightCache()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            eventlet.sleep(0.01)
+            cache['key'] = len(calls)
+            return len(calls)
+
+        first = eventlet.spawn(utils.single_flight, cache, 'key', compute)
+        second = eventlet.spawn(utils.single_flight, cache, 'key', compute)
+        self.assertEqual([1, 1], [first.wait(), second.wait()])
+        self.assertEqual({'key': 1}, cache)
+
+        # The computation is run again once over.
+        self.assertEqual(2, utils.single_flight(cache, 'key', compute))
+
+    def test_single_flight_exception(self):
+        cache = utils.SingleFlightCache()
+
+        def compute():
+            eventlet.sleep(0.01)
+            raise ValueError('failed')
+
+        first = eventlet.spawn(utils.single_flight, cache, 'key', compute)
+        second = eventlet.spawn(utils.single_flight, cache, 'key', compute)
+        self.assertRaises(ValueError, first.wait)
+        self.assertRaises(ValueError, second.wait)
+
+    def test_single_flight_interrupted(self):
+        cache = utils.SingleFlightCache()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            eventlet.sleep(0.05 if len(calls) == 1 else 0)
+            return len(calls)
+
+        def interrupted():
+            with eventlet.Timeout(0.01, False):
+                return utils.single_flight(cache, 'key', compute)
+
+        first = eventlet.spawn(interrupted)
+        second = eventlet.spawn(utils.single_flight, cache, 'key', compute)
+        self.assertIsNone(first.wait())
+        # The waiter ran the computation itself.
+        self.assertEqual(2, second.wait())
+        self.assertEqual(3, utils.single_flight(cache, 'key', compute))
+
+    def test_single_flight_dict(self):
+        self.assertEqual(1, utils.single_flight({}, 'key', lambda: 1))
@@ -41,6 +41,10 @@ class TransformerExtensionManager(extension.ExtensionManager):
 class TransformerBase(object):
     """Base class for plugins that transform the sample."""
 
+    # Whether handle_samples does better than handling the samples one by
+    # one, the pipeline then passing it the samples in batches.
+    supports_batch = False
+
     def __init__(self, **kwargs):
         """Setup transformer.
 
@@ -61,6 +65,20 @@ class TransformerBase(object):
         :param sample: A sample.
         """
 
+    def handle_samples(self, context, samples):
+        """Transform a batch of samples.
+
+        Implementations must leave the state of the transformer untouched
+        when failing, the pipeline then passing the samples one by one to
+        handle_sample so that only the faulty ones are dropped.
+
+        :param context: Passed from the data collector.
+        :param samples: A list of samples.
+        :return: The list of the transformed samples.
+        """
+        return [s for s in (self.handle_sample(context, sample)
+                            for sample in samples) if s]
+
     def flush(self, context):
         """Flush samples cached previously.
 
@@ -68,6 +86,32 @@ class TransformerBase(object):
         """
         return []
 
+    def export_state(self, match):
+        """Return the state kept for some resources.
+
+        Lets another agent, the resources being moved to it, take over
+        the state through its import_state method. The state is kept until
+        drop_state is called, once the take over is acknowledged.
+
+        :param match: tells whether a resource id is one of the resources
+        :return: a JSON serializable state, None if there is none
+        """
+        return None
+
+    def drop_state(self, match):
+        """Drop the state kept for some resources.
+
+        :param match: tells whether a resource id is one of the resources
+        """
+
+    def import_state(self, state, match):
+        """Take over the state exported by another agent.
+
+        :param state: the state returned by export_state
+        :param match: tells whether a resource id is one of the resources
+                      taken over
+        """
+
 
 class Namespace(object):
     """Encapsulates the namespace.
@@ -15,13 +15,12 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import ast
 import collections
 import keyword
 import math
 import re
 
-import six
-
 from ceilometer.openstack.common.gettextutils import _
 from ceilometer.openstack.common import log
 from ceilometer import sample
@@ -39,6 +38,21 @@ class ArithmeticTransformer(transformer.TransformerBase):
 
     meter_name_re = re.compile(r'\$\(([\w\.\-]+)\)')
 
+    # The functions an expression may call.
+    functions = {'abs': abs, 'bool': bool, 'float': float, 'int': int,
+                 'max': max, 'min': min, 'round': round}
+
+    # The syntax an expression may use, being only arithmetic and logic
+    # over the fields of the samples, some of the node types depending
+    # on the version of Python.
+    allowed_nodes = frozenset([
+        'Expression', 'BinOp', 'UnaryOp', 'BoolOp', 'Compare', 'IfExp',
+        'Call', 'Attribute', 'Subscript', 'Index', 'Name', 'Load',
+        'Num', 'Str', 'NameConstant', 'Constant',
+        'Add', 'Sub', 'Mult', 'Div', 'FloorDiv', 'Mod', 'Pow',
+        'UAdd', 'USub', 'Not', 'And', 'Or',
+        'Eq', 'NotEq', 'Lt', 'LtE', 'Gt', 'GtE', 'Is', 'IsNot'])
+
     def __init__(self, target=None, **kwargs):
         super(ArithmeticTransformer, self).__init__(**kwargs)
         target = target or {}
@@ -47,18 +61,28 @@ class ArithmeticTransformer(transformer.TransformerBase):
         self.expr_escaped, self.escaped_names = self.parse_expr(self.expr)
         self.required_meters = self.escaped_names.values()
         self.misconfigured = len(self.required_meters) == 0
+        if not self.misconfigured:
+            try:
+                self.function, self.fields = self.compile_expr(
+                    self.expr_escaped, self.required_meters)
+            except SyntaxError as e:
+                LOG.warn(_('Unable to compile expression %(expr)s: %(exc)s'),
+                         {'expr': self.expr, 'exc': str(e)})
+                self.misconfigured = True
         if not self.misconfigured:
             self.reference_meter = self.required_meters[0]
             # convert to set for more efficient contains operation
             self.required_meters = set(self.required_meters)
             self.cache = collections.defaultdict(dict)
             self.latest_timestamp = None
-        else:
+        elif not self.required_meters:
             LOG.warn(_('Arithmetic transformer must use at least one'
                        ' meter in expression \'%s\''), self.expr)
 
     def _update_cache(self, _sample):
         """Update the cache with the latest sample."""
+        if self.misconfigured:
+            return
         escaped_name = self.escaped_names.get(_sample.name, '')
         if escaped_name not in self.required_meters:
             return
@@ -68,32 +92,47 @@ class ArithmeticTransformer(transformer.TransformerBase):
         """Check if all the required meters are available in the cache."""
         return len(self.cache[resource_id]) == len(self.required_meters)
 
-    def _calculate(self, resource_id):
-        """Evaluate the expression and return a new sample if successful."""
-        ns_dict = dict((m, s.as_dict()) for m, s
-                       in six.iteritems(self.cache[resource_id]))
-        ns = transformer.Namespace(ns_dict)
-        try:
-            new_volume = eval(self.expr_escaped, {}, ns)
-            if math.isnan(new_volume):
-                raise ArithmeticError(_('Expression evaluated to '
-                                        'a NaN value!'))
-
-            reference_sample = self.cache[resource_id][self.reference_meter]
-            return sample.Sample(
-                name=self.target.get('name', reference_sample.name),
-                unit=self.target.get('unit', reference_sample.unit),
-                type=self.target.get('type', reference_sample.type),
-                volume=float(new_volume),
-                user_id=reference_sample.user_id,
-                project_id=reference_sample.project_id,
-                resource_id=reference_sample.resource_id,
-                timestamp=self.latest_timestamp,
-                resource_metadata=reference_sample.resource_metadata
-            )
-        except Exception as e:
-            LOG.warn(_('Unable to evaluate expression %(expr)s: %(exc)s'),
-                     {'expr': self.expr, 'exc': str(e)})
+    @staticmethod
+    def _field(s, field):
+        """Return a field of a sample as seen by the expression."""
+        if field is None:
+            return transformer.Namespace(s.as_dict())
+        value = vars(s).get(field, {})
+        return transformer.Namespace(value) if isinstance(value,
+                                                          dict) else value
+
+    def _calculate(self, resources):
+        """Evaluate the expression and return the new samples.
+
+        :param resources: the cached samples of each resource, by meter
+        """
+        function = self.function
+        fields = self.fields
+        new_samples = []
+        for samples in resources:
+            try:
+                new_volume = function(*[self._field(samples[meter], field)
+                                        for meter, field in fields])
+                if math.isnan(new_volume):
+                    raise ArithmeticError(_('Expression evaluated to '
+                                            'a NaN value!'))
+
+                reference_sample = samples[self.reference_meter]
+                new_samples.append(sample.Sample(
+                    name=self.target.get('name', reference_sample.name),
+                    unit=self.target.get('unit', reference_sample.unit),
+                    type=self.target.get('type', reference_sample.type),
+                    volume=float(new_volume),
+                    user_id=reference_sample.user_id,
+                    project_id=reference_sample.project_id,
+                    resource_id=reference_sample.resource_id,
+                    timestamp=self.latest_timestamp,
+                    resource_metadata=reference_sample.resource_metadata
+                ))
+            except Exception as e:
+                LOG.warn(_('Unable to evaluate expression %(expr)s: %(exc)s'),
+                         {'expr': self.expr, 'exc': str(e)})
+        return new_samples
 
     def handle_sample(self, context, _sample):
         self._update_cache(_sample)
@@ -102,16 +141,87 @@ class ArithmeticTransformer(transformer.TransformerBase):
     def flush(self, context):
         new_samples = []
         if not self.misconfigured:
+            resources = []
             for resource_id in self.cache:
                 if self._check_requirements(resource_id):
-                    new_samples.append(self._calculate(resource_id))
+                    resources.append(self.cache[resource_id])
                 else:
                     LOG.warn(_('Unable to perform calculation, not all of '
                                '{%s} are present'),
                              ', '.join(self.required_meters))
+            new_samples = self._calculate(resources)
             self.cache.clear()
         return new_samples
 
+    @classmethod
+    def compile_expr(cls, expr, meters):
+        """Compiles an escaped expression into a function.
+
+        The function takes as arguments the fields of the samples read by
+        the expression, so that only those are looked up, and can only
+        call the allowed functions.
+
+        :param expr: escaped expression
+        :param meters: escaped names of the meters of the expression
+        :return: A tuple of the function and of the (meter, field) pairs
+                 it takes, the field being None for a whole sample
+        :raises SyntaxError: if the expression is not valid or not only
+                             arithmetic over the samples
+        """
+        tree = ast.parse(expr.strip(), mode='eval')
+        for node in ast.walk(tree):
+            kind = type(node).__name__
+            if kind not in cls.allowed_nodes:
+                raise SyntaxError(_('%s is not allowed') % kind)
+            if isinstance(node, ast.Name) and not (
+                    node.id in meters or node.id in cls.functions or
+                    node.id in ('True', 'False', 'None')):
+                raise SyntaxError(_('Unknown name %s') % node.id)
+            if isinstance(node, ast.Attribute) and node.attr.startswith('_'):
+                raise SyntaxError(_('Private field %s') % node.attr)
+            if isinstance(node, ast.Call) and (
+                    not isinstance(node.func, ast.Name) or
+                    node.func.id not in cls.functions or node.keywords or
+                    getattr(node, 'starargs', None) or
+                    getattr(node, 'kwargs', None)):
+                raise SyntaxError(_('Only %s can be called')
+                                  % ', '.join(sorted(cls.functions)))
+
+        fields = []
+        names = {}
+
+        def argument(node, meter, field):
+            if (meter, field) not in names:
+                names[(meter, field)] = '_%d' % len(fields)
+                fields.append((meter, field))
+            return ast.copy_location(
+                ast.Name(id=names[(meter, field)], ctx=ast.Load()), node)
+
+        class Binder(ast.NodeTransformer):
+            """Replaces the fields of the samples with arguments."""
+
+            def visit_Attribute(self, node):
+                if (isinstance(node.value, ast.Name) and
+                        node.value.id in meters):
+                    return argument(node, node.value.id, node.attr)
+                return self.generic_visit(node)
+
+            def visit_Name(self, node):
+                if node.id in meters:
+                    return argument(node, node.id, None)
+                return node
+
+        body = Binder().visit(tree).body
+        function = ast.parse('lambda %s: None' % ', '.join(
+            '_%d' % i for i in range(len(fields))), mode='eval')
+        function.body.body = body
+        code = compile(ast.fix_missing_locations(function), '<expr>', 'eval')
+        # Without builtins, the constants are plain names on Python 2.
+        namespace = {'__builtins__': {}, 'True': True, 'False': False,
+                     'None': None}
+        namespace.update(cls.functions)
+        return eval(code, namespace), fields
+
     @classmethod
     def parse_expr(cls, expr):
         """Transforms meter names in the expression into valid identifiers.
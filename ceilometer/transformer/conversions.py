@@ -15,11 +15,23 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import array
+import calendar
 import collections
+import copy
+import datetime
+import heapq
 import re
+import sys
+import time
 
+import iso8601
 from oslo.utils import timeutils
 import six
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from ceilometer.openstack.common.gettextutils import _
 from ceilometer.openstack.common import log
@@ -29,9 +41,41 @@ from ceilometer import transformer
 LOG = log.getLogger(__name__)
 
 
+def _rates(volumes, timestamps, prev_volumes, prev_timestamps, cumulative):
+    """Return the per second rates of change of columns of volumes.
+
+    We only allow negative deltas for noncumulative samples, whereas for
+    cumulative we assume that a reset has occurred in the interim so that
+    the current volume gives a lower bound on growth.
+    """
+    if numpy is not None:
+        volumes = numpy.array(volumes, dtype=numpy.float64)
+        prev_volumes = numpy.array(prev_volumes, dtype=numpy.float64)
+        time_deltas = (numpy.array(timestamps, dtype=numpy.float64) -
+                       numpy.array(prev_timestamps, dtype=numpy.float64))
+        volume_deltas = numpy.where(
+            numpy.array(cumulative, dtype=bool) & (prev_volumes > volumes),
+            volumes, volumes - prev_volumes)
+        rates = numpy.zeros(len(volumes))
+        numpy.divide(volume_deltas, time_deltas, out=rates,
+                     where=time_deltas != 0)
+        return rates.tolist()
+    rates = []
+    for volume, timestamp, prev_volume, prev_timestamp, cumul in zip(
+            volumes, timestamps, prev_volumes, prev_timestamps, cumulative):
+        time_delta = timestamp - prev_timestamp
+        volume_delta = (volume - prev_volume
+                        if prev_volume <= volume or not cumul else volume)
+        rates.append((1.0 * volume_delta / time_delta)
+                     if time_delta else 0.0)
+    return rates
+
+
 class ScalingTransformer(transformer.TransformerBase):
     """Transformer to apply a scaling conversion."""
 
+    supports_batch = True
+
     def __init__(self, source=None, target=None, **kwargs):
         """Initialize transformer with configured parameters.
 
@@ -45,6 +89,7 @@ class ScalingTransformer(transformer.TransformerBase):
         self.source = source
         self.target = target
         self.scale = target.get('scale')
+        self._code = None
         LOG.debug(_('scaling conversion transformer with source:'
                     ' %(source)s target: %(target)s:')
                   % {'source': source,
@@ -59,9 +104,33 @@ class ScalingTransformer(transformer.TransformerBase):
         ns = transformer.Namespace(s.as_dict())
 
         scale = self.scale
-        return ((eval(scale, {}, ns) if isinstance(scale, six.string_types)
+        return ((eval(self._compile(), {}, ns)
+                 if isinstance(scale, six.string_types)
                  else s.volume * scale) if scale else s.volume)
 
+    def _compile(self):
+        """Return the scaling expression compiled."""
+        if self._code is None or self._code[0] != self.scale:
+            self._code = (self.scale, compile(self.scale, '<scale>', 'eval'))
+        return self._code[1]
+
+    def _scales(self, samples):
+        """Apply the scaling factor to the volumes of a batch of samples."""
+        scale = self.scale
+        if not scale:
+            return [s.volume for s in samples]
+        if isinstance(scale, six.string_types):
+            code = self._compile()
+            return [eval(code, {}, transformer.Namespace(s.as_dict()))
+                    for s in samples]
+        volumes = [s.volume for s in samples]
+        # The products are floats only with a float factor, so that the
+        # type of the volumes is kept as by the scaling of a sample.
+        if numpy is not None and isinstance(scale, float) and all(
+                isinstance(v, (float,) + six.integer_types) for v in volumes):
+            return (numpy.array(volumes, numpy.float64) * scale).tolist()
+        return [v * scale for v in volumes]
+
     def _map(self, s, attr):
         """Apply the name or unit mapping if configured."""
         mapped = None
@@ -75,13 +144,13 @@ class ScalingTransformer(transformer.TransformerBase):
                     pass
         return mapped or self.target.get(attr, getattr(s, attr))
 
-    def _convert(self, s, growth=1):
+    def _convert(self, s, growth=1, volume=None):
         """Transform the appropriate sample fields."""
         return sample.Sample(
             name=self._map(s, 'name'),
             unit=self._map(s, 'unit'),
             type=self.target.get('type', s.type),
-            volume=self._scale(s) * growth,
+            volume=(self._scale(s) if volume is None else volume) * growth,
             user_id=s.user_id,
             project_id=s.project_id,
             resource_id=s.resource_id,
@@ -89,14 +158,139 @@ class ScalingTransformer(transformer.TransformerBase):
             resource_metadata=s.resource_metadata
         )
 
+    def _converts(self, s):
+        """Tell whether the sample is of the source unit."""
+        return self.source.get('unit', s.unit) == s.unit
+
     def handle_sample(self, context, s):
         """Handle a sample, converting if necessary."""
         LOG.debug(_('handling sample %s'), (s,))
-        if self.source.get('unit', s.unit) == s.unit:
+        if self._converts(s):
             s = self._convert(s)
             LOG.debug(_('converted to: %s'), (s,))
         return s
 
+    def handle_samples(self, context, samples):
+        """Handle a batch of samples, converting if necessary."""
+        volumes = iter(self._scales([s for s in samples
+                                     if self._converts(s)]))
+        return [self._convert(s, volume=next(volumes))
+                if self._converts(s) else s for s in samples]
+
+
+class RateState(object):
+    """The last volume and timestamp of each meter of each resource.
+
+    The volumes, the timestamps, as seconds since the epoch, and the time
+    each entry was last updated are kept in parallel arrays of doubles, a
+    dict mapping the (meter, resource) keys to their index in the arrays.
+    The slots of the dropped entries are reused.
+
+    Entries not updated for ttl seconds are dropped, and once max_size
+    entries are kept the least recently updated tenth of them is, so that
+    the state of short-lived resources does not pile up.
+
+    :param max_size: maximum number of entries, None for no limit
+    :param ttl: seconds an entry is kept without update, None for ever
+    """
+
+    __slots__ = ('max_size', 'ttl', '_index', '_keys', '_volumes',
+                 '_timestamps', '_updated', '_free', '_next_sweep')
+
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._index = {}
+        self._keys = []
+        self._volumes = array.array('d')
+        self._timestamps = array.array('d')
+        self._updated = array.array('d')
+        self._free = []
+        self._next_sweep = None
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def _expired(self, i, now):
+        return self.ttl is not None and self._updated[i] < now - self.ttl
+
+    def get(self, key, now=None):
+        """Return the (volume, timestamp) of an entry, or None."""
+        i = self._index.get(key)
+        if i is None or self._expired(i, time.time() if now is None else now):
+            return None
+        return self._volumes[i], self._timestamps[i]
+
+    def update(self, key, volume, timestamp, now=None):
+        """Set an entry, returning its former (volume, timestamp) if any."""
+        now = time.time() if now is None else now
+        if self._next_sweep is None or now >= self._next_sweep:
+            self._evict(now)
+        i = self._index.get(key)
+        prev = None
+        if i is None:
+            if self.max_size and len(self._index) >= self.max_size:
+                self._evict(now, full=True)
+            i = self._allocate(key)
+        elif not self._expired(i, now):
+            prev = self._volumes[i], self._timestamps[i]
+        self._volumes[i] = volume
+        self._timestamps[i] = timestamp
+        self._updated[i] = now
+        return prev
+
+    def _allocate(self, key):
+        if self._free:
+            i = self._free.pop()
+            self._keys[i] = key
+        else:
+            i = len(self._keys)
+            self._keys.append(key)
+            self._volumes.append(0.0)
+            self._timestamps.append(0.0)
+            self._updated.append(0.0)
+        self._index[key] = i
+        return i
+
+    def pop(self, key):
+        """Drop an entry, returning its (volume, timestamp)."""
+        i = self._index.pop(key)
+        self._keys[i] = None
+        self._free.append(i)
+        return self._volumes[i], self._timestamps[i]
+
+    def _evict(self, now, full=False):
+        if self.ttl is not None:
+            self._next_sweep = now + self.ttl
+            horizon = now - self.ttl
+            updated = self._updated
+            for key in [k for k, i in six.iteritems(self._index)
+                        if updated[i] < horizon]:
+                self.pop(key)
+        if full and len(self._index) >= self.max_size:
+            updated, index = self._updated, self._index
+            count = len(index) - self.max_size + max(1, self.max_size // 10)
+            for key in heapq.nsmallest(count, index,
+                                       key=lambda k: updated[index[k]]):
+                self.pop(key)
+
+    def memory_footprint(self):
+        """Return the approximate number of bytes used by the entries.
+
+        The strings of the keys, shared with the samples, are not counted.
+        """
+        arrays = (self._volumes, self._timestamps, self._updated)
+        return (sys.getsizeof(self._index) + sys.getsizeof(self._keys) +
+                sys.getsizeof(self._free) +
+                sum(sys.getsizeof(k) for k in self._index) +
+                sum(a.buffer_info()[1] * a.itemsize for a in arrays))
+
 
 class RateOfChangeTransformer(ScalingTransformer):
     """Transformer based on the rate of change of a sample volume.
@@ -105,24 +299,44 @@ class RateOfChangeTransformer(ScalingTransformer):
     and producing a gauge value based on the proportion of some maximum used.
     """
 
-    def __init__(self, **kwargs):
-        """Initialize transformer with configured parameters."""
+    # Number of parsed timestamps remembered, the samples of a polling
+    # cycle mostly sharing the same few.
+    TIMESTAMP_CACHE_SIZE = 1024
+
+    def __init__(self, max_size=None, ttl=None, **kwargs):
+        """Initialize transformer with configured parameters.
+
+        :param max_size: maximum number of resource volumes kept
+        :param ttl: seconds after which the volume of a resource no longer
+                    sampled is dropped, None to keep it for ever
+        """
         super(RateOfChangeTransformer, self).__init__(**kwargs)
-        self.cache = {}
+        self.cache = RateState(int(max_size) if max_size else None,
+                               float(ttl) if ttl else None)
+        self._epochs = {}
         self.scale = self.scale or '1'
 
+    def _epoch(self, timestamp):
+        """Return an ISO 8601 timestamp as seconds since the epoch."""
+        epoch = self._epochs.get(timestamp)
+        if epoch is None:
+            parsed = timeutils.parse_isotime(timestamp)
+            epoch = (calendar.timegm(parsed.utctimetuple()) +
+                     parsed.microsecond / 1000000.0)
+            if len(self._epochs) >= self.TIMESTAMP_CACHE_SIZE:
+                self._epochs.clear()
+            self._epochs[timestamp] = epoch
+        return epoch
+
     def handle_sample(self, context, s):
         """Handle a sample, converting if necessary."""
         LOG.debug(_('handling sample %s'), (s,))
-        key = s.name + s.resource_id
-        prev = self.cache.get(key)
-        timestamp = timeutils.parse_isotime(s.timestamp)
-        self.cache[key] = (s.volume, timestamp)
+        timestamp = self._epoch(s.timestamp)
+        prev = self.cache.update((s.name, s.resource_id), s.volume, timestamp)
 
         if prev:
-            prev_volume = prev[0]
-            prev_timestamp = prev[1]
-            time_delta = timeutils.delta_seconds(prev_timestamp, timestamp)
+            prev_volume, prev_timestamp = prev
+            time_delta = timestamp - prev_timestamp
             # we only allow negative deltas for noncumulative samples, whereas
             # for cumulative we assume that a reset has occurred in the interim
             # so that the current volume gives a lower bound on growth
@@ -141,6 +355,74 @@ class RateOfChangeTransformer(ScalingTransformer):
             s = None
         return s
 
+    def handle_samples(self, context, samples):
+        """Handle a batch of samples, converting if necessary.
+
+        The predecessors, the rates and the converted samples are all
+        computed before the state is updated, so that it is left untouched
+        if any fails.
+        """
+        timestamps = [self._epoch(s.timestamp) for s in samples]
+        now = time.time()
+        cache = self.cache
+        # The predecessor of a sample is the previous one of its resource
+        # in the batch, if any.
+        last = {}
+        rated = []
+        prevs = []
+        for s, timestamp in zip(samples, timestamps):
+            key = (s.name, s.resource_id)
+            prev = last[key] if key in last else cache.get(key, now)
+            last[key] = (s.volume, timestamp)
+            if prev is None:
+                LOG.warn(_('dropping sample with no predecessor: %s'),
+                         (s,))
+            else:
+                rated.append((s, timestamp))
+                prevs.append(prev)
+        converted = []
+        if rated:
+            rated_samples, rated_timestamps = zip(*rated)
+            prev_volumes, prev_timestamps = zip(*prevs)
+            rates = _rates([s.volume for s in rated_samples],
+                           rated_timestamps, prev_volumes, prev_timestamps,
+                           [s.type == sample.TYPE_CUMULATIVE
+                            for s in rated_samples])
+            converted = [self._convert(s, rate, volume=scaled)
+                         for s, scaled, rate in zip(
+                             rated_samples, self._scales(rated_samples),
+                             rates)]
+        for s, timestamp in zip(samples, timestamps):
+            cache.update((s.name, s.resource_id), s.volume, timestamp, now)
+        return converted
+
+    def export_state(self, match):
+        state = []
+        for key in [k for k in self.cache if match(k[1])]:
+            entry = self.cache.get(key)
+            if entry is None:
+                continue
+            volume, timestamp = entry
+            timestamp = datetime.datetime.utcfromtimestamp(timestamp)
+            state.append([key[0], key[1], volume,
+                          timestamp.replace(tzinfo=iso8601.iso8601.UTC)
+                          .isoformat()])
+        return state or None
+
+    def drop_state(self, match):
+        for key in [k for k in self.cache if match(k[1])]:
+            self.cache.pop(key)
+
+    def import_state(self, state, match):
+        for name, resource_id, volume, timestamp in state:
+            if not match(resource_id):
+                continue
+            timestamp = self._epoch(timestamp)
+            prev = self.cache.get((name, resource_id))
+            # The samples received meanwhile are more recent.
+            if prev is None or prev[1] < timestamp:
+                self.cache.update((name, resource_id), volume, timestamp)
+
 
 class AggregatorTransformer(ScalingTransformer):
     """Transformer that aggregates samples.
@@ -203,26 +485,53 @@ class AggregatorTransformer(ScalingTransformer):
         return "%s-%s-%s" % (s.name, s.resource_id, non_aggregated_keys)
 
     def handle_sample(self, context, sample_):
-        if not self.initial_timestamp:
-            self.initial_timestamp = timeutils.parse_isotime(sample_.timestamp)
+        self._aggregate_all([sample_], [self._scale(sample_)])
+
+    def handle_samples(self, context, samples):
+        """Aggregate a batch of samples."""
+        if samples:
+            self._aggregate_all(samples, self._scales(samples))
+        return []
 
-        self.aggregated_samples += 1
+    def _aggregate_all(self, samples, volumes):
+        """Aggregate samples, all or none of them.
+
+        The aggregates are updated on copies which only replace them once
+        all the samples are aggregated, so that they are left untouched
+        if any sample fails, the samples being then retried one by one.
+        """
+        initial_timestamp = (self.initial_timestamp or
+                             timeutils.parse_isotime(samples[0].timestamp))
+        aggregates = {}
+        counts = {}
+        for sample_, volume in zip(samples, volumes):
+            self._aggregate(sample_, volume, aggregates, counts)
+        self.samples.update(aggregates)
+        self.counts.update(counts)
+        self.aggregated_samples += len(samples)
+        self.initial_timestamp = initial_timestamp
+
+    def _aggregate(self, sample_, volume, aggregates, counts):
         key = self._get_unique_key(sample_)
-        self.counts[key] += 1
-        if key not in self.samples:
-            self.samples[key] = self._convert(sample_)
+        counts[key] = counts.get(key, self.counts.get(key, 0)) + 1
+        if key in aggregates:
+            aggregate = aggregates[key]
+        elif key in self.samples:
+            aggregate = aggregates[key] = copy.copy(self.samples[key])
+        else:
+            aggregate = self._convert(sample_, volume=volume)
             if self.merged_attribute_policy[
                     'resource_metadata'] == 'drop':
-                self.samples[key].resource_metadata = {}
+                aggregate.resource_metadata = {}
+            aggregates[key] = aggregate
+            return
+        if sample_.type == sample.TYPE_CUMULATIVE:
+            aggregate.volume = volume
         else:
-            if sample_.type == sample.TYPE_CUMULATIVE:
-                self.samples[key].volume = self._scale(sample_)
-            else:
-                self.samples[key].volume += self._scale(sample_)
-            for field in self.merged_attribute_policy:
-                if self.merged_attribute_policy[field] == 'last':
-                    setattr(self.samples[key], field,
-                            getattr(sample_, field))
+            aggregate.volume += volume
+        for field in self.merged_attribute_policy:
+            if self.merged_attribute_policy[field] == 'last':
+                setattr(aggregate, field, getattr(sample_, field))
 
     def flush(self, context):
         if not self.initial_timestamp:
@@ -18,6 +18,7 @@
 
 """Utilities and helper functions."""
 
+import array
 import bisect
 import calendar
 import copy
@@ -25,10 +26,12 @@ import datetime
 import decimal
 import hashlib
 import multiprocessing
-import struct
 import json
+import struct
+import zlib
 
 from ceilometer.openstack.common import processutils
+from eventlet import event
 from oslo.config import cfg
 from oslo.utils import timeutils
 from oslo.utils import units
@@ -220,33 +223,176 @@ def hash_of_set(s):
 
 
 class HashRing(object):
+    """Consistent hash ring spreading keys over weighted nodes.
+
+    Each node is given replicas points on the ring, multiplied by its
+    weight. The points are kept sorted in an array of unsigned 32 bit
+    integers, a key belonging to the node of the first point after the
+    hash of the key.
+
+    With the md5 hash function, the default, the keys and the points are
+    hashed as by the previous releases, so that the agents of a group can
+    be upgraded one by one. The crc32 hash function, zlib.crc32 followed
+    by the MurmurHash3 finalizer, is faster and evens the load better with
+    its 200 points per node, but lays the ring out differently: all the
+    agents of a group have to switch to it at once.
+
+    :param nodes: the nodes of the ring
+    :param replicas: number of points of a node of weight 1, by default
+                     100 with md5 and 200 with crc32
+    :param weights: optional weight of each node, by node, 1 by default
+    :param hash_function: md5 or crc32
+    """
 
-    def __init__(self, nodes, replicas=100):
-        self._ring = dict()
-        self._sorted_keys = []
+    HASH_FUNCTIONS = ('md5', 'crc32')
+
+    # Golden ratio step between the points of a node before mixing.
+    _STEP = 0x9e3779b9
+
+    def __init__(self, nodes, replicas=None, weights=None,
+                 hash_function='md5'):
+        if hash_function not in self.HASH_FUNCTIONS:
+            raise ValueError('Unknown hash function %s' % hash_function)
+        self._md5 = hash_function == 'md5'
+        if replicas is None:
+            replicas = 100 if self._md5 else 200
+        weights = weights or {}
+        points = []
+        self._nodes = list(nodes)
+        for index, node in enumerate(self._nodes):
+            count = int(round(replicas * weights.get(node, 1)))
+            if self._md5:
+                points.extend((self._md5_hash('%s-%s' % (node, r)), index)
+                              for r in six.moves.range(count))
+            else:
+                base = self._crc32_hash('%s' % node)
+                points.extend(
+                    (self._mix((base + r * self._STEP) & 0xffffffff), index)
+                    for r in six.moves.range(count))
+        # A point shared by several nodes belongs to the last of them, as
+        # with the ring of the previous releases.
+        points.sort(key=lambda p: (p[0], -p[1]))
+        self._points = array.array('I', [p[0] for p in points])
+        self._owners = [self._nodes[p[1]] for p in points]
 
-        for node in nodes:
-            for r in six.moves.range(replicas):
-                hashed_key = self._hash('%s-%s' % (node, r))
-                self._ring[hashed_key] = node
-                self._sorted_keys.append(hashed_key)
-        self._sorted_keys.sort()
+    @staticmethod
+    def _mix(h):
+        """MurmurHash3 finalizer, spreading h over the ring."""
+        h ^= h >> 16
+        h = (h * 0x85ebca6b) & 0xffffffff
+        h ^= h >> 13
+        h = (h * 0xc2b2ae35) & 0xffffffff
+        h ^= h >> 16
+        return h
 
     @staticmethod
-    def _hash(key):
+    def _md5_hash(key):
         return struct.unpack_from('>I',
                                   hashlib.md5(str(key).encode()).digest())[0]
 
-    def _get_position_on_ring(self, key):
-        hashed_key = self._hash(key)
-        position = bisect.bisect(self._sorted_keys, hashed_key)
-        return position if position < len(self._sorted_keys) else 0
+    @classmethod
+    def _crc32_hash(cls, key):
+        # CRC32 is computed in C, the finalizer makes up for its poor
+        # avalanche on similar keys.
+        if not isinstance(key, bytes):
+            key = str(key).encode()
+        return cls._mix(zlib.crc32(key) & 0xffffffff)
+
+    def _hash(self, key):
+        return self._md5_hash(key) if self._md5 else self._crc32_hash(key)
 
     def get_node(self, key):
-        if not self._ring:
+        if not self._owners:
             return None
-        pos = self._get_position_on_ring(key)
-        return self._ring[self._sorted_keys[pos]]
+        position = bisect.bisect(self._points, self._hash(key))
+        return self._owners[position if position < len(self._owners) else 0]
+
+    def get_nodes(self, keys):
+        """Return the node of each key, in the order of the keys.
+
+        Same as calling get_node for each key, with the hashing inlined.
+        """
+        owners = self._owners
+        if not owners:
+            return [None for key in keys]
+        points = self._points
+        size = len(owners)
+        find = bisect.bisect
+        nodes = []
+        append = nodes.append
+        if self._md5:
+            md5 = hashlib.md5
+            unpack = struct.unpack_from
+            for key in keys:
+                h = unpack('>I', md5(str(key).encode()).digest())[0]
+                position = find(points, h)
+                append(owners[position if position < size else 0])
+            return nodes
+        crc32 = zlib.crc32
+        for key in keys:
+            if not isinstance(key, bytes):
+                key = str(key).encode()
+            h = crc32(key) & 0xffffffff
+            h ^= h >> 16
+            h = (h * 0x85ebca6b) & 0xffffffff
+            h ^= h >> 13
+            h = (h * 0xc2b2ae35) & 0xffffffff
+            position = find(points, h ^ (h >> 16))
+            append(owners[position if position < size else 0])
+        return nodes
+
+
+# Sent to the callers waiting for a computation which was interrupted.
+_INTERRUPTED = object()
+
+
+class SingleFlightCache(dict):
+    """Cache shared by concurrent green threads.
+
+    Besides being a dict, it lets the first caller asking for a key run
+    the computation of the key, the concurrent callers waiting for the
+    same key getting its result or exception instead of running it again.
+    Nothing is remembered once the computation is over, storing the result
+    is up to the computation.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SingleFlightCache, self).__init__(*args, **kwargs)
+        self._flights = {}
+
+    def flight(self, key, compute):
+        waiter = self._flights.get(key)
+        while waiter is not None:
+            result = waiter.wait()
+            if result is not _INTERRUPTED:
+                return result
+            waiter = self._flights.get(key)
+        waiter = self._flights[key] = event.Event()
+        try:
+            result = compute()
+        except Exception as err:
+            waiter.send_exception(err)
+            raise
+        except BaseException:
+            # Interrupted by a timeout or a kill aimed at this caller only,
+            # the waiters run the computation themselves.
+            waiter.send(_INTERRUPTED)
+            raise
+        finally:
+            del self._flights[key]
+        waiter.send(result)
+        return result
+
+
+def single_flight(cache, key, compute):
+    """Run compute() unless a concurrent caller is running it for key.
+
+    :param cache: a SingleFlightCache, or any other dict in which case
+                  compute() is always run
+    """
+    if isinstance(cache, SingleFlightCache):
+        return cache.flight(key, compute)
+    return compute()
 
 
 class SetJSONEncoder(json.JSONEncoder):
@@ -255,4 +401,4 @@ class SetJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, set):
             return list(obj)
-        return json.JSONEncoder.default(self, obj)
\ No newline at end of file
+        return json.JSONEncoder.default(self, obj)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmark the assignment of resources to agents by the hash ring.
+
+Usage:
+
+Assign 100000 resources to 30 agents with the md5 ring, the default one
+laid out as by the previous releases, and with the crc32 ring
+
+source .tox/py27/bin/activate
+./tools/hashring_bench.py --resources 100000 --agents 30
+"""
+from __future__ import print_function
+
+import argparse
+import sys
+import time
+import uuid
+
+from ceilometer import utils
+
+
+def best_of(repeat, func):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def report(name, resources, build, assign, nodes):
+    counts = {}
+    for node in nodes:
+        counts[node] = counts.get(node, 0) + 1
+    mean = float(resources) / len(counts)
+    print('%-22s build %7.2f ms, assign %7.3f s, %9.0f resources/s, '
+          'load %.2f-%.2f of mean' %
+          (name, build * 1000, assign, resources / assign,
+           min(counts.values()) / mean, max(counts.values()) / mean))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--resources', type=int, default=100000,
+                        help='Number of resources assigned.')
+    parser.add_argument('--agents', type=int, default=30,
+                        help='Number of agents of the ring.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs, the best one is reported.')
+    args = parser.parse_args(argv)
+
+    agents = [str(uuid.uuid4()) for _ in range(args.agents)]
+    keys = [str(uuid.uuid4()) for _ in range(args.resources)]
+
+    for hash_function in utils.HashRing.HASH_FUNCTIONS:
+        build, ring = best_of(args.repeat, lambda: utils.HashRing(
+            agents, hash_function=hash_function))
+        assign, nodes = best_of(args.repeat,
+                                lambda: [ring.get_node(k) for k in keys])
+        report('%s get_node' % hash_function, args.resources, build,
+               assign, nodes)
+        assign, nodes = best_of(args.repeat, lambda: ring.get_nodes(keys))
+        report('%s get_nodes' % hash_function, args.resources, build,
+               assign, nodes)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmark the message-to-store latency of the VM channels listener.
+
+Usage:
+
+Simulate 200 guests sending 20 heartbeats each, with the listener waiting
+through the eventlet hub
+
+source .tox/py27/bin/activate
+./tools/ovirtga_listener_bench.py --guests 200 --messages 20 --mode green
+"""
+from __future__ import print_function
+
+import eventlet
+eventlet.monkey_patch(socket=True, select=True, thread=True)
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+
+from ceilometer.compute.virt.ovirtga import guestagent
+from ceilometer.compute.virt.ovirtga import statestore
+from ceilometer.compute.virt.ovirtga import vmchannels
+
+
+class BenchGuestAgent(guestagent.GuestAgent):
+    def _prepare_socket(self):
+        # The sockets are created by the benchmark, no chmod needed.
+        pass
+
+
+def heartbeat(value):
+    return (json.dumps({'__name__': 'heartbeat',
+                        'free-ram': 0,
+                        'memory-stat': {'mem_total': value}}) +
+            '\n').encode('utf8')
+
+
+def percentile(values, pct):
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def wait_for(predicate, timeout):
+    deadline = statestore.monotonic() + timeout
+    while not predicate():
+        if statestore.monotonic() > deadline:
+            return False
+        eventlet.sleep(0.0005)
+    return True
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guests', type=int, default=100,
+                        help='Number of simulated guest sockets.')
+    parser.add_argument('--messages', type=int, default=10,
+                        help='Number of heartbeats sent by each guest.')
+    parser.add_argument('--mode', choices=vmchannels.MODES,
+                        default=vmchannels.GREEN,
+                        help='Listener mode.')
+    args = parser.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp()
+    store = statestore.GuestStateStore()
+    listener = vmchannels.Listener(store=store, mode=args.mode)
+    listener.settimeout(30)
+    listener.start()
+    try:
+        guests = []
+        for i in range(args.guests):
+            path = os.path.join(tmpdir, 'guest-%d.sock' % i)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(path)
+            server.listen(1)
+            BenchGuestAgent(path, listener, vmName=path).connect()
+            conn, _ = server.accept()
+            guests.append((path, conn))
+
+        latencies = []
+        for msg in range(1, args.messages + 1):
+            for name, conn in guests:
+                sent = statestore.monotonic()
+                conn.sendall(heartbeat(msg))
+                if not wait_for(lambda: (store.get(name) is not None and
+                                         store.get(name).seq == msg), 10):
+                    print('Timed out waiting for %s' % name)
+                    return 1
+                latencies.append(store.get(name).timestamp - sent)
+
+        latencies.sort()
+        print('mode=%s guests=%d messages=%d' % (args.mode, args.guests,
+                                                 len(latencies)))
+        for label, value in (('min', latencies[0]),
+                             ('p50', percentile(latencies, 50)),
+                             ('p99', percentile(latencies, 99)),
+                             ('max', latencies[-1])):
+            print('%s: %.3f ms' % (label, value * 1000))
+    finally:
+        listener.stop()
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmark the guest agent message parsing.
+
+Usage:
+
+Replay traffic recorded from a guest agent channel socket (the raw bytes
+sent by the guest, e.g. captured with socat) ten times
+
+source .tox/py27/bin/activate
+./tools/ovirtga_parser_bench.py --repeat 10 guest-traffic.raw
+
+Without a recording, synthetic traffic with a large applications list
+and disks usage report is used.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+import time
+
+from ceilometer.compute.virt.ovirtga import guestagent
+
+
+class _Listener(object):
+    def report(self, name, kind, value):
+        pass
+
+
+def synthesize(messages, apps, disks):
+    lines = []
+    for i in range(messages):
+        lines.append({'__name__': 'heartbeat', 'free-ram': 1024,
+                      'memory-stat': {'mem_total': 4194304,
+                                      'mem_unused': 1048576 + i,
+                                      'mem_free': 2097152,
+                                      'swap_in': 0, 'swap_out': 0,
+                                      'pageflt': i, 'majflt': 0}})
+        if i % 10 == 0:
+            lines.append({'__name__': 'applications',
+                          'applications': [u'package-%d-1.0.\xe9l7' % n
+                                           for n in range(apps)]})
+            lines.append({'__name__': 'disks-usage',
+                          'disks': [{'path': u'/mnt/disk%d' % n,
+                                     'fs': 'ext4',
+                                     'total': 10737418240,
+                                     'used': 5368709120 + n}
+                                    for n in range(disks)],
+                          'mapping': {}})
+            lines.append({'__name__': 'network-interfaces',
+                          'interfaces': [{'name': 'eth0',
+                                          'hw': '52:54:00:12:34:56',
+                                          'inet': ['10.0.0.%d' % (i % 250)],
+                                          'inet6': ['fe80::1']}]})
+    return b''.join((json.dumps(line) + '\n').encode('utf8')
+                    for line in lines)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('recording', nargs='?',
+                        help='File with raw guest agent traffic.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of times the traffic is replayed.')
+    parser.add_argument('--chunk-size', type=int, default=2 ** 16,
+                        help='Size of the simulated socket reads.')
+    parser.add_argument('--messages', type=int, default=1000,
+                        help='Number of synthetic heartbeats.')
+    parser.add_argument('--apps', type=int, default=2000,
+                        help='Size of the synthetic applications list.')
+    parser.add_argument('--disks', type=int, default=50,
+                        help='Size of the synthetic disks usage report.')
+    args = parser.parse_args(argv)
+
+    if args.recording:
+        with open(args.recording, 'rb') as f:
+            traffic = f.read()
+    else:
+        traffic = synthesize(args.messages, args.apps, args.disks)
+    chunks = [traffic[i:i + args.chunk_size]
+              for i in range(0, len(traffic), args.chunk_size)]
+
+    agent = guestagent.GuestAgent('bench.sock', _Listener(), vmName='bench')
+    agent._clearReadBuffer()
+    agent._stopped = False
+    messages = traffic.count(b'\n')
+
+    best = None
+    for _ in range(args.repeat):
+        start = time.time()
+        for chunk in chunks:
+            agent._handleData(chunk)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    print('%d bytes, %d messages, best of %d runs: %.3f s' %
+          (len(traffic), messages, args.repeat, best))
+    print('%.1f MiB/s, %.0f messages/s' %
+          (len(traffic) / best / 2 ** 20, messages / best))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmark the state kept by the rate of change transformer.
+
+Usage:
+
+Keep the volumes of 1000000 resources over 3 polling cycles, comparing
+with the dict of parsed timestamps used before
+
+source .tox/py27/bin/activate
+./tools/rate_transformer_bench.py --resources 1000000 --cycles 3
+
+which reported, on CPython 2.7, per sample and for the whole state:
+
+dict        43.04 us/sample,  23235 samples/s, 254.0 MiB, 266 bytes/resource
+RateState    3.20 us/sample, 312425 samples/s, 147.8 MiB, 155 bytes/resource
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import sys
+import time
+
+from oslo.utils import timeutils
+
+from ceilometer.transformer import conversions
+
+
+class DictRateState(object):
+    """The state the rate of change transformer kept before."""
+
+    def __init__(self):
+        self.cache = {}
+
+    def update(self, name, resource_id, volume, timestamp):
+        key = (name, resource_id)
+        prev = self.cache.get(key)
+        self.cache[key] = (volume, timeutils.parse_isotime(timestamp))
+        return prev
+
+    def memory_footprint(self):
+        return (sys.getsizeof(self.cache) +
+                sum(sys.getsizeof(k) + sys.getsizeof(v) +
+                    sys.getsizeof(v[0]) + sys.getsizeof(v[1])
+                    for k, v in self.cache.items()))
+
+
+class TransformerRateState(object):
+    """The state kept by the rate of change transformer."""
+
+    def __init__(self):
+        self.transformer = conversions.RateOfChangeTransformer(
+            target={'name': 'cpu_util'})
+
+    def update(self, name, resource_id, volume, timestamp):
+        return self.transformer.cache.update(
+            (name, resource_id), volume, self.transformer._epoch(timestamp))
+
+    def memory_footprint(self):
+        return self.transformer.cache.memory_footprint()
+
+
+def run(state, resources, cycles, start):
+    update = state.update
+    elapsed = 0.0
+    for cycle in range(cycles):
+        timestamp = (start + datetime.timedelta(minutes=10 * cycle)
+                     ).isoformat()
+        volume = 1000.0 * (cycle + 1)
+        begin = time.time()
+        for resource_id in resources:
+            update('cpu', resource_id, volume, timestamp)
+        elapsed += time.time() - begin
+    return elapsed
+
+
+def report(name, samples, elapsed, footprint, entries):
+    print('%-16s %6.2f us/sample, %9.0f samples/s, '
+          '%7.1f MiB, %5.0f bytes/resource' %
+          (name, elapsed * 1000000 / samples, samples / elapsed,
+           footprint / 1048576.0, float(footprint) / entries))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--resources', type=int, default=1000000,
+                        help='Number of resources sampled.')
+    parser.add_argument('--cycles', type=int, default=3,
+                        help='Number of polling cycles.')
+    args = parser.parse_args(argv)
+
+    resources = ['instance-%08x-vda' % i for i in range(args.resources)]
+    start = timeutils.utcnow().replace(microsecond=0)
+    samples = args.resources * args.cycles
+    for name, factory in (('dict', DictRateState),
+                          ('RateState', TransformerRateState)):
+        state = factory()
+        elapsed = run(state, resources, args.cycles, start)
+        report(name, samples, elapsed, state.memory_footprint(),
+               args.resources)
+        del state
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))